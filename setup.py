@@ -57,10 +57,17 @@ def run_setup(with_binary=True, test_xgboost=True, test_lightgbm=True, test_catb
     ext_modules = []
     if with_binary:
         compile_args = []
+        link_args = []
         if sys.platform == 'zos':
             compile_args.append('-qlonglong')
+        elif sys.platform != 'win32':
+            compile_args.append('-std=c++11') # the C extension uses std::thread
+            if sys.platform.startswith('linux'):
+                compile_args.append('-pthread')
+                link_args.append('-pthread')
         ext_modules.append(
-            Extension('shap._cext', sources=['shap/_cext.cc'], extra_compile_args=compile_args)
+            Extension('shap._cext', sources=['shap/_cext.cc'], extra_compile_args=compile_args,
+                      extra_link_args=link_args)
         )
 
     tests_require = ['nose']
@@ -5,18 +5,24 @@
 #include "tree_shap.h"
 #include <iostream>
 
-static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args);
-static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args);
 static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args);
-static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args);
 static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args);
+static PyObject *_cext_pack_tree_ensemble(PyObject *self, PyObject *args);
+static PyObject *_cext_dense_tree_shap_packed(PyObject *self, PyObject *args);
+static PyObject *_cext_dense_tree_predict_packed(PyObject *self, PyObject *args);
+static PyObject *_cext_dense_tree_saabas_packed(PyObject *self, PyObject *args);
+static PyObject *_cext_sparse_tree_shap(PyObject *self, PyObject *args);
+static PyObject *_cext_sparse_tree_predict(PyObject *self, PyObject *args);
 
 static PyMethodDef module_methods[] = {
-    {"dense_tree_shap", _cext_dense_tree_shap, METH_VARARGS, "C implementation of Tree SHAP for dense."},
-    {"dense_tree_predict", _cext_dense_tree_predict, METH_VARARGS, "C implementation of tree predictions."},
     {"dense_tree_update_weights", _cext_dense_tree_update_weights, METH_VARARGS, "C implementation of tree node weight compuatations."},
-    {"dense_tree_saabas", _cext_dense_tree_saabas, METH_VARARGS, "C implementation of Saabas (rough fast approximation to Tree SHAP)."},
     {"compute_expectations", _cext_compute_expectations, METH_VARARGS, "Compute expectations of internal nodes."},
+    {"pack_tree_ensemble", _cext_pack_tree_ensemble, METH_VARARGS, "Build a packed copy of a tree ensemble that can be reused by the *_packed methods."},
+    {"dense_tree_shap_packed", _cext_dense_tree_shap_packed, METH_VARARGS, "C implementation of Tree SHAP for dense data using a packed tree ensemble."},
+    {"dense_tree_predict_packed", _cext_dense_tree_predict_packed, METH_VARARGS, "C implementation of tree predictions using a packed tree ensemble."},
+    {"dense_tree_saabas_packed", _cext_dense_tree_saabas_packed, METH_VARARGS, "C implementation of Saabas using a packed tree ensemble."},
+    {"sparse_tree_shap", _cext_sparse_tree_shap, METH_VARARGS, "C implementation of Tree SHAP for CSR sparse data using a packed tree ensemble."},
+    {"sparse_tree_predict", _cext_sparse_tree_predict, METH_VARARGS, "C implementation of tree predictions for CSR sparse data using a packed tree ensemble."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -56,6 +62,14 @@ PyMODINIT_FUNC init_cext(void)
     #endif
 }
 
+// The dtype of the model's values array decides which instantiation of the tree_shap.h templates a call
+// runs: float32 models run in single precision (so float32 inputs and outputs are used without a copy),
+// everything else runs in double precision.
+static int get_float_type(PyObject *values_obj) {
+    if (PyArray_Check(values_obj) && PyArray_TYPE((PyArrayObject*)values_obj) == NPY_FLOAT) return NPY_FLOAT;
+    return NPY_DOUBLE;
+}
+
 static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args)
 {
     PyObject *children_left_obj;
@@ -85,18 +99,29 @@ static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args)
         return NULL;
     }
 
-    TreeEnsemble tree;
+    TreeEnsemble<double> tree;
 
     // number of outputs
-    tree.num_outputs = PyArray_DIM(values_array, 1);
+    tree.num_outputs = PyArray_DIM(values_array, PyArray_NDIM(values_array) - 1);
 
-    /* Get pointers to the data as C-types. */
-    tree.children_left = (int*)PyArray_DATA(children_left_array);
-    tree.children_right = (int*)PyArray_DATA(children_right_array);
-    tree.values = (tfloat*)PyArray_DATA(values_array);
-    tree.node_sample_weights = (tfloat*)PyArray_DATA(node_sample_weight_array);
+    // 2D children arrays hold a whole ensemble (every tree padded out to max_nodes nodes)
+    const unsigned num_trees = PyArray_NDIM(children_left_array) == 2 ? PyArray_DIM(children_left_array, 0) : 1;
+    const unsigned max_nodes = PyArray_DIM(children_left_array, PyArray_NDIM(children_left_array) - 1);
 
-    const int max_depth = compute_expectations(tree);
+    /* Get pointers to the data as C-types. */
+    int *children_left = (int*)PyArray_DATA(children_left_array);
+    int *children_right = (int*)PyArray_DATA(children_right_array);
+    double *values = (double*)PyArray_DATA(values_array);
+    double *node_sample_weights = (double*)PyArray_DATA(node_sample_weight_array);
+
+    int max_depth = 0;
+    for (unsigned i = 0; i < num_trees; ++i) {
+        tree.children_left = children_left + i * max_nodes;
+        tree.children_right = children_right + i * max_nodes;
+        tree.values = values + i * max_nodes * tree.num_outputs;
+        tree.node_sample_weights = node_sample_weights + i * max_nodes;
+        max_depth = std::max(max_depth, compute_expectations(tree));
+    }
 
     // clean up the created python objects
     Py_XDECREF(children_left_array);
@@ -110,7 +135,7 @@ static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args)
 }
 
 
-static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
+static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args)
 {
     PyObject *children_left_obj;
     PyObject *children_right_obj;
@@ -118,26 +143,20 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     PyObject *features_obj;
     PyObject *thresholds_obj;
     PyObject *values_obj;
-    PyObject *node_sample_weights_obj;
-    int max_depth;
+    int tree_limit;
+    PyObject *node_sample_weight_obj;
     PyObject *X_obj;
     PyObject *X_missing_obj;
-    PyObject *y_obj;
-    PyObject *R_obj;
-    PyObject *R_missing_obj;
-    int tree_limit;
-    PyObject *out_contribs_obj;
-    int feature_dependence;
-    int model_output;
-    PyObject *base_offset_obj;
-    bool interactions;
+    PyObject *category_sets_obj = Py_None;
+    PyObject *category_offsets_obj = Py_None;
+    PyObject *category_bits_obj = Py_None;
+    int num_threads = 1;
   
-    /* Parse the input tuple */
+    /* Parse the input tuple (the category sets are only needed for trees with categorical splits) */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOOiOOOOOiOOiib", &children_left_obj, &children_right_obj, &children_default_obj,
-        &features_obj, &thresholds_obj, &values_obj, &node_sample_weights_obj,
-        &max_depth, &X_obj, &X_missing_obj, &y_obj, &R_obj, &R_missing_obj, &tree_limit, &base_offset_obj,
-        &out_contribs_obj, &feature_dependence, &model_output, &interactions
+        args, "OOOOOOiOOO|OOOi", &children_left_obj, &children_right_obj, &children_default_obj,
+        &features_obj, &thresholds_obj, &values_obj, &tree_limit, &node_sample_weight_obj, &X_obj, &X_missing_obj,
+        &category_sets_obj, &category_offsets_obj, &category_bits_obj, &num_threads
     )) return NULL;
 
     /* Interpret the input objects as numpy arrays. */
@@ -147,80 +166,72 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *node_sample_weights_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weights_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *node_sample_weight_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weight_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
     PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *y_array = NULL;
-    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *R_array = NULL;
-    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *R_missing_array = NULL;
-    if (R_missing_obj != Py_None) R_missing_array = (PyArrayObject*)PyArray_FROM_OTF(R_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *out_contribs_array = (PyArrayObject*)PyArray_FROM_OTF(out_contribs_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
-    PyArrayObject *base_offset_array = (PyArrayObject*)PyArray_FROM_OTF(base_offset_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *category_sets_array = NULL;
+    PyArrayObject *category_offsets_array = NULL;
+    PyArrayObject *category_bits_array = NULL;
+    if (category_sets_obj != Py_None) {
+        category_sets_array = (PyArrayObject*)PyArray_FROM_OTF(category_sets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        category_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(category_offsets_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        category_bits_array = (PyArrayObject*)PyArray_FROM_OTF(category_bits_obj, NPY_UINT32, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    }
 
-    /* If that didn't work, throw an exception. Note that R and y are optional. */
+    /* If that didn't work, throw an exception. */
     if (children_left_array == NULL || children_right_array == NULL ||
         children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
-        values_array == NULL || node_sample_weights_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_contribs_array == NULL) {
+        values_array == NULL || node_sample_weight_array == NULL || X_array == NULL ||
+        X_missing_array == NULL || (category_sets_obj != Py_None && (category_sets_array == NULL ||
+        category_offsets_array == NULL || category_bits_array == NULL))) {
+        Py_XDECREF(category_sets_array);
+        Py_XDECREF(category_offsets_array);
+        Py_XDECREF(category_bits_array);
         Py_XDECREF(children_left_array);
         Py_XDECREF(children_right_array);
         Py_XDECREF(children_default_array);
         Py_XDECREF(features_array);
         Py_XDECREF(thresholds_array);
         Py_XDECREF(values_array);
-        Py_XDECREF(node_sample_weights_array);
+        //PyArray_ResolveWritebackIfCopy(node_sample_weight_array);
+        Py_XDECREF(node_sample_weight_array);
         Py_XDECREF(X_array);
         Py_XDECREF(X_missing_array);
-        if (y_array != NULL) Py_XDECREF(y_array);
-        if (R_array != NULL) Py_XDECREF(R_array);
-        if (R_missing_array != NULL) Py_XDECREF(R_missing_array);
-        //PyArray_ResolveWritebackIfCopy(out_contribs_array);
-        Py_XDECREF(out_contribs_array);
-        Py_XDECREF(base_offset_array);
+        std::cerr << "Found a NULL input array in _cext_dense_tree_update_weights!\n";
         return NULL;
     }
 
     const unsigned num_X = PyArray_DIM(X_array, 0);
     const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
-    unsigned num_R = 0;
-    if (R_array != NULL) num_R = PyArray_DIM(R_array, 0);
+    const unsigned max_nodes = PyArray_NDIM(children_left_array) == 2 ? PyArray_DIM(children_left_array, 1) : PyArray_DIM(children_left_array, 0);
 
     // Get pointers to the data as C-types
     int *children_left = (int*)PyArray_DATA(children_left_array);
     int *children_right = (int*)PyArray_DATA(children_right_array);
     int *children_default = (int*)PyArray_DATA(children_default_array);
     int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *node_sample_weights = (tfloat*)PyArray_DATA(node_sample_weights_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
+    double *thresholds = (double*)PyArray_DATA(thresholds_array);
+    double *values = (double*)PyArray_DATA(values_array);
+    double *node_sample_weight = (double*)PyArray_DATA(node_sample_weight_array);
+    double *X = (double*)PyArray_DATA(X_array);
     bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
-    tfloat *y = NULL;
-    if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
-    tfloat *R = NULL;
-    if (R_array != NULL) R = (tfloat*)PyArray_DATA(R_array);
-    bool *R_missing = NULL;
-    if (R_missing_array != NULL) R_missing = (bool*)PyArray_DATA(R_missing_array);
-    tfloat *out_contribs = (tfloat*)PyArray_DATA(out_contribs_array);
-    tfloat *base_offset = (tfloat*)PyArray_DATA(base_offset_array);
-
-    // these are just a wrapper objects for all the pointers and numbers associated with
+
+    // these are just wrapper objects for all the pointers and numbers associated with
     // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
+    TreeEnsemble<double> trees = TreeEnsemble<double>(
         children_left, children_right, children_default, features, thresholds, values,
-        node_sample_weights, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
+        node_sample_weight, 0, tree_limit, 0, max_nodes, 0
     );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, R, R_missing, num_X, M, num_R);
-
-    dense_tree_shap(trees, data, out_contribs, feature_dependence, model_output, interactions);
+    if (category_sets_array != NULL) {
+        trees.category_sets = (int*)PyArray_DATA(category_sets_array);
+        trees.category_offsets = (unsigned*)PyArray_DATA(category_offsets_array);
+        trees.category_bits = (uint32_t*)PyArray_DATA(category_bits_array);
+    }
+    ExplanationDataset<double> data = ExplanationDataset<double>(X, X_missing, NULL, NULL, NULL, num_X, M, 0);
 
-    // retrieve return value before python cleanup of objects
-    tfloat ret_value = (double)values[0];
+    Py_BEGIN_ALLOW_THREADS
+    dense_tree_update_weights(trees, data, num_threads);
+    Py_END_ALLOW_THREADS
 
     // clean up the created python objects 
     Py_XDECREF(children_left_array);
@@ -229,23 +240,88 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     Py_XDECREF(features_array);
     Py_XDECREF(thresholds_array);
     Py_XDECREF(values_array);
-    Py_XDECREF(node_sample_weights_array);
+    //PyArray_ResolveWritebackIfCopy(node_sample_weight_array);
+    Py_XDECREF(node_sample_weight_array);
     Py_XDECREF(X_array);
     Py_XDECREF(X_missing_array);
-    if (y_array != NULL) Py_XDECREF(y_array);
-    if (R_array != NULL) Py_XDECREF(R_array);
-    if (R_missing_array != NULL) Py_XDECREF(R_missing_array);
-    //PyArray_ResolveWritebackIfCopy(out_contribs_array);
-    Py_XDECREF(out_contribs_array);
-    Py_XDECREF(base_offset_array);
+    Py_XDECREF(category_sets_array);
+    Py_XDECREF(category_offsets_array);
+    Py_XDECREF(category_bits_array);
 
     /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", ret_value);
+    PyObject *ret = Py_BuildValue("d", 1);
     return ret;
 }
 
+// Packed tree ensembles live in capsules, and the capsule name records which floating point type they use
+static const char *PACKED_FLOAT_NAME = "shap._cext.PackedTreeEnsemble[float32]";
+static const char *PACKED_DOUBLE_NAME = "shap._cext.PackedTreeEnsemble[float64]";
+
+template <typename tfloat> static const char *packed_capsule_name();
+template <> const char *packed_capsule_name<float>() { return PACKED_FLOAT_NAME; }
+template <> const char *packed_capsule_name<double>() { return PACKED_DOUBLE_NAME; }
 
-static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
+template <typename tfloat>
+static void free_packed_tree_ensemble(PyObject *capsule) {
+    delete (PackedTreeEnsemble<tfloat>*)PyCapsule_GetPointer(capsule, packed_capsule_name<tfloat>());
+}
+
+template <typename tfloat>
+static const PackedTreeEnsemble<tfloat> *get_packed_tree_ensemble(PyObject *capsule) {
+    return (const PackedTreeEnsemble<tfloat>*)PyCapsule_GetPointer(capsule, packed_capsule_name<tfloat>());
+}
+
+// returns the numpy type of a packed tree ensemble (or -1 with an exception set if it is not one)
+static int get_packed_float_type(PyObject *packed_obj) {
+    if (PyCapsule_IsValid(packed_obj, PACKED_FLOAT_NAME)) return NPY_FLOAT;
+    if (PyCapsule_IsValid(packed_obj, PACKED_DOUBLE_NAME)) return NPY_DOUBLE;
+    PyErr_SetString(PyExc_TypeError, "Expected a packed tree ensemble from _cext.pack_tree_ensemble!");
+    return -1;
+}
+
+template <typename tfloat>
+static PyObject *pack_tree_ensemble_arrays(PyArrayObject *children_left_array, PyArrayObject *children_right_array,
+                                           PyArrayObject *children_default_array, PyArrayObject *features_array,
+                                           PyArrayObject *thresholds_array, PyArrayObject *values_array,
+                                           PyArrayObject *node_sample_weights_array,
+                                           PyArrayObject *base_offset_array, const int max_depth,
+                                           PyArrayObject *num_nodes_array, PyArrayObject *category_sets_array,
+                                           PyArrayObject *category_offsets_array,
+                                           PyArrayObject *category_bits_array, PyArrayObject *linear_models_array,
+                                           PyArrayObject *linear_offsets_array,
+                                           PyArrayObject *linear_features_array,
+                                           PyArrayObject *linear_coefs_array, PyArrayObject *linear_means_array) {
+    TreeEnsemble<tfloat> trees = TreeEnsemble<tfloat>(
+        (int*)PyArray_DATA(children_left_array), (int*)PyArray_DATA(children_right_array),
+        (int*)PyArray_DATA(children_default_array), (int*)PyArray_DATA(features_array),
+        (tfloat*)PyArray_DATA(thresholds_array), (tfloat*)PyArray_DATA(values_array),
+        (tfloat*)PyArray_DATA(node_sample_weights_array), max_depth, PyArray_DIM(values_array, 0),
+        (tfloat*)PyArray_DATA(base_offset_array), PyArray_DIM(values_array, 1), PyArray_DIM(values_array, 2)
+    );
+    unsigned num_category_sets = 0;
+    if (category_sets_array != NULL) {
+        trees.category_sets = (int*)PyArray_DATA(category_sets_array);
+        trees.category_offsets = (unsigned*)PyArray_DATA(category_offsets_array);
+        trees.category_bits = (uint32_t*)PyArray_DATA(category_bits_array);
+        num_category_sets = PyArray_SIZE(category_offsets_array) - 1;
+    }
+    unsigned num_linear_models = 0;
+    if (linear_models_array != NULL) {
+        trees.linear.models = (int*)PyArray_DATA(linear_models_array);
+        trees.linear.offsets = (unsigned*)PyArray_DATA(linear_offsets_array);
+        trees.linear.features = (int*)PyArray_DATA(linear_features_array);
+        trees.linear.coefs = (tfloat*)PyArray_DATA(linear_coefs_array);
+        trees.linear.means = (tfloat*)PyArray_DATA(linear_means_array);
+        num_linear_models = PyArray_SIZE(linear_offsets_array) - 1;
+    }
+
+    PackedTreeEnsemble<tfloat> *packed = new PackedTreeEnsemble<tfloat>(
+        trees, (unsigned*)PyArray_DATA(num_nodes_array), num_category_sets, num_linear_models
+    );
+    return PyCapsule_New(packed, packed_capsule_name<tfloat>(), free_packed_tree_ensemble<tfloat>);
+}
+
+static PyObject *_cext_pack_tree_ensemble(PyObject *self, PyObject *args)
 {
     PyObject *children_left_obj;
     PyObject *children_right_obj;
@@ -253,302 +329,673 @@ static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
     PyObject *features_obj;
     PyObject *thresholds_obj;
     PyObject *values_obj;
+    PyObject *node_sample_weights_obj;
     int max_depth;
-    int tree_limit;
     PyObject *base_offset_obj;
-    int model_output;
-    PyObject *X_obj;
-    PyObject *X_missing_obj;
-    PyObject *y_obj;
-    PyObject *out_pred_obj;
-  
-    /* Parse the input tuple */
+    PyObject *num_nodes_obj;
+    PyObject *category_sets_obj = Py_None;
+    PyObject *category_offsets_obj = Py_None;
+    PyObject *category_bits_obj = Py_None;
+    PyObject *linear_models_obj = Py_None;
+    PyObject *linear_offsets_obj = Py_None;
+    PyObject *linear_features_obj = Py_None;
+    PyObject *linear_coefs_obj = Py_None;
+    PyObject *linear_means_obj = Py_None;
+
+    /* Parse the input tuple (the category sets are only needed for models with categorical splits, and the
+       linear models for models with linear leaves) */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOiiOiOOOO", &children_left_obj, &children_right_obj, &children_default_obj,
-        &features_obj, &thresholds_obj, &values_obj, &max_depth, &tree_limit, &base_offset_obj, &model_output,
-        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj
+        args, "OOOOOOOiOO|OOOOOOOO", &children_left_obj, &children_right_obj, &children_default_obj,
+        &features_obj, &thresholds_obj, &values_obj, &node_sample_weights_obj, &max_depth, &base_offset_obj,
+        &num_nodes_obj, &category_sets_obj, &category_offsets_obj, &category_bits_obj, &linear_models_obj,
+        &linear_offsets_obj, &linear_features_obj, &linear_coefs_obj, &linear_means_obj
     )) return NULL;
 
     /* Interpret the input objects as numpy arrays. */
+    const int float_type = get_float_type(values_obj);
     PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *base_offset_array = (PyArrayObject*)PyArray_FROM_OTF(base_offset_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *y_array = NULL;
-    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
-
-    /* If that didn't work, throw an exception. Note that R and y are optional. */
-    if (children_left_array == NULL || children_right_array == NULL ||
-        children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
-        values_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_pred_array == NULL) {
-        Py_XDECREF(children_left_array);
-        Py_XDECREF(children_right_array);
-        Py_XDECREF(children_default_array);
-        Py_XDECREF(features_array);
-        Py_XDECREF(thresholds_array);
-        Py_XDECREF(values_array);
-        Py_XDECREF(base_offset_array);
-        Py_XDECREF(X_array);
-        Py_XDECREF(X_missing_array);
-        if (y_array != NULL) Py_XDECREF(y_array);
-        //PyArray_ResolveWritebackIfCopy(out_pred_array);
-        Py_XDECREF(out_pred_array);
-        return NULL;
+    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *node_sample_weights_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weights_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *base_offset_array = (PyArrayObject*)PyArray_FROM_OTF(base_offset_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *num_nodes_array = (PyArrayObject*)PyArray_FROM_OTF(num_nodes_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *category_sets_array = NULL;
+    PyArrayObject *category_offsets_array = NULL;
+    PyArrayObject *category_bits_array = NULL;
+    if (category_sets_obj != Py_None) {
+        category_sets_array = (PyArrayObject*)PyArray_FROM_OTF(category_sets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        category_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(category_offsets_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        category_bits_array = (PyArrayObject*)PyArray_FROM_OTF(category_bits_obj, NPY_UINT32, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    }
+    PyArrayObject *linear_models_array = NULL;
+    PyArrayObject *linear_offsets_array = NULL;
+    PyArrayObject *linear_features_array = NULL;
+    PyArrayObject *linear_coefs_array = NULL;
+    PyArrayObject *linear_means_array = NULL;
+    if (linear_models_obj != Py_None) {
+        linear_models_array = (PyArrayObject*)PyArray_FROM_OTF(linear_models_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        linear_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(linear_offsets_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        linear_features_array = (PyArrayObject*)PyArray_FROM_OTF(linear_features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        linear_coefs_array = (PyArrayObject*)PyArray_FROM_OTF(linear_coefs_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        linear_means_array = (PyArrayObject*)PyArray_FROM_OTF(linear_means_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
     }
 
-    const unsigned num_X = PyArray_DIM(X_array, 0);
-    const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
-
-    // Get pointers to the data as C-types
-    int *children_left = (int*)PyArray_DATA(children_left_array);
-    int *children_right = (int*)PyArray_DATA(children_right_array);
-    int *children_default = (int*)PyArray_DATA(children_default_array);
-    int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *base_offset = (tfloat*)PyArray_DATA(base_offset_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
-    bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
-    tfloat *y = NULL;
-    if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
-    tfloat *out_pred = (tfloat*)PyArray_DATA(out_pred_array);
-
-    // these are just wrapper objects for all the pointers and numbers associated with
-    // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        NULL, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
-    );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, NULL, NULL, num_X, M, 0);
-
-    dense_tree_predict(out_pred, trees, data, model_output);
+    PyObject *ret = NULL;
+    if (children_left_array != NULL && children_right_array != NULL && children_default_array != NULL &&
+        features_array != NULL && thresholds_array != NULL && values_array != NULL &&
+        node_sample_weights_array != NULL && base_offset_array != NULL && num_nodes_array != NULL &&
+        (category_sets_obj == Py_None || (category_sets_array != NULL && category_offsets_array != NULL &&
+                                          category_bits_array != NULL)) &&
+        (linear_models_obj == Py_None || (linear_models_array != NULL && linear_offsets_array != NULL &&
+                                          linear_features_array != NULL && linear_coefs_array != NULL &&
+                                          linear_means_array != NULL))) {
+
+        // each tree must fit in its padded row of the source arrays
+        const npy_intp num_trees = PyArray_DIM(values_array, 0);
+        const unsigned max_nodes = PyArray_DIM(values_array, 1);
+        const unsigned *num_nodes = (unsigned*)PyArray_DATA(num_nodes_array);
+        bool valid = PyArray_SIZE(num_nodes_array) == num_trees;
+        for (npy_intp i = 0; valid && i < num_trees; ++i) {
+            if (num_nodes[i] > max_nodes) valid = false;
+        }
+        if (valid && category_sets_array != NULL) {
+            valid = PyArray_SIZE(category_sets_array) == PyArray_SIZE(children_left_array) &&
+                PyArray_SIZE(category_offsets_array) > 0;
+        }
+        if (valid && linear_models_array != NULL) {
+            const npy_intp num_terms = PyArray_SIZE(linear_features_array);
+            valid = PyArray_SIZE(linear_models_array) == PyArray_SIZE(children_left_array) &&
+                PyArray_SIZE(linear_offsets_array) > 0 &&
+                ((unsigned*)PyArray_DATA(linear_offsets_array))[PyArray_SIZE(linear_offsets_array) - 1] == num_terms &&
+                PyArray_SIZE(linear_coefs_array) == num_terms * PyArray_DIM(values_array, 2) &&
+                PyArray_SIZE(linear_means_array) == num_terms;
+        }
+
+        if (!valid) {
+            PyErr_SetString(PyExc_ValueError, "num_nodes must give a node count of at most max_nodes for every tree, "
+                            "category_sets must give a category set for every node, and linear_models must give a "
+                            "linear model for every node (with a coefficient per output and a mean for every term)!");
+        } else if (float_type == NPY_FLOAT) {
+            ret = pack_tree_ensemble_arrays<float>(
+                children_left_array, children_right_array, children_default_array, features_array,
+                thresholds_array, values_array, node_sample_weights_array, base_offset_array, max_depth,
+                num_nodes_array, category_sets_array, category_offsets_array, category_bits_array,
+                linear_models_array, linear_offsets_array, linear_features_array, linear_coefs_array,
+                linear_means_array
+            );
+        } else {
+            ret = pack_tree_ensemble_arrays<double>(
+                children_left_array, children_right_array, children_default_array, features_array,
+                thresholds_array, values_array, node_sample_weights_array, base_offset_array, max_depth,
+                num_nodes_array, category_sets_array, category_offsets_array, category_bits_array,
+                linear_models_array, linear_offsets_array, linear_features_array, linear_coefs_array,
+                linear_means_array
+            );
+        }
+    }
 
-    // clean up the created python objects 
+    // clean up the created python objects (the packed ensemble has its own copy of everything)
     Py_XDECREF(children_left_array);
     Py_XDECREF(children_right_array);
     Py_XDECREF(children_default_array);
     Py_XDECREF(features_array);
     Py_XDECREF(thresholds_array);
     Py_XDECREF(values_array);
+    Py_XDECREF(node_sample_weights_array);
     Py_XDECREF(base_offset_array);
-    Py_XDECREF(X_array);
-    Py_XDECREF(X_missing_array);
-    if (y_array != NULL) Py_XDECREF(y_array);
-    //PyArray_ResolveWritebackIfCopy(out_pred_array);
-    Py_XDECREF(out_pred_array);
+    Py_XDECREF(num_nodes_array);
+    Py_XDECREF(category_sets_array);
+    Py_XDECREF(category_offsets_array);
+    Py_XDECREF(category_bits_array);
+    Py_XDECREF(linear_models_array);
+    Py_XDECREF(linear_offsets_array);
+    Py_XDECREF(linear_features_array);
+    Py_XDECREF(linear_coefs_array);
+    Py_XDECREF(linear_means_array);
 
-    /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", (double)values[0]);
     return ret;
 }
 
 
-static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args)
+// copies a vector into a new 1D numpy array
+template <typename T>
+static PyObject *vector_to_array(const std::vector<T> &vec, const int type_num) {
+    npy_intp dims[1] = {(npy_intp)vec.size()};
+    PyObject *arr = PyArray_SimpleNew(1, dims, type_num);
+    if (arr != NULL && !vec.empty()) {
+        std::copy(vec.begin(), vec.end(), (T*)PyArray_DATA((PyArrayObject*)arr));
+    }
+    return arr;
+}
+
+// builds the (indptr, indices, data) tuple of CSR arrays holding sparse SHAP values
+template <typename tfloat>
+static PyObject *sparse_contribs_to_tuple(const SparseContribs<tfloat> &sparse_out, const int float_type) {
+    PyObject *indptr = vector_to_array(sparse_out.indptr, NPY_INT64);
+    PyObject *indices = vector_to_array(sparse_out.indices, NPY_INT);
+    PyObject *values = vector_to_array(sparse_out.data, float_type);
+    PyObject *ret = NULL;
+    if (indptr != NULL && indices != NULL && values != NULL) ret = Py_BuildValue("(OOO)", indptr, indices, values);
+    Py_XDECREF(indptr);
+    Py_XDECREF(indices);
+    Py_XDECREF(values);
+    return ret;
+}
+
+// wraps the (num_X, num_outputs, k) arrays that receive the top k SHAP values (NULL when they are not used), or
+// the (num_X, num_outputs, 2, k) arrays that receive the k largest and the k smallest of them
+template <typename tfloat>
+static TopKContribs<tfloat> *get_top_contribs(PyArrayObject *top_indices_array, PyArrayObject *top_values_array) {
+    if (top_indices_array == NULL) return NULL;
+    const int ndim = PyArray_NDIM(top_indices_array);
+    return new TopKContribs<tfloat>(
+        PyArray_DIM(top_indices_array, ndim - 1), (int*)PyArray_DATA(top_indices_array),
+        (tfloat*)PyArray_DATA(top_values_array), ndim == 4
+    );
+}
+
+template <typename tfloat>
+static PyObject *dense_tree_shap_packed_arrays(PyObject *packed_obj, PyArrayObject *X_array, PyArrayObject *X_missing_array,
+                                          PyArrayObject *y_array, PyArrayObject *R_array,
+                                          PyArrayObject *R_missing_array, PyArrayObject *out_contribs_array,
+                                          const int tree_limit, const int feature_dependence,
+                                          const int model_output, const int interactions, const int num_threads,
+                                          PyArrayObject *R_weights_array, PyArrayObject *R_tree_offsets_array,
+                                          PyArrayObject *R_tree_rows_array, PyArrayObject *R_tree_weights_array,
+                                          PyArrayObject *R_margins_array, const int approximate,
+                                          PyArrayObject *top_indices_array, PyArrayObject *top_values_array,
+                                          const int float_type, const int merged_chunk_size,
+                                          const int split_trees) {
+    const PackedTreeEnsemble<tfloat> *packed = get_packed_tree_ensemble<tfloat>(packed_obj);
+    const TreeEnsemble<tfloat> trees = packed->get_trees(tree_limit);
+    ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+        (tfloat*)PyArray_DATA(X_array), (bool*)PyArray_DATA(X_missing_array),
+        y_array == NULL ? NULL : (tfloat*)PyArray_DATA(y_array),
+        R_array == NULL ? NULL : (tfloat*)PyArray_DATA(R_array),
+        R_missing_array == NULL ? NULL : (bool*)PyArray_DATA(R_missing_array),
+        PyArray_DIM(X_array, 0), PyArray_DIM(X_array, 1), R_array == NULL ? 0 : PyArray_DIM(R_array, 0)
+    );
+    if (R_weights_array != NULL) data.R_weights = (tfloat*)PyArray_DATA(R_weights_array);
+    if (R_tree_offsets_array != NULL) {
+        data.R_tree_offsets = (unsigned*)PyArray_DATA(R_tree_offsets_array);
+        data.R_tree_rows = (unsigned*)PyArray_DATA(R_tree_rows_array);
+        data.R_tree_weights = (tfloat*)PyArray_DATA(R_tree_weights_array);
+    }
+    if (R_margins_array != NULL) data.R_margins = (tfloat*)PyArray_DATA(R_margins_array);
+    tfloat *out_contribs = out_contribs_array == NULL ? NULL : (tfloat*)PyArray_DATA(out_contribs_array);
+    SparseContribs<tfloat> sparse_out;
+    TopKContribs<tfloat> *top_out = get_top_contribs<tfloat>(top_indices_array, top_values_array);
+
+    // release the GIL while we work so other python threads can keep running
+    Py_BEGIN_ALLOW_THREADS
+    if (out_contribs == NULL) {
+        dense_tree_shap_collected(
+            trees, data, top_out == NULL ? &sparse_out : NULL, top_out, feature_dependence, model_output,
+            approximate, num_threads, packed->node_trees
+        );
+    } else {
+        dense_tree_shap(
+            trees, data, out_contribs, feature_dependence, model_output, interactions, num_threads, packed->node_trees,
+            merged_chunk_size, split_trees
+        );
+    }
+    Py_END_ALLOW_THREADS
+
+    // without a dense or top k output array we return the CSR arrays of the SHAP values
+    if (out_contribs != NULL || top_out != NULL) {
+        delete top_out;
+        Py_RETURN_NONE;
+    }
+    return sparse_contribs_to_tuple(sparse_out, float_type);
+}
+
+static PyObject *_cext_dense_tree_shap_packed(PyObject *self, PyObject *args)
 {
-    PyObject *children_left_obj;
-    PyObject *children_right_obj;
-    PyObject *children_default_obj;
-    PyObject *features_obj;
-    PyObject *thresholds_obj;
-    PyObject *values_obj;
-    int tree_limit;
-    PyObject *node_sample_weight_obj;
+    PyObject *packed_obj;
     PyObject *X_obj;
     PyObject *X_missing_obj;
-  
-    /* Parse the input tuple */
+    PyObject *y_obj;
+    PyObject *R_obj;
+    PyObject *R_missing_obj;
+    int tree_limit;
+    PyObject *out_contribs_obj;
+    int feature_dependence;
+    int model_output;
+    int interactions;
+    int num_threads;
+    PyObject *R_weights_obj = Py_None;
+    PyObject *R_tree_offsets_obj = Py_None;
+    PyObject *R_tree_rows_obj = Py_None;
+    PyObject *R_tree_weights_obj = Py_None;
+    PyObject *R_margins_obj = Py_None;
+    int approximate = 0;
+    PyObject *top_indices_obj = Py_None;
+    PyObject *top_values_obj = Py_None;
+    int merged_chunk_size = 0;
+    int split_trees = 0;
+
+    /* Parse the input tuple (the background summary arrays and cached background margins are optional, and
+       out_contribs can be None to get the SHAP values back as CSR arrays, or written into the top k arrays,
+       which approximate then applies to, while merged_chunk_size is only used by global_path_dependent and
+       split_trees, which splits the trees rather than the samples between the threads, by tree_path_dependent) */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOiOOO", &children_left_obj, &children_right_obj, &children_default_obj,
-        &features_obj, &thresholds_obj, &values_obj, &tree_limit, &node_sample_weight_obj, &X_obj, &X_missing_obj
+        args, "OOOOOOiOiiii|OOOOOiOOii", &packed_obj, &X_obj, &X_missing_obj, &y_obj, &R_obj, &R_missing_obj,
+        &tree_limit, &out_contribs_obj, &feature_dependence, &model_output, &interactions, &num_threads,
+        &R_weights_obj, &R_tree_offsets_obj, &R_tree_rows_obj, &R_tree_weights_obj, &R_margins_obj, &approximate,
+        &top_indices_obj, &top_values_obj, &merged_chunk_size, &split_trees
     )) return NULL;
+    const int float_type = get_packed_float_type(packed_obj);
+    if (float_type < 0) return NULL;
+    if (out_contribs_obj == Py_None && interactions != 0) {
+        PyErr_SetString(PyExc_ValueError, "SHAP interaction values can only be written to a dense output array!");
+        return NULL;
+    }
+    if ((top_indices_obj != Py_None || top_values_obj != Py_None) && out_contribs_obj != Py_None) {
+        PyErr_SetString(PyExc_ValueError, "The top k SHAP values are computed instead of a dense output array!");
+        return NULL;
+    }
 
     /* Interpret the input objects as numpy arrays. */
-    PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *node_sample_weight_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weight_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
-
-    /* If that didn't work, throw an exception. */
-    if (children_left_array == NULL || children_right_array == NULL ||
-        children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
-        values_array == NULL || node_sample_weight_array == NULL || X_array == NULL ||
-        X_missing_array == NULL) {
-        Py_XDECREF(children_left_array);
-        Py_XDECREF(children_right_array);
-        Py_XDECREF(children_default_array);
-        Py_XDECREF(features_array);
-        Py_XDECREF(thresholds_array);
-        Py_XDECREF(values_array);
-        //PyArray_ResolveWritebackIfCopy(node_sample_weight_array);
-        Py_XDECREF(node_sample_weight_array);
-        Py_XDECREF(X_array);
-        Py_XDECREF(X_missing_array);
-        std::cerr << "Found a NULL input array in _cext_dense_tree_update_weights!\n";
-        return NULL;
+    PyArrayObject *y_array = NULL;
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *R_array = NULL;
+    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *R_missing_array = NULL;
+    if (R_missing_obj != Py_None) R_missing_array = (PyArrayObject*)PyArray_FROM_OTF(R_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_contribs_array = NULL;
+    if (out_contribs_obj != Py_None) out_contribs_array = (PyArrayObject*)PyArray_FROM_OTF(out_contribs_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *R_weights_array = NULL;
+    if (R_weights_obj != Py_None) R_weights_array = (PyArrayObject*)PyArray_FROM_OTF(R_weights_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *R_tree_offsets_array = NULL;
+    PyArrayObject *R_tree_rows_array = NULL;
+    PyArrayObject *R_tree_weights_array = NULL;
+    if (R_tree_offsets_obj != Py_None) {
+        R_tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_offsets_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        R_tree_rows_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_rows_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        R_tree_weights_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_weights_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    }
+    PyArrayObject *R_margins_array = NULL;
+    if (R_margins_obj != Py_None) R_margins_array = (PyArrayObject*)PyArray_FROM_OTF(R_margins_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *top_indices_array = NULL;
+    if (top_indices_obj != Py_None) top_indices_array = (PyArrayObject*)PyArray_FROM_OTF(top_indices_obj, NPY_INT, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *top_values_array = NULL;
+    if (top_values_obj != Py_None) top_values_array = (PyArrayObject*)PyArray_FROM_OTF(top_values_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that R, y, the background summary and out_contribs are optional. */
+    PyObject *ret = NULL;
+    const bool valid = X_array != NULL && X_missing_array != NULL &&
+        (out_contribs_obj == Py_None || out_contribs_array != NULL) &&
+        (y_obj == Py_None || y_array != NULL) && (R_obj == Py_None || R_array != NULL) &&
+        (R_missing_obj == Py_None || R_missing_array != NULL) &&
+        (R_weights_obj == Py_None || R_weights_array != NULL) &&
+        (R_tree_offsets_obj == Py_None || (R_tree_offsets_array != NULL && R_tree_rows_array != NULL && R_tree_weights_array != NULL)) &&
+        (R_margins_obj == Py_None || R_margins_array != NULL) &&
+        (top_indices_obj == Py_None) == (top_values_obj == Py_None) &&
+        (top_indices_obj == Py_None || (top_indices_array != NULL && top_values_array != NULL));
+    if (valid && float_type == NPY_FLOAT) {
+        ret = dense_tree_shap_packed_arrays<float>(
+            packed_obj, X_array, X_missing_array, y_array, R_array, R_missing_array, out_contribs_array,
+            tree_limit, feature_dependence, model_output, interactions, num_threads,
+            R_weights_array, R_tree_offsets_array, R_tree_rows_array, R_tree_weights_array, R_margins_array,
+            approximate, top_indices_array, top_values_array, float_type, merged_chunk_size, split_trees
+        );
+    } else if (valid) {
+        ret = dense_tree_shap_packed_arrays<double>(
+            packed_obj, X_array, X_missing_array, y_array, R_array, R_missing_array, out_contribs_array,
+            tree_limit, feature_dependence, model_output, interactions, num_threads,
+            R_weights_array, R_tree_offsets_array, R_tree_rows_array, R_tree_weights_array, R_margins_array,
+            approximate, top_indices_array, top_values_array, float_type, merged_chunk_size, split_trees
+        );
     }
 
-    const unsigned num_X = PyArray_DIM(X_array, 0);
-    const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-
-    // Get pointers to the data as C-types
-    int *children_left = (int*)PyArray_DATA(children_left_array);
-    int *children_right = (int*)PyArray_DATA(children_right_array);
-    int *children_default = (int*)PyArray_DATA(children_default_array);
-    int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *node_sample_weight = (tfloat*)PyArray_DATA(node_sample_weight_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
-    bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
-
-    // these are just wrapper objects for all the pointers and numbers associated with
-    // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        node_sample_weight, 0, tree_limit, 0, max_nodes, 0
-    );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, NULL, NULL, NULL, num_X, M, 0);
-
-    dense_tree_update_weights(trees, data);
-
-    // clean up the created python objects 
-    Py_XDECREF(children_left_array);
-    Py_XDECREF(children_right_array);
-    Py_XDECREF(children_default_array);
-    Py_XDECREF(features_array);
-    Py_XDECREF(thresholds_array);
-    Py_XDECREF(values_array);
-    //PyArray_ResolveWritebackIfCopy(node_sample_weight_array);
-    Py_XDECREF(node_sample_weight_array);
+    // clean up the created python objects
     Py_XDECREF(X_array);
     Py_XDECREF(X_missing_array);
+    Py_XDECREF(y_array);
+    Py_XDECREF(R_array);
+    Py_XDECREF(R_missing_array);
+    Py_XDECREF(R_weights_array);
+    Py_XDECREF(R_tree_offsets_array);
+    Py_XDECREF(R_tree_rows_array);
+    Py_XDECREF(R_tree_weights_array);
+    Py_XDECREF(R_margins_array);
+    Py_XDECREF(top_indices_array);
+    Py_XDECREF(top_values_array);
+    //PyArray_ResolveWritebackIfCopy(out_contribs_array);
+    Py_XDECREF(out_contribs_array);
 
-    /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", 1);
     return ret;
 }
 
 
-static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
+template <typename tfloat>
+static void dense_tree_predict_packed_arrays(PyObject *packed_obj, PyArrayObject *X_array,
+                                             PyArrayObject *X_missing_array, PyArrayObject *y_array,
+                                             PyArrayObject *out_pred_array, const int tree_limit,
+                                             const int model_output, const bool saabas, const int num_threads) {
+    const PackedTreeEnsemble<tfloat> *packed = get_packed_tree_ensemble<tfloat>(packed_obj);
+    const TreeEnsemble<tfloat> trees = packed->get_trees(tree_limit);
+    ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+        (tfloat*)PyArray_DATA(X_array), (bool*)PyArray_DATA(X_missing_array),
+        y_array == NULL ? NULL : (tfloat*)PyArray_DATA(y_array), NULL, NULL,
+        PyArray_DIM(X_array, 0), PyArray_DIM(X_array, 1), 0
+    );
+    tfloat *out_pred = (tfloat*)PyArray_DATA(out_pred_array);
+
+    Py_BEGIN_ALLOW_THREADS
+    if (saabas) {
+        dense_tree_saabas(out_pred, trees, data, num_threads);
+    } else {
+        dense_tree_predict(out_pred, trees, data, model_output, num_threads);
+    }
+    Py_END_ALLOW_THREADS
+}
+
+// shared by dense_tree_predict_packed and dense_tree_saabas_packed since they take the same inputs
+static PyObject *dense_tree_predict_packed_args(PyObject *args, const bool saabas)
 {
-    PyObject *children_left_obj;
-    PyObject *children_right_obj;
-    PyObject *children_default_obj;
-    PyObject *features_obj;
-    PyObject *thresholds_obj;
-    PyObject *values_obj;
-    int max_depth;
+    PyObject *packed_obj;
     int tree_limit;
-    PyObject *base_offset_obj;
     int model_output;
     PyObject *X_obj;
     PyObject *X_missing_obj;
     PyObject *y_obj;
     PyObject *out_pred_obj;
-    
-  
+    int num_threads = 1;
+
     /* Parse the input tuple */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOiiOiOOOO", &children_left_obj, &children_right_obj, &children_default_obj,
-        &features_obj, &thresholds_obj, &values_obj, &max_depth, &tree_limit, &base_offset_obj, &model_output,
-        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj
+        args, "OiiOOOO|i", &packed_obj, &tree_limit, &model_output,
+        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj, &num_threads
     )) return NULL;
+    const int float_type = get_packed_float_type(packed_obj);
+    if (float_type < 0) return NULL;
 
     /* Interpret the input objects as numpy arrays. */
-    PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *base_offset_array = (PyArrayObject*)PyArray_FROM_OTF(base_offset_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *y_array = NULL;
-    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that y is optional. */
+    const bool valid = X_array != NULL && X_missing_array != NULL && out_pred_array != NULL &&
+        (y_obj == Py_None || y_array != NULL);
+    if (valid && float_type == NPY_FLOAT) {
+        dense_tree_predict_packed_arrays<float>(
+            packed_obj, X_array, X_missing_array, y_array, out_pred_array, tree_limit, model_output, saabas, num_threads
+        );
+    } else if (valid) {
+        dense_tree_predict_packed_arrays<double>(
+            packed_obj, X_array, X_missing_array, y_array, out_pred_array, tree_limit, model_output, saabas, num_threads
+        );
+    }
 
-    /* If that didn't work, throw an exception. Note that R and y are optional. */
-    if (children_left_array == NULL || children_right_array == NULL ||
-        children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
-        values_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_pred_array == NULL) {
-        Py_XDECREF(children_left_array);
-        Py_XDECREF(children_right_array);
-        Py_XDECREF(children_default_array);
-        Py_XDECREF(features_array);
-        Py_XDECREF(thresholds_array);
-        Py_XDECREF(values_array);
-        Py_XDECREF(base_offset_array);
-        Py_XDECREF(X_array);
-        Py_XDECREF(X_missing_array);
-        if (y_array != NULL) Py_XDECREF(y_array);
-        //PyArray_ResolveWritebackIfCopy(out_pred_array);
-        Py_XDECREF(out_pred_array);
+    // clean up the created python objects
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+    Py_XDECREF(y_array);
+    //PyArray_ResolveWritebackIfCopy(out_pred_array);
+    Py_XDECREF(out_pred_array);
+
+    if (!valid) return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *_cext_dense_tree_predict_packed(PyObject *self, PyObject *args)
+{
+    return dense_tree_predict_packed_args(args, false);
+}
+
+static PyObject *_cext_dense_tree_saabas_packed(PyObject *self, PyObject *args)
+{
+    return dense_tree_predict_packed_args(args, true);
+}
+
+
+template <typename tfloat>
+static PyObject *sparse_tree_shap_arrays(PyObject *packed_obj, PyArrayObject *X_indptr_array,
+                                         PyArrayObject *X_indices_array, PyArrayObject *X_data_array,
+                                         const int M, const int absent_missing, PyArrayObject *y_array,
+                                         PyArrayObject *R_array, PyArrayObject *R_missing_array,
+                                         PyArrayObject *out_contribs_array, const int tree_limit,
+                                         const int feature_dependence, const int model_output,
+                                         const int approximate, const int num_threads,
+                                         PyArrayObject *R_weights_array, PyArrayObject *R_tree_offsets_array,
+                                         PyArrayObject *R_tree_rows_array, PyArrayObject *R_tree_weights_array,
+                                         PyArrayObject *R_margins_array, PyArrayObject *top_indices_array,
+                                         PyArrayObject *top_values_array, const int float_type) {
+    const PackedTreeEnsemble<tfloat> *packed = get_packed_tree_ensemble<tfloat>(packed_obj);
+    const TreeEnsemble<tfloat> trees = packed->get_trees(tree_limit);
+    const SparseDataset<tfloat> X = SparseDataset<tfloat>(
+        (int64_t*)PyArray_DATA(X_indptr_array), (int*)PyArray_DATA(X_indices_array),
+        (tfloat*)PyArray_DATA(X_data_array), PyArray_DIM(X_indptr_array, 0) - 1, M, absent_missing
+    );
+    ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+        NULL, NULL, y_array == NULL ? NULL : (tfloat*)PyArray_DATA(y_array),
+        R_array == NULL ? NULL : (tfloat*)PyArray_DATA(R_array),
+        R_missing_array == NULL ? NULL : (bool*)PyArray_DATA(R_missing_array),
+        X.num_X, M, R_array == NULL ? 0 : PyArray_DIM(R_array, 0)
+    );
+    if (R_weights_array != NULL) data.R_weights = (tfloat*)PyArray_DATA(R_weights_array);
+    if (R_tree_offsets_array != NULL) {
+        data.R_tree_offsets = (unsigned*)PyArray_DATA(R_tree_offsets_array);
+        data.R_tree_rows = (unsigned*)PyArray_DATA(R_tree_rows_array);
+        data.R_tree_weights = (tfloat*)PyArray_DATA(R_tree_weights_array);
+    }
+    if (R_margins_array != NULL) data.R_margins = (tfloat*)PyArray_DATA(R_margins_array);
+    tfloat *out_contribs = out_contribs_array == NULL ? NULL : (tfloat*)PyArray_DATA(out_contribs_array);
+    SparseContribs<tfloat> sparse_out;
+    TopKContribs<tfloat> *top_out = get_top_contribs<tfloat>(top_indices_array, top_values_array);
+
+    // release the GIL while we work so other python threads can keep running
+    Py_BEGIN_ALLOW_THREADS
+    sparse_tree_shap(
+        trees, X, data, out_contribs, out_contribs == NULL && top_out == NULL ? &sparse_out : NULL, top_out,
+        feature_dependence, model_output, approximate, num_threads, packed->node_trees
+    );
+    Py_END_ALLOW_THREADS
+
+    // without a dense or top k output array we return the CSR arrays of the SHAP values
+    if (out_contribs != NULL || top_out != NULL) {
+        delete top_out;
+        Py_RETURN_NONE;
+    }
+    return sparse_contribs_to_tuple(sparse_out, float_type);
+}
+
+static PyObject *_cext_sparse_tree_shap(PyObject *self, PyObject *args)
+{
+    PyObject *packed_obj;
+    PyObject *X_indptr_obj;
+    PyObject *X_indices_obj;
+    PyObject *X_data_obj;
+    int M;
+    int absent_missing;
+    PyObject *y_obj;
+    PyObject *R_obj;
+    PyObject *R_missing_obj;
+    int tree_limit;
+    PyObject *out_contribs_obj;
+    int feature_dependence;
+    int model_output;
+    int approximate;
+    int num_threads;
+    PyObject *R_weights_obj = Py_None;
+    PyObject *R_tree_offsets_obj = Py_None;
+    PyObject *R_tree_rows_obj = Py_None;
+    PyObject *R_tree_weights_obj = Py_None;
+    PyObject *R_margins_obj = Py_None;
+    PyObject *top_indices_obj = Py_None;
+    PyObject *top_values_obj = Py_None;
+
+    /* Parse the input tuple (out_contribs can be None to get the SHAP values back as CSR arrays, or written
+       into the top k arrays) */
+    if (!PyArg_ParseTuple(
+        args, "OOOOiiOOOiOiiii|OOOOOOO", &packed_obj, &X_indptr_obj, &X_indices_obj, &X_data_obj, &M,
+        &absent_missing, &y_obj, &R_obj, &R_missing_obj, &tree_limit, &out_contribs_obj, &feature_dependence,
+        &model_output, &approximate, &num_threads, &R_weights_obj, &R_tree_offsets_obj, &R_tree_rows_obj,
+        &R_tree_weights_obj, &R_margins_obj, &top_indices_obj, &top_values_obj
+    )) return NULL;
+    const int float_type = get_packed_float_type(packed_obj);
+    if (float_type < 0) return NULL;
+    if ((top_indices_obj != Py_None || top_values_obj != Py_None) && out_contribs_obj != Py_None) {
+        PyErr_SetString(PyExc_ValueError, "The top k SHAP values are computed instead of a dense output array!");
         return NULL;
     }
 
-    const unsigned num_X = PyArray_DIM(X_array, 0);
-    const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
+    /* Interpret the input objects as numpy arrays. */
+    PyArrayObject *X_indptr_array = (PyArrayObject*)PyArray_FROM_OTF(X_indptr_obj, NPY_INT64, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *X_indices_array = (PyArrayObject*)PyArray_FROM_OTF(X_indices_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *X_data_array = (PyArrayObject*)PyArray_FROM_OTF(X_data_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *y_array = NULL;
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *R_array = NULL;
+    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *R_missing_array = NULL;
+    if (R_missing_obj != Py_None) R_missing_array = (PyArrayObject*)PyArray_FROM_OTF(R_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_contribs_array = NULL;
+    if (out_contribs_obj != Py_None) out_contribs_array = (PyArrayObject*)PyArray_FROM_OTF(out_contribs_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *R_weights_array = NULL;
+    if (R_weights_obj != Py_None) R_weights_array = (PyArrayObject*)PyArray_FROM_OTF(R_weights_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *R_tree_offsets_array = NULL;
+    PyArrayObject *R_tree_rows_array = NULL;
+    PyArrayObject *R_tree_weights_array = NULL;
+    if (R_tree_offsets_obj != Py_None) {
+        R_tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_offsets_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        R_tree_rows_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_rows_obj, NPY_UINT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        R_tree_weights_array = (PyArrayObject*)PyArray_FROM_OTF(R_tree_weights_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    }
+    PyArrayObject *R_margins_array = NULL;
+    if (R_margins_obj != Py_None) R_margins_array = (PyArrayObject*)PyArray_FROM_OTF(R_margins_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *top_indices_array = NULL;
+    if (top_indices_obj != Py_None) top_indices_array = (PyArrayObject*)PyArray_FROM_OTF(top_indices_obj, NPY_INT, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *top_values_array = NULL;
+    if (top_values_obj != Py_None) top_values_array = (PyArrayObject*)PyArray_FROM_OTF(top_values_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that R, y, the background summary and out_contribs are optional. */
+    PyObject *ret = NULL;
+    const bool valid = X_indptr_array != NULL && X_indices_array != NULL && X_data_array != NULL &&
+        (out_contribs_obj == Py_None || out_contribs_array != NULL) &&
+        (y_obj == Py_None || y_array != NULL) && (R_obj == Py_None || R_array != NULL) &&
+        (R_missing_obj == Py_None || R_missing_array != NULL) &&
+        (R_weights_obj == Py_None || R_weights_array != NULL) &&
+        (R_tree_offsets_obj == Py_None || (R_tree_offsets_array != NULL && R_tree_rows_array != NULL && R_tree_weights_array != NULL)) &&
+        (R_margins_obj == Py_None || R_margins_array != NULL) &&
+        (top_indices_obj == Py_None) == (top_values_obj == Py_None) &&
+        (top_indices_obj == Py_None || (top_indices_array != NULL && top_values_array != NULL));
+    if (valid && float_type == NPY_FLOAT) {
+        ret = sparse_tree_shap_arrays<float>(
+            packed_obj, X_indptr_array, X_indices_array, X_data_array, M, absent_missing, y_array, R_array,
+            R_missing_array, out_contribs_array, tree_limit, feature_dependence, model_output, approximate,
+            num_threads, R_weights_array, R_tree_offsets_array, R_tree_rows_array, R_tree_weights_array,
+            R_margins_array, top_indices_array, top_values_array, float_type
+        );
+    } else if (valid) {
+        ret = sparse_tree_shap_arrays<double>(
+            packed_obj, X_indptr_array, X_indices_array, X_data_array, M, absent_missing, y_array, R_array,
+            R_missing_array, out_contribs_array, tree_limit, feature_dependence, model_output, approximate,
+            num_threads, R_weights_array, R_tree_offsets_array, R_tree_rows_array, R_tree_weights_array,
+            R_margins_array, top_indices_array, top_values_array, float_type
+        );
+    }
 
-    // Get pointers to the data as C-types
-    int *children_left = (int*)PyArray_DATA(children_left_array);
-    int *children_right = (int*)PyArray_DATA(children_right_array);
-    int *children_default = (int*)PyArray_DATA(children_default_array);
-    int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *base_offset = (tfloat*)PyArray_DATA(base_offset_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
-    bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
-    tfloat *y = NULL;
-    if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
-    tfloat *out_pred = (tfloat*)PyArray_DATA(out_pred_array);
+    // clean up the created python objects
+    Py_XDECREF(X_indptr_array);
+    Py_XDECREF(X_indices_array);
+    Py_XDECREF(X_data_array);
+    Py_XDECREF(y_array);
+    Py_XDECREF(R_array);
+    Py_XDECREF(R_missing_array);
+    Py_XDECREF(R_weights_array);
+    Py_XDECREF(R_tree_offsets_array);
+    Py_XDECREF(R_tree_rows_array);
+    Py_XDECREF(R_tree_weights_array);
+    Py_XDECREF(R_margins_array);
+    Py_XDECREF(top_indices_array);
+    Py_XDECREF(top_values_array);
+    Py_XDECREF(out_contribs_array);
 
-    // these are just wrapper objects for all the pointers and numbers associated with
-    // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        NULL, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
+    return ret;
+}
+
+template <typename tfloat>
+static void sparse_tree_predict_arrays(PyObject *packed_obj, PyArrayObject *X_indptr_array,
+                                       PyArrayObject *X_indices_array, PyArrayObject *X_data_array,
+                                       const int M, const int absent_missing, PyArrayObject *y_array,
+                                       PyArrayObject *out_pred_array, const int tree_limit,
+                                       const int model_output, const int num_threads) {
+    const PackedTreeEnsemble<tfloat> *packed = get_packed_tree_ensemble<tfloat>(packed_obj);
+    const TreeEnsemble<tfloat> trees = packed->get_trees(tree_limit);
+    const SparseDataset<tfloat> X = SparseDataset<tfloat>(
+        (int64_t*)PyArray_DATA(X_indptr_array), (int*)PyArray_DATA(X_indices_array),
+        (tfloat*)PyArray_DATA(X_data_array), PyArray_DIM(X_indptr_array, 0) - 1, M, absent_missing
     );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, NULL, NULL, num_X, M, 0);
+    const tfloat *y = y_array == NULL ? NULL : (tfloat*)PyArray_DATA(y_array);
+    tfloat *out_pred = (tfloat*)PyArray_DATA(out_pred_array);
 
-    dense_tree_saabas(out_pred, trees, data);
+    Py_BEGIN_ALLOW_THREADS
+    sparse_tree_predict(out_pred, trees, X, y, model_output, num_threads);
+    Py_END_ALLOW_THREADS
+}
 
-    // clean up the created python objects 
-    Py_XDECREF(children_left_array);
-    Py_XDECREF(children_right_array);
-    Py_XDECREF(children_default_array);
-    Py_XDECREF(features_array);
-    Py_XDECREF(thresholds_array);
-    Py_XDECREF(values_array);
-    Py_XDECREF(base_offset_array);
-    Py_XDECREF(X_array);
-    Py_XDECREF(X_missing_array);
-    if (y_array != NULL) Py_XDECREF(y_array);
-    //PyArray_ResolveWritebackIfCopy(out_pred_array);
+static PyObject *_cext_sparse_tree_predict(PyObject *self, PyObject *args)
+{
+    PyObject *packed_obj;
+    int tree_limit;
+    int model_output;
+    PyObject *X_indptr_obj;
+    PyObject *X_indices_obj;
+    PyObject *X_data_obj;
+    int M;
+    int absent_missing;
+    PyObject *y_obj;
+    PyObject *out_pred_obj;
+    int num_threads = 1;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OiiOOOiiOO|i", &packed_obj, &tree_limit, &model_output, &X_indptr_obj, &X_indices_obj,
+        &X_data_obj, &M, &absent_missing, &y_obj, &out_pred_obj, &num_threads
+    )) return NULL;
+    const int float_type = get_packed_float_type(packed_obj);
+    if (float_type < 0) return NULL;
+
+    /* Interpret the input objects as numpy arrays. */
+    PyArrayObject *X_indptr_array = (PyArrayObject*)PyArray_FROM_OTF(X_indptr_obj, NPY_INT64, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *X_indices_array = (PyArrayObject*)PyArray_FROM_OTF(X_indices_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *X_data_array = (PyArrayObject*)PyArray_FROM_OTF(X_data_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *y_array = NULL;
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, float_type, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, float_type, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that y is optional. */
+    const bool valid = X_indptr_array != NULL && X_indices_array != NULL && X_data_array != NULL &&
+        out_pred_array != NULL && (y_obj == Py_None || y_array != NULL);
+    if (valid && float_type == NPY_FLOAT) {
+        sparse_tree_predict_arrays<float>(
+            packed_obj, X_indptr_array, X_indices_array, X_data_array, M, absent_missing, y_array,
+            out_pred_array, tree_limit, model_output, num_threads
+        );
+    } else if (valid) {
+        sparse_tree_predict_arrays<double>(
+            packed_obj, X_indptr_array, X_indices_array, X_data_array, M, absent_missing, y_array,
+            out_pred_array, tree_limit, model_output, num_threads
+        );
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(X_indptr_array);
+    Py_XDECREF(X_indices_array);
+    Py_XDECREF(X_data_array);
+    Py_XDECREF(y_array);
     Py_XDECREF(out_pred_array);
 
-    /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", (double)values[0]);
-    return ret;
-}
\ No newline at end of file
+    if (!valid) return NULL;
+    Py_RETURN_NONE;
+}
@@ -1,10 +1,13 @@
 import numpy as np
 import scipy.special
+import scipy.sparse
 import multiprocessing
 import sys
 import json
 import os
 import struct
+import pickle
+import copy
 import itertools
 from distutils.version import LooseVersion
 from .explainer import Explainer
@@ -36,6 +39,221 @@ feature_perturbation_codes = {
     "global_path_dependent": 2
 }
 
+interaction_algorithm_codes = {
+    "on_off": 1,
+    "fast": 2
+}
+
+def get_num_threads(n_jobs):
+    """ Translate an sklearn style n_jobs value into the number of native threads to use.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+def pack_category_sets(category_sets):
+    """ Pack a list of category sets into the bitsets the C extension reads for categorical splits.
+
+    Each set is a collection of non-negative integer categories. Set k is stored in the uint32 words
+    bits[offsets[k]:offsets[k+1]], where bit c % 32 of word c // 32 is set for every category c in the set.
+    """
+    offsets = np.zeros(len(category_sets) + 1, dtype=np.uint32)
+    words = []
+    for k, categories in enumerate(category_sets):
+        categories = np.asarray(categories, dtype=np.int64)
+        assert np.all(categories >= 0), "Categories must be non-negative integers!"
+        set_words = np.zeros(categories.max() // 32 + 1 if len(categories) > 0 else 0, dtype=np.uint32)
+        np.bitwise_or.at(set_words, categories // 32, (np.uint32(1) << (categories % 32).astype(np.uint32)))
+        words.append(set_words)
+        offsets[k + 1] = offsets[k] + len(set_words)
+    bits = np.concatenate(words) if len(words) > 0 else np.zeros(0, dtype=np.uint32)
+    return offsets, bits
+
+# the file format written by TreeExplainer.save (bump the version whenever the layout or the saved fields change)
+SAVE_FORMAT_MAGIC = b"SHAPTREE"
+SAVE_FORMAT_VERSION = 1
+SAVE_FORMAT_ALIGNMENT = 64
+
+def write_array_file(path, metadata, arrays):
+    """ Write a dictionary of numpy arrays (plus JSON metadata) to a file that read_array_file can memory map.
+
+    The file starts with the magic bytes, the format version and the length of a JSON header that holds the
+    metadata and the dtype, shape and offset of every array. The raw C order array data follows, with every
+    array aligned to SAVE_FORMAT_ALIGNMENT bytes.
+    """
+    arrays = {name: np.asarray(arr, order="C") for name, arr in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += -(-arr.nbytes // SAVE_FORMAT_ALIGNMENT) * SAVE_FORMAT_ALIGNMENT
+    header = json.dumps({"metadata": metadata, "arrays": layout}).encode("utf-8")
+    data_start = -(-(16 + len(header)) // SAVE_FORMAT_ALIGNMENT) * SAVE_FORMAT_ALIGNMENT
+
+    with open(path, "wb") as f:
+        f.write(SAVE_FORMAT_MAGIC + struct.pack("<II", SAVE_FORMAT_VERSION, len(header)) + header)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (data_start + layout[name]["offset"] - f.tell()))
+            f.write(arr.tobytes())
+
+def read_array_file(path, mmap=True):
+    """ Read the (metadata, arrays) written by write_array_file.
+
+    With mmap=True the arrays are read-only memory maps of the file, so every process that loads the same file
+    shares a single copy of it through the page cache.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(SAVE_FORMAT_MAGIC))
+        if magic != SAVE_FORMAT_MAGIC:
+            raise SHAPError("%s is not a file written by TreeExplainer.save!" % path)
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version > SAVE_FORMAT_VERSION:
+            raise SHAPError("%s was written by a newer version of shap (format version %d, this version reads up "
+                            "to %d)!" % (path, version, SAVE_FORMAT_VERSION))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        data_start = -(-(16 + header_len) // SAVE_FORMAT_ALIGNMENT) * SAVE_FORMAT_ALIGNMENT
+
+        arrays = {}
+        for name, info in header["arrays"].items():
+            dtype = np.dtype(info["dtype"])
+            shape = tuple(info["shape"])
+            size = int(np.prod(shape))
+            if mmap and len(shape) > 0 and size > 0:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + info["offset"], shape=shape)
+            else:
+                f.seek(data_start + info["offset"])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+    return header["metadata"], arrays
+
+def assert_shared_memory():
+    """ Sharing memory between processes needs multiprocessing.shared_memory, which was added in Python 3.8.
+    """
+    if sys.version_info < (3, 8):
+        raise SHAPError("Sharing memory between processes requires Python 3.8 or later!")
+
+class SharedArray:
+    """ A numpy array stored in a multiprocessing.shared_memory block, which pickles as a handle to the block.
+
+    np.asarray(shared_array) returns a view of the block that keeps the SharedArray alive, and unpickling a
+    SharedArray attaches to the block rather than copying it. The process that created the block unlinks it
+    once its SharedArray is garbage collected, or earlier with unlink.
+    """
+    def __init__(self, arr):
+        assert_shared_memory()
+        from multiprocessing import shared_memory
+        arr = np.asarray(arr, order="C")
+        self._shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        self._owner = True
+        self._view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self._shm.buf)
+        self._view[...] = arr
+
+    @property
+    def __array_interface__(self):
+        return self._view.__array_interface__
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "dtype": self._view.dtype.str, "shape": self._view.shape}
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._view = np.ndarray(state["shape"], dtype=np.dtype(state["dtype"]), buffer=self._shm.buf)
+
+    def unlink(self):
+        """ Remove the name of the block so no more processes can attach to it (the processes that already
+        did keep their mapping, and the memory is freed once they all close it).
+        """
+        if self._owner:
+            self._owner = False
+            self._shm.unlink()
+
+    def __del__(self):
+        # the block can only be closed once no views of it remain (views returned by np.asarray hold a reference to us)
+        if getattr(self, "_shm", None) is None:
+            return
+        self._view = None
+        self._shm.close()
+        self.unlink()
+
+def share_array(arr):
+    """ Copy an array into shared memory (arrays that are already there, and None, are returned as they are).
+    """
+    if arr is None or isinstance(arr.base, SharedArray):
+        return arr
+    return np.asarray(SharedArray(arr))
+
+def shared_array_blocks(obj):
+    """ The SharedArray blocks behind the array attributes of an object (including tuples of arrays).
+    """
+    blocks = []
+    for value in obj.__dict__.values():
+        for v in value if isinstance(value, tuple) else (value,):
+            if isinstance(v, np.ndarray) and isinstance(v.base, SharedArray):
+                blocks.append(v.base)
+    return blocks
+
+def shared_array_state(value):
+    """ Replace the shared memory arrays in an attribute value (which may be a tuple of arrays) with their handles.
+    """
+    if isinstance(value, np.ndarray) and isinstance(value.base, SharedArray):
+        return value.base
+    if isinstance(value, tuple):
+        return tuple(shared_array_state(v) for v in value)
+    return value
+
+def attach_shared_array_state(value):
+    """ The inverse of shared_array_state, used after unpickling.
+    """
+    if isinstance(value, SharedArray):
+        return np.asarray(value)
+    if isinstance(value, tuple):
+        return tuple(attach_shared_array_state(v) for v in value)
+    return value
+
+def concatenate_shap_outputs(outputs):
+    """ Stack the shap_values outputs of consecutive blocks of rows (in any of the shap_values output formats).
+    """
+    first = outputs[0]
+    if isinstance(first, (list, tuple)):
+        return type(first)(concatenate_shap_outputs([out[i] for out in outputs]) for i in range(len(first)))
+    if scipy.sparse.issparse(first):
+        return scipy.sparse.vstack(outputs, format="csr")
+    return np.concatenate(outputs)
+
+def select_top_k(indices, values, k, order):
+    """ The (indices, values) of the k best values on the last axis, ranked like the top_k SHAP values of _cext.
+
+    order is 0 to rank by decreasing absolute value, 1 by decreasing value and -1 by increasing value, and ties
+    go to the lower index.
+    """
+    key = -np.abs(values) if order == 0 else -order * values
+    indices = np.broadcast_to(indices, values.shape)
+    best = np.lexsort((indices, key), axis=-1)[..., :k]
+    return np.take_along_axis(indices, best, axis=-1), np.take_along_axis(values, best, axis=-1)
+
+def top_k_lists(top_indices, top_values):
+    """ The (order, indices, values) of each ranked list in the top k arrays of TreeExplainer._compute_phi.
+    """
+    if top_indices.ndim == 3:
+        return [(0, top_indices, top_values)]
+    return [(1, top_indices[:, :, 0], top_values[:, :, 0]), (-1, top_indices[:, :, 1], top_values[:, :, 1])]
+
+# the explainer that each process of the process backend of TreeExplainer.shap_values works with
+_worker_explainer = None
+
+def _init_shap_values_worker(explainer_bytes):
+    global _worker_explainer
+    _worker_explainer = pickle.loads(explainer_bytes)
+
+def _shap_values_worker(args):
+    X, y, kwargs = args
+    out = _worker_explainer.shap_values(X, y, n_jobs=1, **kwargs)
+    expected_value = _worker_explainer.expected_value
+    return out, None if callable(expected_value) else expected_value
+
 class TreeExplainer(Explainer):
     """Uses Tree SHAP algorithms to explain the output of ensemble tree models.
 
@@ -75,10 +293,43 @@ class TreeExplainer(Explainer):
         then we explain the log base e of the model loss function, so that the SHAP values sum up to the
         log loss of the model for each sample. This is helpful for breaking down model performance by feature.
         Currently the probability and logloss options are only supported when feature_dependence="independent".
+
+    precision : "float64" (default) or "float32"
+        The floating point precision used by the C extension. "float32" stores the model arrays in single
+        precision and computes the SHAP values in single precision, which halves the memory traffic of the
+        algorithms, lets float32 data be explained without first copying it, and returns float32 SHAP values.
+        The model thresholds are rounded down to the nearest float32 value, so float32 inputs follow exactly
+        the same tree paths they would with the original thresholds.
+
+    summarize_background : bool
+        Only used when feature_perturbation="interventional". If True the background dataset is replaced by
+        an exact weighted summary of it: for model_output="raw" each tree only gets one background row for each
+        group of rows that fall in the same side of every one of its splits, and for other model outputs rows
+        that are indistinguishable to the whole ensemble are merged. The SHAP values do not change, but the
+        runtime then scales with the number of distinct paths through the trees rather than the size of the
+        background dataset, so thousands of background samples can be used.
+
+    max_merged_nodes : None (default) or int
+        Only used when feature_perturbation="global_path_dependent". That algorithm merges all the trees into a
+        single tree built from the background samples and the samples being explained, which has up to two nodes
+        for each of them. With a limit on the number of nodes, the samples are explained in chunks that each get
+        a merged tree of at most max_merged_nodes nodes, so the memory used no longer grows with the number of
+        samples explained. Since the merged tree depends on all the samples it is built from, the SHAP values of a
+        sample depend on the chunk it is explained with: setting max_merged_nodes changes the SHAP values compared
+        to explaining all the samples with one merged tree, and they change with its value (but not with n_jobs).
+        They stay additive, but the credit each feature gets can shift noticeably. Setting it to
+        2 * (len(data) + 1) explains every sample against its own merged tree, which makes its SHAP values
+        independent of the other samples explained. See merged_tree_memory for the memory used.
+
+    n_jobs : int
+        The number of workers used to load the model: LightGBM models are parsed with this many processes (one
+        block of trees at a time), and the background samples are counted in the nodes of the trees with this
+        many threads. Negative values count back from the number of CPUs, so -1 means use all of them.
     """
 
 
-    def __init__(self, model, data = None, model_output="raw", feature_perturbation="interventional", **deprecated_options):
+    def __init__(self, model, data = None, model_output="raw", feature_perturbation="interventional", precision="float64",
+                 summarize_background=False, max_merged_nodes=None, n_jobs=1, **deprecated_options):
 
         # check for deprecated options
         if model_output == "margin":
@@ -112,14 +363,27 @@ class TreeExplainer(Explainer):
         if self.data is None:
             feature_perturbation = "tree_path_dependent"
             warnings.warn("Setting feature_perturbation = \"tree_path_dependent\" because no background data was given.")
-        elif feature_perturbation == "interventional" and self.data.shape[0] > 1000:
+        elif feature_perturbation == "interventional" and self.data.shape[0] > 1000 and not summarize_background:
                 warnings.warn("Passing "+str(self.data.shape[0]) + " background samples may lead to slow runtimes. Consider "
                     "using shap.sample(data, 100) to create a smaller background data set.")
         self.data_missing = None if self.data is None else np.isnan(self.data)
         self.feature_perturbation = feature_perturbation
         self.expected_value = None
-        self.model = TreeEnsemble(model, self.data, self.data_missing, model_output)
+        self.model = TreeEnsemble(model, self.data, self.data_missing, model_output, n_jobs=n_jobs)
+        self.model.set_precision(precision)
+
+        # the background samples need to be in the same format as the samples we explain
+        if self.data is not None and self.data.dtype != self.model.input_dtype:
+            self.data = self.data.astype(self.model.input_dtype)
+        self._background_margins = {}
+        self._background_summary = None
+        if summarize_background and self.data is not None and feature_perturbation == "interventional":
+            self._background_summary = self.model.summarize_background(self.data, self.data_missing)
         self.model_output = model_output
+        self.max_merged_nodes = max_merged_nodes
+        if max_merged_nodes is not None and feature_perturbation == "global_path_dependent":
+            assert max_merged_nodes >= 2 * (self.data.shape[0] + 1), "max_merged_nodes must be at least twice " \
+                "the number of background samples plus one, since they are part of every merged tree!"
         #self.model_output = self.model.model_output # this allows the TreeEnsemble to translate model outputs types by how it loads the model
         
         if feature_perturbation not in feature_perturbation_codes:
@@ -131,6 +395,9 @@ class TreeExplainer(Explainer):
                 raise ValueError("Only model_output=\"raw\" is supported for feature_perturbation=\"tree_path_dependent\"")
         elif data is None:
             raise ValueError("A background dataset must be provided unless you are using feature_perturbation=\"tree_path_dependent\"!")
+        elif self.model.trees is None:
+            raise SHAPError("This model could not be parsed into the internal tree format, so it can only be explained " \
+                            "with feature_perturbation=\"tree_path_dependent\" and no background data!")
 
         if self.model.model_output != "raw":
             if self.model.objective is None and self.model.tree_output is None:
@@ -167,19 +434,93 @@ class TreeExplainer(Explainer):
         if self.model.model_output == "probability_doubled" and self.expected_value is not None:
             self.expected_value = [1-self.expected_value, self.expected_value]
 
+    def save(self, path):
+        """ Save the explainer to a file that TreeExplainer.load can memory map.
+
+        The dense tree arrays, the background data (and its summary) and the expected value are stored in a
+        versioned binary format along with the metadata needed to explain the model. The original model object
+        is not stored, so a loaded explainer always runs the internal Tree SHAP algorithms.
+        """
+        if not hasattr(self.model, "values"):
+            raise SHAPError("Only models that are parsed into the internal tree format can be saved!")
+
+        metadata = {
+            "feature_perturbation": self.feature_perturbation,
+            "model_output": self.model_output,
+            "max_merged_nodes": self.max_merged_nodes,
+            "model": self.model.get_save_metadata()
+        }
+        arrays = {"model." + name: arr for name, arr in self.model.get_save_arrays().items()}
+        if self.data is not None:
+            arrays["data"] = self.data
+            arrays["data_missing"] = self.data_missing
+        if self._background_summary is not None:
+            for i, arr in enumerate(self._background_summary):
+                if arr is not None:
+                    arrays["background_summary.%d" % i] = arr
+
+        # the expected value is a scalar, a list (one per output) or computed from the labels (for the log loss),
+        # and the one XGBoost, LightGBM or CatBoost reported for their own outputs is recomputed after loading
+        native_expected_value = self.model.model_type != "internal" and self.data is None \
+            and self.feature_perturbation == "tree_path_dependent"
+        if self.expected_value is None or callable(self.expected_value) or native_expected_value:
+            metadata["expected_value_type"] = "dynamic" if callable(self.expected_value) else "none"
+        else:
+            metadata["expected_value_type"] = "list" if isinstance(self.expected_value, list) else "array"
+            arrays["expected_value"] = np.asarray(self.expected_value)
+
+        write_array_file(path, metadata, arrays)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Load an explainer written by TreeExplainer.save.
+
+        With mmap=True (the default) the tree arrays and background data are read-only memory maps of the file,
+        so loading takes milliseconds and every process that loads the same file shares one copy of the model.
+        """
+        metadata, arrays = read_array_file(path, mmap=mmap)
+
+        explainer = cls.__new__(cls)
+        explainer.feature_perturbation = metadata["feature_perturbation"]
+        explainer.model_output = metadata["model_output"]
+        explainer.max_merged_nodes = metadata.get("max_merged_nodes", None)
+        explainer.model = TreeEnsemble.from_saved(
+            metadata["model"], {k[len("model."):]: v for k, v in arrays.items() if k.startswith("model.")}
+        )
+        explainer.data = arrays.get("data", None)
+        explainer.data_missing = arrays.get("data_missing", None)
+        explainer._background_margins = {}
+        explainer._background_summary = None
+        if any(k.startswith("background_summary.") for k in arrays):
+            explainer._background_summary = tuple(arrays.get("background_summary.%d" % i, None) for i in range(6))
+
+        expected_value_type = metadata["expected_value_type"]
+        if expected_value_type == "dynamic":
+            explainer.expected_value = explainer.__dynamic_expected_value
+        elif expected_value_type == "none":
+            explainer.expected_value = None
+        elif expected_value_type == "list":
+            explainer.expected_value = list(np.array(arrays["expected_value"]))
+        else:
+            explainer.expected_value = np.array(arrays["expected_value"])[()]
+        return explainer
+
     def __dynamic_expected_value(self, y):
         """ This computes the expected value conditioned on the given label value.
         """
 
         return self.model.predict(self.data, np.ones(self.data.shape[0]) * y).mean(0)
 
-    def shap_values(self, X, y=None, tree_limit=None, approximate=False, check_additivity=True):
+    def shap_values(self, X, y=None, tree_limit=None, approximate=False, check_additivity=True, n_jobs=1,
+                    output_format="dense", top_k=None, top_k_mode="abs", backend="thread", parallel_over="samples"):
         """ Estimate the SHAP values for a set of samples.
 
         Parameters
         ----------
-        X : numpy.array, pandas.DataFrame or catboost.Pool (for catboost)
-            A matrix of samples (# samples x # features) on which to explain the model's output.
+        X : numpy.array, pandas.DataFrame, scipy.sparse matrix or catboost.Pool (for catboost)
+            A matrix of samples (# samples x # features) on which to explain the model's output. Sparse
+            matrices are explained one row at a time without being densified, and the entries they leave out
+            are treated as zeros (or as missing values for XGBoost models, which read sparse data that way).
 
         y : numpy.array
             An array of label values for each sample. Used when explaining loss functions.
@@ -199,6 +540,48 @@ class TreeExplainer(Explainer):
             check takes only a small amount of time, and will catch potential unforeseen errors.
             Note that this check only runs right now when explaining the margin of the model.
 
+        n_jobs : int
+            The number of native threads used to explain the samples in X. Each thread works on its own
+            block of samples, and the GIL is released while they run so other Python threads can continue.
+            Negative values count back from the number of CPUs, so -1 means use all of them.
+
+        output_format : "dense" (default) or "csr"
+            With "csr" the SHAP values are returned as scipy.sparse.csr_matrix objects, and the C extension
+            only collects the values of the features the trees actually split on (every other feature has
+            a SHAP value of zero). This keeps the memory use proportional to the number of used features
+            rather than the number of columns in X, which matters for very wide inputs. With
+            feature_perturbation="global_path_dependent" the dense SHAP values are still built first, since
+            that algorithm explains the samples together.
+
+        top_k : None (default) or int
+            Only return the top_k features with the largest absolute SHAP values in each sample. The C
+            extension keeps them in a small heap for each sample, so the full matrix of SHAP values is never
+            built (except with feature_perturbation="global_path_dependent", which explains the samples
+            together). The result for each output is then an (indices, values) tuple of (# samples x top_k)
+            arrays, sorted by decreasing absolute value. The additivity check is skipped in this mode.
+
+        top_k_mode : "abs" (default) or "signed"
+            How the top_k features are ranked. "abs" ranks them by absolute SHAP value, so a sample with large
+            positive SHAP values may not get any of its negative ones. "signed" instead returns a (largest,
+            smallest) pair for each output, where largest holds the (indices, values) of the top_k largest SHAP
+            values in decreasing order and smallest those of the top_k smallest in increasing order, i.e. the
+            features that push the output up and down the most (when a sample has fewer than top_k positive or
+            negative SHAP values, the rest of the list holds the next values, which can be zero or of the other sign).
+
+        backend : "thread" (default) or "process"
+            With "process" the rows of X are split between n_jobs worker processes instead of native threads.
+            The tree arrays and the background data are copied into shared memory for the call (see
+            share_memory), so the workers attach to them rather than each receiving a copy of them, and the
+            blocks are unlinked once the workers are done. The explainer itself is left as it is, so calling
+            share_memory first keeps its arrays shared across calls instead.
+
+        parallel_over : "samples" (default) or "trees"
+            What the n_jobs threads split between them. Splitting the samples does nothing for a single sample,
+            so with "trees" every thread instead explains all the samples with its own block of trees, adding
+            the SHAP values to its own copy of the output, and the copies are summed at the end. This cuts the
+            time it takes to explain one sample with a large ensemble. It is only supported for dense SHAP
+            values with feature_perturbation="tree_path_dependent" and the thread backend.
+
         Returns
         -------
         For models with a single output this returns a matrix of SHAP values
@@ -207,6 +590,23 @@ class TreeExplainer(Explainer):
         attribute of the explainer when it is constant). For models with vector outputs this returns
         a list of such matrices, one for each output.
         """
+        assert output_format in ("dense", "csr"), "output_format must be \"dense\" or \"csr\"!"
+        assert top_k is None or output_format == "dense", "top_k can not be combined with output_format=\"csr\"!"
+        assert top_k is None or top_k > 0, "top_k must be a positive number of features!"
+        assert top_k_mode in ("abs", "signed"), "top_k_mode must be \"abs\" or \"signed\"!"
+        assert backend in ("thread", "process"), "backend must be \"thread\" or \"process\"!"
+        if backend == "process":
+            assert_shared_memory()
+        assert parallel_over in ("samples", "trees"), "parallel_over must be \"samples\" or \"trees\"!"
+        assert parallel_over == "samples" or (
+            self.feature_perturbation == "tree_path_dependent" and backend == "thread" and output_format == "dense"
+            and top_k is None and not approximate and not scipy.sparse.issparse(X)
+        ), "parallel_over=\"trees\" is only supported for the dense SHAP values of feature_perturbation=" \
+           "\"tree_path_dependent\" with the thread backend!"
+        if backend == "process" and get_num_threads(n_jobs) > 1 and len(getattr(X, "shape", ())) == 2 and X.shape[0] > 1:
+            return self._shap_values_processes(
+                X, y, tree_limit, approximate, check_additivity, n_jobs, output_format, top_k, top_k_mode
+            )
         if check_additivity and self.model.model_type == "pyspark":
             warnings.warn("check_additivity requires us to run predictions which is not supported with spark, ignoring." 
                           " Set check_additivity=False to remove this warning")
@@ -217,7 +617,11 @@ class TreeExplainer(Explainer):
             tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
 
         # shortcut using the C++ version of Tree SHAP in XGBoost, LightGBM, and CatBoost
-        if self.feature_perturbation == "tree_path_dependent" and self.model.model_type != "internal" and self.data is None:
+        # (LightGBM can't explain its linear trees itself, none of them split the trees between threads, and they
+        # don't know about node weights from update_background_weights or the trees left by optimize)
+        if self.feature_perturbation == "tree_path_dependent" and self.model.model_type != "internal" and self.data is None \
+                and output_format == "dense" and top_k is None and self.model.linear_models is None \
+                and parallel_over == "samples" and not self.model.custom_weights and self.model.used_features is None:
             model_output_vals = None
             phi = None
             if self.model.model_type == "xgboost":
@@ -277,20 +681,30 @@ class TreeExplainer(Explainer):
 
                 return out
 
-        # convert dataframes
+        # convert dataframes (sparse matrices are read directly by the C extension)
         if safe_isinstance(X, "pandas.core.series.Series"):
             X = X.values
         elif safe_isinstance(X, "pandas.core.frame.DataFrame"):
             X = X.values
         flat_output = False
-        if len(X.shape) == 1:
-            flat_output = True
-            X = X.reshape(1, X.shape[0])
-        if X.dtype != self.model.input_dtype:
-            X = X.astype(self.model.input_dtype)
-        X_missing = np.isnan(X, dtype=np.bool)
-        assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
-        assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
+        X_missing = None
+        assert self.feature_perturbation != "global_path_dependent" or self.model.linear_models is None, \
+            "feature_perturbation = \"global_path_dependent\" is not supported for trees with linear leaves!"
+        assert self.feature_perturbation == "interventional" or self.model.linear_models is None \
+            or not np.any(np.diff(self.model.linear_offsets) > 1), "Trees with linear leaves that use more than one " \
+            "feature can only be explained with feature_perturbation = \"interventional\"!"
+        if scipy.sparse.issparse(X):
+            assert self.feature_perturbation != "global_path_dependent", "feature_perturbation = \"global_path_dependent\" is not supported for sparse inputs!"
+            X = self.model.format_sparse(X)
+        else:
+            if len(X.shape) == 1:
+                flat_output = True
+                X = X.reshape(1, X.shape[0])
+            if X.dtype != self.model.input_dtype:
+                X = X.astype(self.model.input_dtype)
+            X_missing = np.isnan(X, dtype=np.bool)
+            assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
+            assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
 
         if tree_limit < 0 or tree_limit > self.model.values.shape[0]:
             tree_limit = self.model.values.shape[0]
@@ -298,7 +712,6 @@ class TreeExplainer(Explainer):
         if self.model.model_output == "log_loss":
             assert y is not None, "Both samples and labels must be provided when model_output = \"log_loss\" (i.e. `explainer.shap_values(X, y)`)!"
             assert X.shape[0] == len(y), "The number of labels (%d) does not match the number of samples to explain (%d)!" % (len(y), X.shape[0])
-        transform = self.model.get_transform()
 
         if self.feature_perturbation == "tree_path_dependent":
             assert self.model.fully_defined_weighting, "The background dataset you provided does not cover all the leaves in the model, " \
@@ -306,23 +719,393 @@ class TreeExplainer(Explainer):
                                                        "Try providing a larger background dataset, or using feature_perturbation=\"interventional\"."
 
         # run the core algorithm using the C extension
-        assert_import("cext")
-        phi = np.zeros((X.shape[0], X.shape[1]+1, self.model.num_outputs))
-        if not approximate:
-            _cext.dense_tree_shap(
-                self.model.children_left, self.model.children_right, self.model.children_default,
-                self.model.features, self.model.thresholds, self.model.values, self.model.node_sample_weight,
-                self.model.max_depth, X, X_missing, y, self.data, self.data_missing, tree_limit,
-                self.model.base_offset, phi, feature_perturbation_codes[self.feature_perturbation],
-                output_transform_codes[transform], False
+        if output_format == "csr":
+            contribs = self._compute_phi(X, X_missing, y, tree_limit, approximate, n_jobs, None)
+            out = self._get_sparse_shap_output(contribs, X.shape[0], X.shape[1])
+        elif top_k is not None:
+            top_k = min(top_k, X.shape[1])
+            top_shape = (X.shape[0], self.model.num_outputs) + ((2,) if top_k_mode == "signed" else ()) + (top_k,)
+            top_indices = np.zeros(top_shape, dtype=np.int32)
+            top_values = np.zeros(top_shape, dtype=self.model.internal_dtype)
+            self._compute_phi(X, X_missing, y, tree_limit, approximate, n_jobs, None, (top_indices, top_values))
+
+            # the expected value comes from the full SHAP values of the first sample
+            if self.expected_value is None and self.model.model_output != "log_loss":
+                phi = np.zeros((1, X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype)
+                self._compute_phi(
+                    X[:1], None if X_missing is None else X_missing[:1], None if y is None else y[:1],
+                    tree_limit, approximate, n_jobs, phi
+                )
+                self._get_shap_output(phi, True)
+
+            row = 0 if flat_output else slice(None)
+            if top_k_mode == "signed":
+                out = [
+                    ((top_indices[row, i, 0], top_values[row, i, 0]), (top_indices[row, i, 1], top_values[row, i, 1]))
+                    for i in range(self.model.num_outputs)
+                ]
+                if self.model.model_output == "probability_doubled":
+                    (largest_indices, largest), (smallest_indices, smallest) = out[0]
+                    return [((smallest_indices, -smallest), (largest_indices, -largest)), out[0]]
+            else:
+                out = [(top_indices[row, i], top_values[row, i]) for i in range(self.model.num_outputs)]
+                if self.model.model_output == "probability_doubled":
+                    return [(out[0][0], -out[0][1]), out[0]]
+            return out[0] if self.model.num_outputs == 1 else out
+        else:
+            phi = np.zeros((X.shape[0], X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype)
+            self._compute_phi(X, X_missing, y, tree_limit, approximate, n_jobs, phi, parallel_over=parallel_over)
+            out = self._get_shap_output(phi, flat_output)
+
+        if check_additivity and self.model.model_output == "raw":
+            self.assert_additivity(out, self.model.predict(X, n_jobs=n_jobs))
+
+        # if our output format requires binary classificaiton to be represented as two outputs then we do that here
+        if self.model.model_output == "probability_doubled":
+            out = [-out, out]
+
+        return out
+
+    def _shap_values_processes(self, X, y, tree_limit, approximate, check_additivity, n_jobs, output_format, top_k,
+                               top_k_mode):
+        """ Explain blocks of the rows of X in separate processes that share this explainer's memory.
+        """
+        assert self.model.model_type != "pyspark", "backend=\"process\" is not supported for pyspark models!"
+        if safe_isinstance(X, "pandas.core.series.Series") or safe_isinstance(X, "pandas.core.frame.DataFrame"):
+            X = X.values
+        elif scipy.sparse.issparse(X):
+            X = X.tocsr()
+        assert isinstance(X, np.ndarray) or scipy.sparse.issparse(X), \
+            "backend=\"process\" only supports numpy arrays, pandas objects and scipy.sparse matrices!"
+
+        # the workers attach to a shared memory copy of this explainer made for the call (arrays that share_memory
+        # already put in shared memory are used as they are, and only the blocks made here are unlinked after)
+        shared = copy.copy(self)
+        shared.model = copy.copy(self.model)
+        shared.share_memory()
+        kept_blocks = shared_array_blocks(self) + shared_array_blocks(self.model)
+        call_blocks = [
+            block for block in shared_array_blocks(shared) + shared_array_blocks(shared.model)
+            if not any(block is kept for kept in kept_blocks)
+        ]
+        try:
+            explainer_bytes = pickle.dumps(shared, protocol=pickle.HIGHEST_PROTOCOL)
+            kwargs = {
+                "tree_limit": tree_limit, "approximate": approximate, "check_additivity": check_additivity,
+                "output_format": output_format, "top_k": top_k, "top_k_mode": top_k_mode
+            }
+            num_processes = min(get_num_threads(n_jobs), X.shape[0])
+            bounds = np.linspace(0, X.shape[0], num_processes + 1).astype(int)
+            blocks = [
+                (X[start:end], None if y is None else y[start:end], kwargs)
+                for start, end in zip(bounds[:-1], bounds[1:])
+            ]
+            with multiprocessing.Pool(num_processes, _init_shap_values_worker, (explainer_bytes,)) as pool:
+                results = pool.map(_shap_values_worker, blocks)
+        finally:
+            for block in call_blocks:
+                block.unlink()
+
+        if self.expected_value is None:
+            self.expected_value = results[0][1]
+        return concatenate_shap_outputs([out for out, _ in results])
+
+    def update_background_weights(self, data, n_jobs=1):
+        """ Fold a new batch of reference data into the node weights used by the tree_path_dependent algorithm.
+
+        The samples in data are counted in every node of the trees and added to the current weights (see
+        TreeEnsemble.update_weights), so calibrating on a large reference set can be done one batch at a time.
+        The expected value is then recomputed on the next call to shap_values. The background data used by the
+        interventional algorithm is left as it is. XGBoost, LightGBM and CatBoost models are explained with the
+        internal Tree SHAP algorithm from then on, since their own implementations only see their own weights.
+        """
+        if safe_isinstance(data, "pandas.core.frame.DataFrame"):
+            data = data.values
+        self.model.update_weights(data, n_jobs=n_jobs)
+        if self.model.model_output != "log_loss":
+            self.expected_value = None
+
+    def optimize(self):
+        """ Simplify the trees before explaining with them, without changing the SHAP values.
+
+        Redundant splits, single leaf trees, duplicate trees and the features no tree uses are removed (see
+        TreeEnsemble.optimize), so the C extension traverses fewer nodes and explains fewer columns. Afterwards
+        a tree_limit passed to shap_values counts the trees that are left.
+        """
+        self.model.optimize()
+        self._background_margins = {}
+        if self._background_summary is not None:
+            self._background_summary = self.model.summarize_background(self.data, self.data_missing)
+
+    def share_memory(self):
+        """ Move the tree arrays and the background data into shared memory.
+
+        Once shared, pickling the explainer (for example to send it to a multiprocessing worker) only stores
+        handles to the shared blocks, and unpickling attaches to them without copying. The blocks are freed
+        once this explainer (and every array taken from it) is garbage collected. This requires Python 3.8+.
+        """
+        assert_shared_memory()
+        self.model.share_memory()
+        self.data = share_array(self.data)
+        self.data_missing = share_array(self.data_missing)
+        if self._background_summary is not None:
+            self._background_summary = tuple(share_array(arr) for arr in self._background_summary)
+
+    def __getstate__(self):
+        state = {name: shared_array_state(value) for name, value in self.__dict__.items()}
+        if callable(self.expected_value):
+            state["expected_value"] = None # bound methods can't be pickled, so __setstate__ binds it again
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update({name: attach_shared_array_state(value) for name, value in state.items()})
+        if self.model.model_output == "log_loss":
+            self.expected_value = self.__dynamic_expected_value
+
+    def iter_shap_values(self, X, y=None, tree_limit=None, approximate=False, check_additivity=True, n_jobs=1,
+                         chunk_size=10000):
+        """ Estimate the SHAP values for a set of samples, one block of chunk_size rows at a time.
+
+        This gives the same values as shap_values, but only ever holds the inputs, missing value masks and
+        SHAP values of a single block of rows, so the peak memory use is bounded by chunk_size instead of
+        by the number of samples in X (as long as the yielded results are not kept around). The input
+        buffers are allocated once and reused for every block, while every block gets its own SHAP values.
+
+        With feature_perturbation="global_path_dependent" the SHAP values of a sample depend on the other samples
+        in its merged tree, so the blocks are rounded down to a whole number of the chunks max_merged_nodes
+        allows (at least one), and without max_merged_nodes all the rows must fit in one block.
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            A matrix of samples (# samples x # features) on which to explain the model's output.
+
+        y : numpy.array
+            An array of label values for each sample. Used when explaining loss functions.
+
+        tree_limit, approximate, check_additivity, n_jobs
+            The same as for shap_values (the additivity check is run separately on each block of rows).
+
+        chunk_size : int
+            The number of rows of X that are explained at a time (see above for global_path_dependent).
+
+        Returns
+        -------
+        A generator that yields the output of shap_values for each consecutive block of rows in X.
+        """
+        assert chunk_size > 0, "chunk_size must be a positive number of rows!"
+        num_rows = X.shape[0]
+        if self.feature_perturbation == "global_path_dependent":
+            merged_chunk_size = self._merged_chunk_size(num_rows)
+            assert merged_chunk_size > 0 or chunk_size >= num_rows, "Without max_merged_nodes the " \
+                "global_path_dependent algorithm explains all the rows with one merged tree, so they can't be split " \
+                "into blocks! Set max_merged_nodes or pass a chunk_size of at least len(X)."
+            if merged_chunk_size > 0:
+                chunk_size = max(chunk_size // merged_chunk_size, 1) * merged_chunk_size
+
+        # see if we have a default tree_limit in place.
+        if tree_limit is None:
+            tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
+
+        # models explained by their own C++ implementation allocate their own outputs, so we just slice X
+        if self.feature_perturbation == "tree_path_dependent" and self.model.model_type != "internal" and self.data is None \
+                and not self.model.custom_weights and self.model.used_features is None:
+            for start in range(0, num_rows, chunk_size):
+                end = min(start + chunk_size, num_rows)
+                X_chunk = X.iloc[start:end] if safe_isinstance(X, "pandas.core.frame.DataFrame") else X[start:end]
+                yield self.shap_values(
+                    X_chunk, None if y is None else y[start:end], tree_limit=tree_limit, approximate=approximate,
+                    check_additivity=check_additivity, n_jobs=n_jobs
+                )
+            return
+
+        assert len(X.shape) == 2, "Passed input data matrix X must have 2 dimensions!"
+        if tree_limit < 0 or tree_limit > self.model.values.shape[0]:
+            tree_limit = self.model.values.shape[0]
+        if self.model.model_output == "log_loss":
+            assert y is not None, "Both samples and labels must be provided when model_output = \"log_loss\" (i.e. `explainer.iter_shap_values(X, y)`)!"
+            assert num_rows == len(y), "The number of labels (%d) does not match the number of samples to explain (%d)!" % (len(y), num_rows)
+        if self.feature_perturbation == "tree_path_dependent":
+            assert self.model.fully_defined_weighting, "The background dataset you provided does not cover all the leaves in the model, " \
+                                                       "so TreeExplainer cannot run with the feature_perturbation=\"tree_path_dependent\" option! " \
+                                                       "Try providing a larger background dataset, or using feature_perturbation=\"interventional\"."
+
+        # allocate the buffers that every block of rows is read into
+        buffer_rows = min(chunk_size, num_rows)
+        X_buffer = np.empty((buffer_rows, X.shape[1]), dtype=self.model.input_dtype)
+        X_missing_buffer = np.empty((buffer_rows, X.shape[1]), dtype=bool)
+
+        for start in range(0, num_rows, chunk_size):
+            end = min(start + chunk_size, num_rows)
+            if safe_isinstance(X, "pandas.core.frame.DataFrame"):
+                X_chunk = X.iloc[start:end].values
+            else:
+                X_chunk = X[start:end]
+
+            # rows that are already in the right format are used in place, everything else is copied into the buffer
+            if X_chunk.dtype != self.model.input_dtype or not X_chunk.flags.c_contiguous:
+                np.copyto(X_buffer[:end-start], X_chunk, casting="unsafe")
+                X_chunk = X_buffer[:end-start]
+            X_missing = np.isnan(X_chunk, out=X_missing_buffer[:end-start])
+            phi = np.zeros((end-start, X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype)
+
+            self._compute_phi(X_chunk, X_missing, None if y is None else y[start:end], tree_limit, approximate, n_jobs, phi)
+            out = self._get_shap_output(phi, False)
+
+            if check_additivity and self.model.model_output == "raw":
+                self.assert_additivity(out, self.model.predict(X_chunk, n_jobs=n_jobs))
+
+            # if our output format requires binary classificaiton to be represented as two outputs then we do that here
+            if self.model.model_output == "probability_doubled":
+                out = [-out, out]
+
+            yield out
+
+    def _compute_phi(self, X, X_missing, y, tree_limit, approximate, n_jobs, phi, top=None, parallel_over="samples"):
+        """ Adds the SHAP values of X (with the expected value in the last column) to phi using the C extension.
+
+        X can also be a CSR matrix from TreeEnsemble.format_sparse (with X_missing set to None). When phi is
+        None the nonzero SHAP values are returned as the (indptr, indices, data) arrays of a CSR matrix instead,
+        where column o * (M + 1) + j holds the value of feature j for output o (and j == M is the expected value),
+        unless top holds (indices, values) arrays of shape (# samples x # outputs x k) to write the k largest
+        absolute SHAP values of each sample into (or of shape (# samples x # outputs x 2 x k) for the k largest
+        and the k smallest values, see top_k_lists). parallel_over="trees" splits the trees instead of the samples between
+        the threads (only for dense tree_path_dependent SHAP values).
+
+        When TreeEnsemble.optimize dropped the features no tree uses, only the columns the trees read are
+        explained, and their SHAP values are then put back in place (the others are zero).
+        """
+        used_features = self.model.used_features
+        if used_features is None:
+            return self._compute_phi_cext(X, X_missing, y, tree_limit, approximate, n_jobs, phi, top, parallel_over)
+        num_features = X.shape[1]
+        X, X_missing = self.model.select_features(X, X_missing)
+        columns = np.append(used_features, num_features) # where the values of the used columns (and the bias) go
+
+        if phi is not None:
+            used_phi = np.zeros((phi.shape[0], len(columns), phi.shape[2]), dtype=phi.dtype)
+            self._compute_phi_cext(X, X_missing, y, tree_limit, approximate, n_jobs, used_phi, None, parallel_over)
+            phi[:, columns] += used_phi
+        elif top is None:
+            indptr, indices, data = self._compute_phi_cext(X, X_missing, y, tree_limit, approximate, n_jobs, None)
+            outputs, inds = np.divmod(indices, len(columns))
+            return indptr, (outputs * (num_features + 1) + columns[inds]).astype(indices.dtype), data
+        else:
+            top_indices, top_values = top
+            k = top_indices.shape[-1]
+            used_k = min(k, len(used_features))
+            used_indices = np.zeros(top_indices.shape[:-1] + (used_k,), dtype=top_indices.dtype)
+            used_values = np.zeros(top_values.shape[:-1] + (used_k,), dtype=top_values.dtype)
+            if used_k > 0:
+                self._compute_phi_cext(X, X_missing, y, tree_limit, approximate, n_jobs, None, (used_indices, used_values))
+
+            # the unused features have SHAP values of zero, so only the first k of them can make it
+            unused = np.setdiff1d(np.arange(num_features), used_features)[:k]
+            used_lists = top_k_lists(used_indices, used_values)
+            for (order, indices, values), (_, list_indices, list_values) in zip(top_k_lists(*top), used_lists):
+                shape = values.shape[:2]
+                indices[:], values[:] = select_top_k(
+                    np.concatenate([used_features[list_indices], np.broadcast_to(unused, shape + unused.shape)], axis=2),
+                    np.concatenate([list_values, np.zeros(shape + unused.shape, dtype=values.dtype)], axis=2),
+                    k, order
+                )
+
+    def _compute_phi_cext(self, X, X_missing, y, tree_limit, approximate, n_jobs, phi, top=None, parallel_over="samples"):
+        """ Runs the C extension for _compute_phi (X only holds the columns the trees read).
+        """
+
+        # global_path_dependent explains each chunk of rows with its own merged tree, and collecting the nonzero
+        # or top k values explains the rows one at a time, so we collect them from the dense values instead
+        if self.feature_perturbation == "global_path_dependent" and phi is None:
+            dense_phi = np.zeros((X.shape[0], X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype)
+            self._compute_phi_cext(X, X_missing, y, tree_limit, approximate, n_jobs, dense_phi)
+            if top is None:
+                contribs = scipy.sparse.csr_matrix(dense_phi.transpose(0, 2, 1).reshape(X.shape[0], -1))
+                return contribs.indptr, contribs.indices, contribs.data
+            values = dense_phi[:, :-1].transpose(0, 2, 1)
+            for order, top_indices, top_values in top_k_lists(*top):
+                top_indices[:], top_values[:] = select_top_k(np.arange(X.shape[1]), values, top_indices.shape[2], order)
+            return
+
+        top_indices, top_values = (None, None) if top is None else top
+        transform = self.model.get_transform()
+        if self._background_summary is not None:
+            R, R_missing, R_weights, R_tree_offsets, R_tree_rows, R_tree_weights = self._background_summary
+        else:
+            R, R_missing = self.model.select_features(self.data, self.data_missing)
+            R_weights, R_tree_offsets, R_tree_rows, R_tree_weights = None, None, None, None
+        R_margins = None
+        if not approximate and self.feature_perturbation == "interventional" and transform != "identity":
+            R_margins = self._get_background_margins(R, R_missing, tree_limit)
+
+        if scipy.sparse.issparse(X):
+            return _cext.sparse_tree_shap(
+                self.model.get_packed_trees(), X.indptr, X.indices, X.data, X.shape[1], self.model.sparse_missing,
+                y, R, R_missing, tree_limit, phi, feature_perturbation_codes[self.feature_perturbation],
+                output_transform_codes[transform], approximate, get_num_threads(n_jobs),
+                R_weights, R_tree_offsets, R_tree_rows, R_tree_weights, R_margins, top_indices, top_values
+            )
+        elif not approximate or phi is None:
+            return _cext.dense_tree_shap_packed(
+                self.model.get_packed_trees(), X, X_missing, y, R, R_missing, tree_limit, phi,
+                feature_perturbation_codes[self.feature_perturbation], output_transform_codes[transform],
+                False, get_num_threads(n_jobs), R_weights, R_tree_offsets, R_tree_rows, R_tree_weights, R_margins,
+                approximate, top_indices, top_values, self._merged_chunk_size(X.shape[0]), parallel_over == "trees"
             )
         else:
-            _cext.dense_tree_saabas(
-                self.model.children_left, self.model.children_right, self.model.children_default,
-                self.model.features, self.model.thresholds, self.model.values,
-                self.model.max_depth, tree_limit, self.model.base_offset, output_transform_codes[transform],
-                X, X_missing, y, phi
+            _cext.dense_tree_saabas_packed(
+                self.model.get_packed_trees(), tree_limit, output_transform_codes[transform],
+                X, X_missing, y, phi, get_num_threads(n_jobs)
+            )
+
+    def _merged_chunk_size(self, num_rows):
+        """ The number of samples explained with each merged tree by the global_path_dependent algorithm (0 for all).
+
+        This only depends on max_merged_nodes and not on the number of threads, since the chunks change the SHAP values.
+        """
+        if self.feature_perturbation != "global_path_dependent" or self.max_merged_nodes is None:
+            return 0
+        chunk_size = self.max_merged_nodes // 2 - self.data.shape[0]
+        return 0 if chunk_size >= num_rows else chunk_size
+
+    def merged_tree_memory(self, num_rows, n_jobs=1):
+        """ The number of bytes the global_path_dependent algorithm allocates to explain num_rows samples.
+
+        This covers the merged trees (every thread that builds one has its own) along with the copies of the
+        samples and the background data they are built from, which is most of the memory the algorithm uses.
+        """
+        chunk_size = self._merged_chunk_size(num_rows)
+        num_chunks = 1 if chunk_size == 0 else -(-num_rows // chunk_size)
+        chunk_rows = num_rows if num_chunks == 1 else chunk_size
+        num_samples = chunk_rows + self.data.shape[0]
+
+        float_size = np.dtype(self.model.internal_dtype).itemsize
+        node_size = 4 * 4 + (2 + self.model.num_outputs) * float_size
+        if self.model.category_sets is not None:
+            node_size += 4
+        sample_size = self.data.shape[1] * (float_size + 1) + 4
+        chunk_memory = 2 * num_samples * node_size + num_samples * sample_size
+        return min(num_chunks, get_num_threads(n_jobs)) * chunk_memory
+
+    def _get_background_margins(self, R, R_missing, tree_limit):
+        """ The raw model outputs of the background rows, computed once per tree_limit and then reused.
+
+        The interventional algorithm needs the margin of every background row to rescale the SHAP values
+        of transformed model outputs, so caching them saves a pass through all the trees for every
+        background row each time an explanation is computed.
+        """
+        if tree_limit not in self._background_margins:
+            margins = np.zeros((R.shape[0], self.model.num_outputs), dtype=self.model.internal_dtype)
+            _cext.dense_tree_predict_packed(
+                self.model.get_packed_trees(), tree_limit, output_transform_codes["identity"],
+                R, R_missing, None, margins
             )
+            self._background_margins[tree_limit] = margins
+        return self._background_margins[tree_limit]
+
+    def _get_shap_output(self, phi, flat_output):
+        """ Splits the phi array from the C extension into the SHAP values we return and the expected value.
+        """
 
         # note we pull off the last column and keep it as our expected_value
         if self.model.num_outputs == 1:
@@ -340,16 +1123,26 @@ class TreeExplainer(Explainer):
             else:
                 out = [phi[:, :-1, i] for i in range(self.model.num_outputs)]
 
-        if check_additivity and self.model.model_output == "raw":
-            self.assert_additivity(out, self.model.predict(X))
+        return out
 
-        # if our output format requires binary classificaiton to be represented as two outputs then we do that here
-        if self.model.model_output == "probability_doubled":
-            out = [-out, out]
+    def _get_sparse_shap_output(self, contribs, num_rows, num_features):
+        """ Splits the CSR arrays returned by _compute_phi into sparse SHAP values and the expected value.
+        """
+        indptr, indices, data = contribs
+        phi = scipy.sparse.csr_matrix(
+            (data, indices, indptr), shape=(num_rows, (num_features + 1) * self.model.num_outputs)
+        )
+        blocks = [phi[:, i*(num_features+1):(i+1)*(num_features+1)] for i in range(self.model.num_outputs)]
 
-        return out
+        # note we pull off the last column and keep it as our expected_value
+        if self.expected_value is None and self.model.model_output != "log_loss":
+            expected_value = [block[0, -1] for block in blocks]
+            self.expected_value = expected_value[0] if self.model.num_outputs == 1 else expected_value
+        out = [block[:, :-1] for block in blocks]
+
+        return out[0] if self.model.num_outputs == 1 else out
 
-    def shap_interaction_values(self, X, y=None, tree_limit=None):
+    def shap_interaction_values(self, X, y=None, tree_limit=None, n_jobs=1, algorithm="on_off"):
         """ Estimate the SHAP interaction values for a set of samples.
 
         Parameters
@@ -364,6 +1157,17 @@ class TreeExplainer(Explainer):
             Limit the number of trees used by the model. By default None means no use the limit of the
             original model, and -1 means no limit.
 
+        n_jobs : int
+            The number of native threads used to explain the samples in X. Each thread works on its own
+            block of samples, and the GIL is released while they run so other Python threads can continue.
+            Negative values count back from the number of CPUs, so -1 means use all of them.
+
+        algorithm : "on_off" (default) or "fast"
+            How the C extension computes the interaction values. "on_off" reruns Tree SHAP with each unique
+            feature of a tree conditioned on and off. "fast" makes a single pass over each tree and reuses the
+            shared path state for all the conditioned features, which gives the same values (up to floating
+            point error) and is much faster for deep trees.
+
         Returns
         -------
         For models with a single output this returns a tensor of SHAP values
@@ -378,6 +1182,8 @@ class TreeExplainer(Explainer):
 
         assert self.model.model_output == "raw", "Only model_output = \"raw\" is supported for SHAP interaction values right now!"
         assert self.feature_perturbation == "tree_path_dependent", "Only feature_perturbation = \"tree_path_dependent\" is supported for SHAP interaction values right now!"
+        assert algorithm in interaction_algorithm_codes, "Unknown interaction algorithm: %s" % algorithm
+        assert self.model.linear_models is None, "SHAP interaction values are not supported for trees with linear leaves yet!"
         transform = "identity"
 
         # see if we have a default tree_limit in place.
@@ -385,7 +1191,7 @@ class TreeExplainer(Explainer):
             tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
 
         # shortcut using the C++ version of Tree SHAP in XGBoost
-        if self.model.model_type == "xgboost":
+        if self.model.model_type == "xgboost" and not self.model.custom_weights and self.model.used_features is None:
             import xgboost
             if not isinstance(X, xgboost.core.DMatrix):
                 X = xgboost.DMatrix(X)
@@ -419,16 +1225,21 @@ class TreeExplainer(Explainer):
         if tree_limit < 0 or tree_limit > self.model.values.shape[0]:
             tree_limit = self.model.values.shape[0]
 
-        # run the core algorithm using the C extension
-        assert_import("cext")
-        phi = np.zeros((X.shape[0], X.shape[1]+1, X.shape[1]+1, self.model.num_outputs))
-        _cext.dense_tree_shap(
-            self.model.children_left, self.model.children_right, self.model.children_default,
-            self.model.features, self.model.thresholds, self.model.values, self.model.node_sample_weight,
-            self.model.max_depth, X, X_missing, y, self.data, self.data_missing, tree_limit,
-            self.model.base_offset, phi, feature_perturbation_codes[self.feature_perturbation],
-            output_transform_codes[transform], True
+        # run the core algorithm using the C extension (on just the columns the trees read, see TreeEnsemble.optimize)
+        phi = np.zeros((X.shape[0], X.shape[1]+1, X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype)
+        used_X, used_X_missing = self.model.select_features(X, X_missing)
+        used_phi = phi if used_X is X else np.zeros(
+            (X.shape[0], used_X.shape[1]+1, used_X.shape[1]+1, self.model.num_outputs), dtype=self.model.internal_dtype
         )
+        R, R_missing = self.model.select_features(self.data, self.data_missing)
+        _cext.dense_tree_shap_packed(
+            self.model.get_packed_trees(), used_X, used_X_missing, y, R, R_missing, tree_limit, used_phi,
+            feature_perturbation_codes[self.feature_perturbation], output_transform_codes[transform],
+            interaction_algorithm_codes[algorithm], get_num_threads(n_jobs)
+        )
+        if used_phi is not phi:
+            columns = np.append(self.model.used_features, X.shape[1])
+            phi[:, columns[:,None], columns] = used_phi
 
         # note we pull off the last column and keep it as our expected_value
         if self.model.num_outputs == 1:
@@ -462,11 +1273,12 @@ class TreeExplainer(Explainer):
                            " you can set check_additivity=False to disable this check." % (sum_val[ind], model_output[ind])
                 raise SHAPError(err_msg)
 
+        # sparse SHAP values sum to a column matrix, so we flatten the sums
         if type(phi) is list:
             for i in range(len(phi)):
-                check_sum(self.expected_value[i] + phi[i].sum(-1), model_output[:,i])
+                check_sum(self.expected_value[i] + np.asarray(phi[i].sum(-1)).ravel(), model_output[:,i])
         else:
-            check_sum(self.expected_value + phi.sum(-1), model_output)
+            check_sum(self.expected_value + np.asarray(phi.sum(-1)).ravel(), model_output)
 
 
 class TreeEnsemble:
@@ -475,7 +1287,7 @@ class TreeEnsemble:
     This object provides a common interface to many different types of models.
     """
 
-    def __init__(self, model, data=None, data_missing=None, model_output=None):
+    def __init__(self, model, data=None, data_missing=None, model_output=None, n_jobs=1):
         self.model_type = "internal"
         self.trees = None
         less_than_or_equal = True
@@ -489,8 +1301,20 @@ class TreeEnsemble:
         self.data_missing = data_missing
         self.fully_defined_weighting = True # does the background dataset land in every leaf (making it valid for the tree_path_dependent method)
         self.tree_limit = None # used for limiting the number of trees we use by default (like from early stopping)
+        self._packed_trees = None # a packed copy of the dense arrays held by the C extension (see get_packed_trees)
         self.num_stacked_models = 1 # If this is greater than 1 it means we have multiple stacked models with the same number of trees in each model (XGBoost multi-output style)
         self.cat_feature_indices = None # If this is set it tells us which features are treated categorically
+        self.sparse_missing = False # are the entries left out of a sparse input missing values (like XGBoost reads them) or zeros
+        self.category_sets = None # the category set of every node when the trees have categorical splits (-1 for numerical splits)
+        self.category_offsets = None # with category_bits these hold the category sets (see pack_category_sets)
+        self.category_bits = None
+        self.linear_models = None # the linear model of every node when the trees have linear leaves (-1 for constant nodes)
+        self.linear_offsets = None # model m has the terms linear_offsets[m]:linear_offsets[m+1] of the arrays below
+        self.linear_features = None
+        self.linear_coefs = None # one coefficient per output for every term
+        self.linear_means = None
+        self.used_features = None # the columns of the input the trees read when optimize dropped the others
+        self.custom_weights = False # were the node weights replaced by update_weights (the original model doesn't see them)
 
         # we use names like keras
         objective_name_map = {
@@ -535,7 +1359,7 @@ class TreeEnsemble:
                 self.tree_output = model["tree_output"]
             if "base_offset" in model:
                 self.base_offset = model["base_offset"]
-            self.trees = [Tree(t, data=data, data_missing=data_missing) for t in model["trees"]]
+            self.trees = [Tree(t) for t in model["trees"]]
         elif type(model) is list and type(model[0]) == Tree: # old-style direct-load format
             self.trees = model
         elif safe_isinstance(model, ["sklearn.ensemble.RandomForestRegressor", "sklearn.ensemble.forest.RandomForestRegressor"]):
@@ -543,7 +1367,7 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.ensemble.IsolationForest", "sklearn.ensemble.iforest.IsolationForest"]):
@@ -556,7 +1380,7 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.ensemble.ExtraTreesRegressor", "sklearn.ensemble.forest.ExtraTreesRegressor"]):
@@ -564,7 +1388,7 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, "skopt.learning.forest.ExtraTreesRegressor"):
@@ -572,19 +1396,19 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.tree.DecisionTreeRegressor", "sklearn.tree.tree.DecisionTreeRegressor"]):
             self.internal_dtype = model.tree_.value.dtype.type
             self.input_dtype = np.float32
-            self.trees = [Tree(model.tree_, data=data, data_missing=data_missing)]
+            self.trees = [Tree(model.tree_)]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.tree.DecisionTreeClassifier", "sklearn.tree.tree.DecisionTreeClassifier"]):
             self.internal_dtype = model.tree_.value.dtype.type
             self.input_dtype = np.float32
-            self.trees = [Tree(model.tree_, normalize=True, data=data, data_missing=data_missing)]
+            self.trees = [Tree(model.tree_, normalize=True)]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif safe_isinstance(model, ["sklearn.ensemble.RandomForestClassifier", "sklearn.ensemble.forest.RandomForestClassifier"]):
@@ -592,7 +1416,7 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif safe_isinstance(model, ["sklearn.ensemble.ExtraTreesClassifier", "sklearn.ensemble.forest.ExtraTreesClassifier"]): # TODO: add unit test for this case
@@ -600,7 +1424,7 @@ class TreeEnsemble:
             self.internal_dtype = model.estimators_[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif safe_isinstance(model, ["sklearn.ensemble.GradientBoostingRegressor", "sklearn.ensemble.gradient_boosting.GradientBoostingRegressor"]):
@@ -616,7 +1440,7 @@ class TreeEnsemble:
             else:
                 assert False, "Unsupported init model type: " + str(type(model.init_))
 
-            self.trees = [Tree(e.tree_, scaling=model.learning_rate, data=data, data_missing=data_missing) for e in model.estimators_[:,0]]
+            self.trees = [Tree(e.tree_, scaling=model.learning_rate) for e in model.estimators_[:,0]]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.ensemble.HistGradientBoostingRegressor"]):
@@ -638,7 +1462,7 @@ class TreeEnsemble:
                     "values": np.array([[n[0]] for n in nodes], dtype=np.float64),
                     "node_sample_weight": np.array([n[1] for n in nodes], dtype=np.float64),
                 }
-                self.trees.append(Tree(tree, data=data, data_missing=data_missing))
+                self.trees.append(Tree(tree))
             self.objective = objective_name_map.get(model.loss, None)
             self.tree_output = "raw_value"
         elif safe_isinstance(model, ["sklearn.ensemble.HistGradientBoostingClassifier"]):
@@ -667,7 +1491,7 @@ class TreeEnsemble:
                         "values": np.array([[n[0]] for n in nodes], dtype=np.float64),
                         "node_sample_weight": np.array([n[1] for n in nodes], dtype=np.float64),
                     }
-                    output_trees[i].append(Tree(tree, data=data, data_missing=data_missing))
+                    output_trees[i].append(Tree(tree))
             self.trees = list(itertools.chain.from_iterable(output_trees))
             self.objective = objective_name_map.get(model.loss, None)
             self.tree_output = "log_odds"
@@ -688,7 +1512,7 @@ class TreeEnsemble:
             else:
                 assert False, "Unsupported init model type: " + str(type(model.init_))
 
-            self.trees = [Tree(e.tree_, scaling=model.learning_rate, data=data, data_missing=data_missing) for e in model.estimators_[:,0]]
+            self.trees = [Tree(e.tree_, scaling=model.learning_rate) for e in model.estimators_[:,0]]
             self.objective = objective_name_map.get(model.criterion, None)
         elif "pyspark.ml" in str(type(model)):
             assert_import("pyspark")
@@ -723,8 +1547,9 @@ class TreeEnsemble:
             import xgboost
             self.original_model = model
             self.model_type = "xgboost"
+            self.sparse_missing = True
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(xgb_loader.name_obj, None)
@@ -735,9 +1560,10 @@ class TreeEnsemble:
             import xgboost
             self.input_dtype = np.float32
             self.model_type = "xgboost"
+            self.sparse_missing = True
             self.original_model = model.get_booster()
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(xgb_loader.name_obj, None)
@@ -754,8 +1580,9 @@ class TreeEnsemble:
             import xgboost
             self.original_model = model.get_booster()
             self.model_type = "xgboost"
+            self.sparse_missing = True
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(xgb_loader.name_obj, None)
@@ -767,8 +1594,9 @@ class TreeEnsemble:
             import xgboost
             self.original_model = model.get_booster()
             self.model_type = "xgboost"
+            self.sparse_missing = True
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             # Note: for ranker, leaving tree_output and objective as None as they
@@ -780,11 +1608,10 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
-            except:
-                self.trees = None # we get here because the cext can't handle categorical splits yet
+                self.trees = LightGBMTreeModelLoader(self.original_model).get_trees(n_jobs=n_jobs)
+            except SHAPError:
+                self.trees = None # we get here when the trees treat zeros as missing, which the cext can't handle
 
             self.objective = objective_name_map.get(model.params.get("objective", "regression"), None)
             self.tree_output = tree_output_name_map.get(model.params.get("objective", "regression"), None)
@@ -793,11 +1620,10 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model.booster_
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
-            except:
-                self.trees = None # we get here because the cext can't handle categorical splits yet
+                self.trees = LightGBMTreeModelLoader(self.original_model).get_trees(n_jobs=n_jobs)
+            except SHAPError:
+                self.trees = None # we get here when the trees treat zeros as missing, which the cext can't handle
             self.objective = objective_name_map.get(model.objective, None)
             self.tree_output = tree_output_name_map.get(model.objective, None)
             if model.objective is None:
@@ -807,22 +1633,20 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model.booster_
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
-            except:
-                self.trees = None # we get here because the cext can't handle categorical splits yet
+                self.trees = LightGBMTreeModelLoader(self.original_model).get_trees(n_jobs=n_jobs)
+            except SHAPError:
+                self.trees = None # we get here when the trees treat zeros as missing, which the cext can't handle
             # Note: for ranker, leaving tree_output and objective as None as they
             # are not implemented in native code yet
         elif safe_isinstance(model, "lightgbm.sklearn.LGBMClassifier"):
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model.booster_
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
-            except:
-                self.trees = None # we get here because the cext can't handle categorical splits yet
+                self.trees = LightGBMTreeModelLoader(self.original_model).get_trees(n_jobs=n_jobs)
+            except SHAPError:
+                self.trees = None # we get here when the trees treat zeros as missing, which the cext can't handle
             self.objective = objective_name_map.get(model.objective, None)
             self.tree_output = tree_output_name_map.get(model.objective, None)
             if model.objective is None:
@@ -840,7 +1664,7 @@ class TreeEnsemble:
             self.input_dtype = np.float32
             try:
                 cb_loader = CatBoostTreeModelLoader(model)
-                self.trees = cb_loader.get_trees(data=data, data_missing=data_missing)
+                self.trees = cb_loader.get_trees()
             except:
                 self.trees = None # we get here because the cext can't handle categorical splits yet
             self.tree_output = "log_odds"
@@ -854,7 +1678,7 @@ class TreeEnsemble:
         elif safe_isinstance(model, "imblearn.ensemble._forest.BalancedRandomForestClassifier"):
             self.input_dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif safe_isinstance(model, "ngboost.ngboost.NGBoost") or safe_isinstance(model, "ngboost.api.NGBRegressor") or safe_isinstance(model, "ngboost.api.NGBClassifier"):
@@ -870,7 +1694,7 @@ class TreeEnsemble:
             self.internal_dtype = shap_trees[0].tree_.value.dtype.type
             self.input_dtype = np.float32
             scaling = - model.learning_rate * np.array(model.scalings) # output is weighted average of trees
-            self.trees = [Tree(e.tree_, scaling=s, data=data, data_missing=data_missing) for e,s in zip(shap_trees,scaling)]
+            self.trees = [Tree(e.tree_, scaling=s) for e,s in zip(shap_trees,scaling)]
             self.objective = objective_name_map.get(shap_trees[0].criterion, None)
             self.tree_output = "raw_value"
             self.base_offset = model.init_params[param_idx]
@@ -894,6 +1718,10 @@ class TreeEnsemble:
             else:
                 self.num_outputs = self.trees[0].values.shape[1]
 
+            # the C extension reads one base offset per output, so a single base offset is shared by all of them
+            if len(self.base_offset) == 1 and self.num_outputs > 1:
+                self.base_offset = np.repeat(self.base_offset, self.num_outputs)
+
             # important to be -1 in unused sections!! This way we can tell which entries are valid.
             self.children_left = -np.ones((num_trees, max_nodes), dtype=np.int32)
             self.children_right = -np.ones((num_trees, max_nodes), dtype=np.int32)
@@ -928,6 +1756,415 @@ class TreeEnsemble:
             self.num_nodes = np.array([len(t.values) for t in self.trees], dtype=np.int32)
             self.max_depth = np.max([t.max_depth for t in self.trees])
 
+            # categorical splits send the categories in their set to the left child (see pack_category_sets)
+            if any(len(t.categories) > 0 for t in self.trees):
+                self.category_sets = -np.ones((num_trees, max_nodes), dtype=np.int32)
+                category_sets = []
+                for i in range(num_trees):
+                    for node, categories in self.trees[i].categories.items():
+                        self.category_sets[i, node] = len(category_sets)
+                        category_sets.append(categories)
+                self.category_offsets, self.category_bits = pack_category_sets(category_sets)
+
+            # linear leaves add a linear model of the features to their values (see Tree.linear_leaves)
+            if any(len(t.linear_leaves) > 0 for t in self.trees):
+                self.linear_models = -np.ones((num_trees, max_nodes), dtype=np.int32)
+                linear_offsets = [0]
+                linear_features, linear_coefs, linear_means = [], [], []
+                for i in range(num_trees):
+                    for node, (features, coefs, means) in self.trees[i].linear_leaves.items():
+                        self.linear_models[i, node] = len(linear_offsets) - 1
+                        linear_offsets.append(linear_offsets[-1] + len(features))
+                        linear_features.append(features)
+                        if self.num_stacked_models > 1:
+                            stack_pos = int(i // (num_trees / self.num_stacked_models))
+                            stacked_coefs = np.zeros((len(features), self.num_outputs))
+                            stacked_coefs[:,stack_pos] = coefs[:,0]
+                            coefs = stacked_coefs
+                        linear_coefs.append(coefs)
+                        linear_means.append(means)
+                self.linear_offsets = np.array(linear_offsets, dtype=np.uint32)
+                self.linear_features = np.concatenate(linear_features).astype(np.int32)
+                self.linear_coefs = np.concatenate(linear_coefs).astype(self.internal_dtype)
+                self.linear_means = np.concatenate(linear_means).astype(self.internal_dtype)
+
+            # re-compute the number of background samples that pass through each node (isolation forest trees
+            # already did this themselves since their values depend on it)
+            if data is not None and data_missing is not None and not isinstance(self.trees[0], IsoTree):
+                self.update_weights(data, data_missing, reset=True, n_jobs=n_jobs)
+
+    def set_precision(self, precision):
+        """ Store the dense tree arrays in the given floating point precision ("float64" or "float32").
+
+        The C extension runs in the precision of the values array, so "float32" halves the memory used
+        by the trees and lets float32 inputs be passed through without a copy. Thresholds are rounded down
+        to the nearest float32 so that x <= threshold still holds for exactly the same float32 values of x.
+        """
+        assert precision in ["float64", "float32"], "Unknown precision: %s" % precision
+        if not hasattr(self, "values"):
+            return
+        dtype = np.float32 if precision == "float32" else np.float64
+
+        thresholds = self.thresholds.astype(dtype)
+        rounded_up = thresholds > self.thresholds
+        thresholds[rounded_up] = np.nextafter(thresholds[rounded_up], dtype(-np.inf))
+        self.thresholds = thresholds
+        self.values = self.values.astype(dtype, copy=False)
+        self.node_sample_weight = self.node_sample_weight.astype(dtype, copy=False)
+        self.base_offset = self.base_offset.astype(dtype, copy=False)
+        if self.linear_models is not None:
+            self.linear_coefs = self.linear_coefs.astype(dtype, copy=False)
+            self.linear_means = self.linear_means.astype(dtype, copy=False)
+        self.internal_dtype = dtype
+        if precision == "float32":
+            self.input_dtype = np.float32
+        self._packed_trees = None
+
+    def get_packed_trees(self):
+        """ Returns a handle to a packed copy of the dense tree arrays that the C extension reuses across calls.
+
+        The packed copy (which includes the node layout used by the interventional algorithm) is built the
+        first time it is needed, so if the dense arrays are changed after that the _packed_trees attribute
+        needs to be reset to None. Unlike the dense arrays, where every tree is padded out to the size of
+        the largest one, the packed copy stores the trees back to back (num_nodes[i] nodes for tree i)
+        along with the offset where each tree starts.
+        """
+        if self._packed_trees is None:
+            assert_import("cext")
+            num_nodes = getattr(self, "num_nodes", None)
+            if num_nodes is None:
+                num_nodes = np.full(self.values.shape[0], self.values.shape[1], dtype=np.uint32)
+            self._packed_trees = _cext.pack_tree_ensemble(
+                self.children_left, self.children_right, self.children_default, self.features,
+                self.thresholds, self.values, self.node_sample_weight, self.max_depth, self.base_offset,
+                num_nodes, self.category_sets, self.category_offsets, self.category_bits, self.linear_models,
+                self.linear_offsets, self.linear_features, self.linear_coefs, self.linear_means
+            )
+        return self._packed_trees
+
+    def format_sparse(self, X):
+        """ Converts a scipy sparse matrix of samples into the CSR format that the C extension reads.
+
+        The C extension expands one row at a time into a dense buffer, so X itself is never densified.
+        Entries that are not stored are zeros, or missing values when sparse_missing is set (as for XGBoost).
+        Duplicate entries are summed the same way scipy does.
+        """
+        X = X.tocsr()
+        if X.dtype != self.input_dtype:
+            X = X.astype(self.input_dtype)
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        return X
+
+    def _background_bins(self, R, R_missing, trees):
+        """ Map each background row to the threshold bins it falls in for every feature the given trees split on.
+
+        Two rows with the same bins go the same way at every split of these trees (missing values get a bin of
+        their own since they follow the default direction). Features with categorical splits, and the features
+        of linear leaves (whose exact values matter), are binned by value.
+        """
+        internal = self.children_left[trees] >= 0
+        features = self.features[trees][internal]
+        thresholds = self.thresholds[trees][internal]
+        categorical = np.zeros(len(features), dtype=bool)
+        if self.category_sets is not None:
+            categorical = self.category_sets[trees][internal] >= 0
+        if self.linear_models is not None:
+            linear_features = [
+                self.linear_features[self.linear_offsets[m]:self.linear_offsets[m + 1]]
+                for m in self.linear_models[trees][self.linear_models[trees] >= 0]
+            ]
+            linear_features = np.concatenate([np.zeros(0, dtype=np.int32)] + linear_features)
+            features = np.concatenate([features, linear_features])
+            categorical = np.concatenate([categorical, np.ones(len(linear_features), dtype=bool)])
+        R = R.astype(self.thresholds.dtype, copy=False)
+        bins = np.zeros((R.shape[0], len(np.unique(features))), dtype=np.int64)
+        for j,f in enumerate(np.unique(features)):
+            if np.any(categorical[features == f]):
+                bins[:,j] = np.unique(R[:,f], return_inverse=True)[1]
+            else:
+                split_points = np.unique(thresholds[features == f])
+                bins[:,j] = np.searchsorted(split_points, R[:,f], side="left")
+            bins[R_missing[:,f],j] = -1
+        return bins
+
+    def update_weights(self, X, X_missing=None, reset=False, n_jobs=1):
+        """ Add the number of samples in X that pass through each node to node_sample_weight.
+
+        All the trees are updated in one pass of the C extension (the trees are split between n_jobs threads),
+        and then the values of the internal nodes are recomputed as the weighted averages of their children.
+        With reset=True the current weights are cleared first. Otherwise the counts are added to the current
+        weights, so a new batch of reference data can be folded in without counting the earlier ones again.
+        """
+        assert_import("cext")
+        if safe_isinstance(X, "pandas.core.frame.DataFrame"):
+            X = X.values
+        X = np.asarray(X).astype(self.input_dtype, copy=False)
+        if X_missing is None:
+            X_missing = np.isnan(X)
+        X, X_missing = self.select_features(X, X_missing)
+
+        # the updated arrays are new copies (the current ones may be memory mapped or shared with other processes)
+        weights = np.zeros(self.node_sample_weight.shape) if reset else self.node_sample_weight.astype(np.float64)
+        values = self.values.astype(np.float64)
+        _cext.dense_tree_update_weights(
+            self.children_left, self.children_right, self.children_default, self.features, self.thresholds,
+            values, values.shape[0], weights, X, X_missing, self.category_sets, self.category_offsets,
+            self.category_bits, get_num_threads(n_jobs)
+        )
+        _cext.compute_expectations(self.children_left, self.children_right, weights, values)
+
+        # the tree_path_dependent algorithm needs background samples in every leaf
+        valid = np.arange(weights.shape[1]) < np.asarray(self.num_nodes)[:,None]
+        self.fully_defined_weighting = bool(np.all(weights[valid] > 0))
+        self.node_sample_weight = weights.astype(self.internal_dtype, copy=False)
+        self.values = values.astype(self.internal_dtype, copy=False)
+        self.custom_weights = True
+        self._packed_trees = None
+
+    def summarize_background(self, R, R_missing):
+        """ Build an exact weighted summary of a background dataset for the interventional algorithm.
+
+        With no output transform each tree is explained on its own, so for every tree the background rows are
+        grouped by the path-relevant bins of the features that tree splits on and each group is represented
+        by a single row with the group size as its weight. With a transform the margin of every background
+        row is needed, so only rows that are identical for the whole ensemble get merged. Either way the
+        SHAP values are the same as using every background row.
+
+        Returns
+        -------
+        (R, R_missing, R_weights, R_tree_offsets, R_tree_rows, R_tree_weights) to pass to the C extension,
+        where the last three are None when no transform is used (R only holds the columns the trees read).
+        """
+        R, R_missing = self.select_features(R, R_missing)
+        num_trees = self.values.shape[0]
+        if self.get_transform() == "identity":
+            R_tree_offsets = np.zeros(num_trees + 1, dtype=np.uint32)
+            R_tree_rows = []
+            R_tree_weights = []
+            for i in range(num_trees):
+                _, rows, counts = np.unique(
+                    self._background_bins(R, R_missing, [i]), axis=0, return_index=True, return_counts=True
+                )
+                R_tree_rows.append(rows)
+                R_tree_weights.append(counts)
+                R_tree_offsets[i + 1] = R_tree_offsets[i] + len(rows)
+            R_tree_rows = np.concatenate(R_tree_rows).astype(np.uint32)
+            R_tree_weights = np.concatenate(R_tree_weights).astype(self.internal_dtype)
+            return R, R_missing, None, R_tree_offsets, R_tree_rows, R_tree_weights
+        else:
+            _, rows, counts = np.unique(
+                self._background_bins(R, R_missing, slice(None)), axis=0, return_index=True, return_counts=True
+            )
+            return R[rows], R_missing[rows], counts.astype(self.internal_dtype), None, None, None
+
+    def select_features(self, X, X_missing=None):
+        """ The columns of X (and X_missing) that the trees read, which is all of them unless optimize dropped some.
+        """
+        used_features = getattr(self, "used_features", None)
+        if used_features is None or X is None:
+            return X, X_missing
+        return X[:, used_features], None if X_missing is None else X_missing[:, used_features]
+
+    def optimize(self):
+        """ Simplify the dense tree arrays without changing the model output or its SHAP values.
+
+        Splits whose two children are leaves with the same values (and whose weight is split between them) make
+        no difference, so they are collapsed into leaves, over and over until whole subtrees that make no
+        difference are gone, and the nodes that are no longer reachable are dropped. Trees that are then a single
+        leaf are folded into base_offset, and trees with identical splits and node weights are merged by adding
+        up their values. Finally the features nothing splits on are dropped: used_features records the columns
+        of the input that the trees still read, and the trees index into those columns (see select_features).
+
+        Only the trees up to tree_limit are kept, so tree_limit is cleared. The merged tree of the
+        global_path_dependent algorithm is built from the splits, so its SHAP values can change.
+        """
+        num_trees = self.values.shape[0] if self.tree_limit is None else min(self.tree_limit, self.values.shape[0])
+        children_left = np.array(self.children_left[:num_trees])
+        children_right = np.array(self.children_right[:num_trees])
+        children_default = np.array(self.children_default[:num_trees])
+        features = np.array(self.features[:num_trees])
+        thresholds = np.array(self.thresholds[:num_trees])
+        values = np.array(self.values[:num_trees])
+        weights = np.array(self.node_sample_weight[:num_trees])
+        category_sets = None if self.category_sets is None else np.array(self.category_sets[:num_trees])
+        linear_models = None if self.linear_models is None else np.array(self.linear_models[:num_trees])
+        rows = np.arange(num_trees)[:,None]
+
+        # collapse the splits between two leaves with the same values (Tree SHAP gives such a split no credit as
+        # long as the fractions of the weight going each way add up to one)
+        while True:
+            left, right = np.maximum(children_left, 0), np.maximum(children_right, 0)
+            collapse = (children_left >= 0) & (children_left[rows, left] < 0) & (children_left[rows, right] < 0)
+            collapse &= np.all(values[rows, left] == values[rows, right], axis=-1)
+            collapse &= (weights <= 0) | np.isclose(weights[rows, left] + weights[rows, right], weights, rtol=1e-12, atol=0)
+            if linear_models is not None:
+                collapse &= (linear_models[rows, left] < 0) & (linear_models[rows, right] < 0)
+            if not np.any(collapse):
+                break
+            values[collapse] = values[rows, left][collapse]
+            children_left[collapse] = -1
+            children_right[collapse] = -1
+            children_default[collapse] = -1
+
+        # find the depth of every node still reachable from the roots (one level of all the trees at a time)
+        depths = -np.ones(children_left.shape, dtype=np.int64)
+        tree_inds, node_inds = np.arange(num_trees), np.zeros(num_trees, dtype=np.int64)
+        depth = 0
+        while len(tree_inds) > 0:
+            depths[tree_inds, node_inds] = depth
+            internal = children_left[tree_inds, node_inds] >= 0
+            tree_inds, node_inds = tree_inds[internal], node_inds[internal]
+            node_inds = np.concatenate([children_left[tree_inds, node_inds], children_right[tree_inds, node_inds]])
+            tree_inds = np.concatenate([tree_inds, tree_inds])
+            depth += 1
+        reachable = depths >= 0
+
+        # move the reachable nodes of every tree to the front (keeping their order) and renumber the children
+        order = np.argsort(~reachable, axis=1, kind="stable")
+        new_index = np.empty_like(order)
+        new_index[rows, order] = np.arange(order.shape[1])
+        for children in (children_left, children_right, children_default):
+            children[:] = np.where(children >= 0, new_index[rows, np.maximum(children, 0)], -1)
+        num_nodes = reachable.sum(1)
+        max_nodes = num_nodes.max()
+        padding = np.arange(max_nodes) >= num_nodes[:,None]
+        def compact(arr, fill):
+            inds = order[:,:max_nodes].reshape((num_trees, max_nodes) + (1,) * (arr.ndim - 2))
+            arr = np.take_along_axis(arr, inds, axis=1)
+            arr[padding] = fill
+            return arr
+        children_left, children_right, children_default = [
+            compact(arr, -1) for arr in (children_left, children_right, children_default)
+        ]
+        features, thresholds = compact(features, -1), compact(thresholds, 0)
+        values, weights = compact(values, 0), compact(weights, 0)
+        if category_sets is not None:
+            category_sets = compact(category_sets, -1)
+        if linear_models is not None:
+            linear_models = compact(linear_models, -1)
+        internal = children_left >= 0
+
+        # fold the trees that are a single leaf into the base offset (keeping a tree so the ensemble isn't empty)
+        keep = internal[:,0].copy()
+        if linear_models is not None:
+            keep |= linear_models[:,0] >= 0
+        if not np.any(keep):
+            keep[0] = True
+        base_offset = np.array(self.base_offset, dtype=self.internal_dtype) + values[~keep, 0].sum(0)
+
+        # merge the trees with the same splits and node weights by adding up their values
+        merged_into = {}
+        for i in np.nonzero(keep)[0]:
+            if linear_models is not None and np.any(linear_models[i] >= 0):
+                continue
+            key = [num_nodes[i], children_left[i].tobytes(), children_right[i].tobytes(), weights[i].tobytes()]
+            for arr in (children_default, features, thresholds):
+                key.append(np.where(internal[i], arr[i], 0).tobytes())
+            if category_sets is not None:
+                for node in np.nonzero(category_sets[i] >= 0)[0]:
+                    k = category_sets[i, node]
+                    key.append((node, self.category_bits[self.category_offsets[k]:self.category_offsets[k + 1]].tobytes()))
+            j = merged_into.setdefault(tuple(key), i)
+            if j != i:
+                values[j] += values[i]
+                keep[i] = False
+
+        # number the features the trees still use from zero
+        linear_features = np.zeros(0, dtype=np.int32) if self.linear_features is None else self.linear_features
+        used_features = np.unique(np.concatenate([features[keep][internal[keep]], linear_features]))
+        features[internal] = np.searchsorted(used_features, features[internal])
+        if self.linear_features is not None:
+            self.linear_features = np.searchsorted(used_features, self.linear_features).astype(np.int32)
+        if getattr(self, "used_features", None) is not None:
+            used_features = self.used_features[used_features]
+        self.used_features = used_features.astype(np.int32)
+
+        self.children_left = children_left[keep]
+        self.children_right = children_right[keep]
+        self.children_default = children_default[keep]
+        self.features = features[keep]
+        self.thresholds = thresholds[keep]
+        self.values = values[keep]
+        self.node_sample_weight = weights[keep]
+        self.category_sets = None if category_sets is None else category_sets[keep]
+        self.linear_models = None if linear_models is None else linear_models[keep]
+        self.base_offset = base_offset
+        self.num_nodes = num_nodes[keep].astype(np.int32)
+        self.max_depth = int(depths[keep].max())
+        self.tree_limit = None
+        self.fully_defined_weighting = bool(np.all(self.node_sample_weight[~padding[keep]] > 0))
+        self._packed_trees = None
+
+    # the dense arrays and attributes TreeExplainer.save stores (everything needed to explain the model)
+    saved_arrays = [
+        "children_left", "children_right", "children_default", "features", "thresholds", "values",
+        "node_sample_weight", "base_offset", "num_nodes", "category_sets", "category_offsets", "category_bits",
+        "linear_models", "linear_offsets", "linear_features", "linear_coefs", "linear_means", "used_features"
+    ]
+    saved_attributes = [
+        "model_type", "model_output", "objective", "tree_output", "num_outputs", "num_stacked_models", "max_depth",
+        "tree_limit", "fully_defined_weighting", "sparse_missing", "cat_feature_indices"
+    ]
+
+    def get_save_arrays(self):
+        return {name: getattr(self, name) for name in self.saved_arrays if getattr(self, name, None) is not None}
+
+    def get_save_metadata(self):
+        metadata = {}
+        for name in self.saved_attributes:
+            value = getattr(self, name, None)
+            metadata[name] = value.tolist() if hasattr(value, "tolist") else value
+        metadata["input_dtype"] = np.dtype(self.input_dtype).name
+        metadata["internal_dtype"] = np.dtype(self.internal_dtype).name
+        return metadata
+
+    @classmethod
+    def from_saved(cls, metadata, arrays):
+        """ Rebuild an ensemble from what get_save_metadata and get_save_arrays returned (without the original model).
+        """
+        model = cls.__new__(cls)
+        for name in cls.saved_arrays:
+            setattr(model, name, arrays.get(name, None))
+        for name in cls.saved_attributes:
+            setattr(model, name, metadata[name])
+        model.input_dtype = np.dtype(metadata["input_dtype"]).type
+        model.internal_dtype = np.dtype(metadata["internal_dtype"]).type
+        model.original_model = None
+        model.model_type = "internal" # the original model is not saved, so its own SHAP implementation can't be used
+        model.custom_weights = False
+        model.trees = None
+        model.data = None
+        model.data_missing = None
+        model._packed_trees = None
+        return model
+
+    def share_memory(self):
+        """ Move the dense tree arrays into shared memory (see TreeExplainer.share_memory).
+        """
+        for name in self.saved_arrays:
+            setattr(self, name, share_array(getattr(self, name, None)))
+        self._packed_trees = None
+
+    def __getstate__(self):
+        # the packed trees live in the C extension so they get rebuilt after unpickling
+        state = {name: shared_array_state(value) for name, value in self.__dict__.items()}
+        state["_packed_trees"] = None
+
+        # once the dense arrays are shared we leave out the trees and background data that only the constructor
+        # needs (along with the original model when it has no SHAP implementation of its own)
+        if isinstance(state.get("values", None), SharedArray):
+            state["trees"] = None
+            state["data"] = None
+            state["data_missing"] = None
+            if self.model_type == "internal":
+                state["original_model"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update({name: attach_shared_array_state(value) for name, value in state.items()})
+
     def get_transform(self):
         """ A consistent interface to make predictions from this model.
         """
@@ -953,7 +2190,7 @@ class TreeEnsemble:
 
         return transform
 
-    def predict(self, X, y=None, output=None, tree_limit=None):
+    def predict(self, X, y=None, output=None, tree_limit=None, n_jobs=1):
         """ A consistent interface to make predictions from this model.
 
         Parameters
@@ -961,6 +2198,10 @@ class TreeEnsemble:
         tree_limit : None (default) or int
             Limit the number of trees used by the model. By default None means no use the limit of the
             original model, and -1 means no limit.
+
+        n_jobs : int
+            The number of threads used to traverse the trees (blocks of rows are split between the
+            threads). -1 means using all the available cores.
         """
 
         if output is None:
@@ -975,20 +2216,26 @@ class TreeEnsemble:
         if tree_limit is None:
             tree_limit = -1 if self.tree_limit is None else self.tree_limit
 
-        # convert dataframes
+        # convert dataframes (sparse matrices are read directly by the C extension)
         if safe_isinstance(X, "pandas.core.series.Series"):
             X = X.values
         elif safe_isinstance(X, "pandas.core.frame.DataFrame"):
             X = X.values
         flat_output = False
-        if len(X.shape) == 1:
-            flat_output = True
-            X = X.reshape(1, X.shape[0])
-        if X.dtype.type != self.input_dtype:
-            X = X.astype(self.input_dtype)
-        X_missing = np.isnan(X, dtype=np.bool)
-        assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
-        assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
+        if scipy.sparse.issparse(X):
+            X = self.format_sparse(X)
+        else:
+            if len(X.shape) == 1:
+                flat_output = True
+                X = X.reshape(1, X.shape[0])
+            if X.dtype.type != self.input_dtype:
+                X = X.astype(self.input_dtype)
+            X_missing = np.isnan(X, dtype=np.bool)
+            assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
+            assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
+            X, X_missing = self.select_features(X, X_missing)
+        if scipy.sparse.issparse(X):
+            X = self.select_features(X)[0]
 
         if tree_limit < 0 or tree_limit > self.values.shape[0]:
             tree_limit = self.values.shape[0]
@@ -997,14 +2244,17 @@ class TreeEnsemble:
             assert y is not None, "Both samples and labels must be provided when explaining the loss (i.e. `explainer.shap_values(X, y)`)!"
             assert X.shape[0] == len(y), "The number of labels (%d) does not match the number of samples to explain (%d)!" % (len(y), X.shape[0])
         transform = self.get_transform()
-        assert_import("cext")
-        output = np.zeros((X.shape[0], self.num_outputs))
-        _cext.dense_tree_predict(
-            self.children_left, self.children_right, self.children_default,
-            self.features, self.thresholds, self.values,
-            self.max_depth, tree_limit, self.base_offset, output_transform_codes[transform],
-            X, X_missing, y, output
-        )
+        output = np.zeros((X.shape[0], self.num_outputs), dtype=self.values.dtype)
+        if scipy.sparse.issparse(X):
+            _cext.sparse_tree_predict(
+                self.get_packed_trees(), tree_limit, output_transform_codes[transform], X.indptr, X.indices,
+                X.data, X.shape[1], self.sparse_missing, y, output, get_num_threads(n_jobs)
+            )
+        else:
+            _cext.dense_tree_predict_packed(
+                self.get_packed_trees(), tree_limit, output_transform_codes[transform], X, X_missing, y, output,
+                get_num_threads(n_jobs)
+            )
 
         # drop dimensions we don't need
         if flat_output:
@@ -1019,13 +2269,41 @@ class TreeEnsemble:
                 return output
 
 
+def lightgbm_linear_leaf(features, coefs, leaf_value, leaf_const):
+    """ Convert the linear model of a LightGBM leaf into the (features, coefficients, means) used by Tree.linear_leaves.
+
+    LightGBM leaves output leaf_const + coefs . x (or leaf_value when any of their features are missing), so we
+    use the means that make the linear model give leaf_value. Returns None for leaves that are constant.
+
+    The interventional algorithm only uses the predictions of the leaves, so it gives the same SHAP values for
+    any such means. The path dependent one credits the values of the leaf to the splits above it and the linear
+    terms to their features, so the means decide that split. With one feature, the mean is the single point
+    where the linear model gives leaf_value (the leaf's output when its feature is unknown). With more features,
+    a whole hyperplane of points does that, and the minimum norm one we take is arbitrary. That is why
+    TreeExplainer only explains such leaves with feature_perturbation="interventional".
+    """
+    coefs = np.asarray(coefs, dtype=np.float64)
+    if not np.any(coefs != 0):
+        return None
+    means = (leaf_value - leaf_const) * coefs / coefs.dot(coefs)
+    return np.asarray(features, dtype=np.int32), coefs[:,None], means
+
+
 class Tree:
     """ A single decision tree.
 
     The primary point of this object is to parse many different tree types into a common format.
+    Categorical splits are stored in the categories dictionary, which maps the index of each categorical
+    split node to the integer categories that go to its left child (its threshold is then unused).
+    Linear leaves are stored in the linear_leaves dictionary, which maps the index of each linear leaf to
+    its (features, coefficients, means) arrays (with one column of coefficients per output). Such a leaf
+    outputs its values plus the sum of coefficients * (x[features] - means), unless one of its features is
+    missing, in which case it outputs just its values.
     """
     def __init__(self, tree, normalize=False, scaling=1.0, data=None, data_missing=None):
         assert_import("cext")
+        self.categories = {}
+        self.linear_leaves = {}
 
         if safe_isinstance(tree, "sklearn.tree._tree.Tree"):
             self.children_left = tree.children_left.astype(np.int32)
@@ -1047,6 +2325,11 @@ class Tree:
             self.thresholds = tree["thresholds"]
             self.values = tree["values"] * scaling
             self.node_sample_weight = tree["node_sample_weight"]
+            self.categories = tree.get("categories", {})
+            self.linear_leaves = {
+                node: (features, np.reshape(coefs, (len(features), -1)) * scaling, means)
+                for node, (features, coefs, means) in tree.get("linear_leaves", {}).items()
+            }
 
         # deprecated dictionary support (with sklearn singlular style "feature" and "value" names)
         elif type(tree) is dict and 'children_left' in tree:
@@ -1090,9 +2373,9 @@ class Tree:
                 else:
                     self.features[index] = node.split().featureIndex() #index of the feature we split on, not available for leaf, int
                     if str(node.split().getClass()).endswith('tree.CategoricalSplit'):
-                        #Categorical split isn't implemented, TODO: could fake it by creating a fake node to split on the exact value?
-                        raise NotImplementedError('CategoricalSplit are not yet implemented')
-                    self.thresholds[index] = node.split().threshold() #threshold for the feature, not available for leaf, float
+                        self.categories[index] = np.array(list(node.split().leftCategories()), dtype=np.int64) #categories that go left
+                    else:
+                        self.thresholds[index] = node.split().threshold() #threshold for the feature, not available for leaf, float
 
                     self.children_left[index] = index + 1
                     idx = buildTree(index, node.leftChild())
@@ -1136,7 +2419,13 @@ class Tree:
                         else:
                             self.children_default[vertex['split_index']] = self.children_right[vertex['split_index']]
                         self.features[vertex['split_index']] = vertex['split_feature']
-                        self.thresholds[vertex['split_index']] = vertex['threshold']
+                        if vertex.get('decision_type') == '==': # categorical splits list the categories that go left
+                            self.categories[vertex['split_index']] = np.array(
+                                [int(c) for c in str(vertex['threshold']).split('||')], dtype=np.int64
+                            )
+                            self.thresholds[vertex['split_index']] = 0
+                        else:
+                            self.thresholds[vertex['split_index']] = vertex['threshold']
                         self.values[vertex['split_index']] = [vertex['internal_value']]
                         self.node_sample_weight[vertex['split_index']] = vertex['internal_count']
                         visited.append(vertex['split_index'])
@@ -1154,6 +2443,15 @@ class Tree:
                     self.thresholds[vertex['leaf_index']+num_parents] = -1
                     self.values[vertex['leaf_index']+num_parents] = [vertex['leaf_value']]
                     self.node_sample_weight[vertex['leaf_index']+num_parents] = vertex['leaf_count']
+
+                    # the leaves of linear trees also have a linear model of some features
+                    linear_leaf = lightgbm_linear_leaf(
+                        vertex.get('leaf_features', []), vertex.get('leaf_coeff', []), vertex['leaf_value'],
+                        vertex.get('leaf_const', 0)
+                    )
+                    if linear_leaf is not None:
+                        features, coefs, means = linear_leaf
+                        self.linear_leaves[vertex['leaf_index']+num_parents] = (features, coefs * scaling, means)
             self.values = np.asarray(self.values)
             self.values = np.multiply(self.values, scaling)
 
@@ -1253,9 +2551,15 @@ class Tree:
         # Re-compute the number of samples that pass through each node if we are given data
         if data is not None and data_missing is not None:
             self.node_sample_weight[:] = 0.0
+            category_sets, category_offsets, category_bits = None, None, None
+            if len(self.categories) > 0:
+                category_sets = -np.ones(len(self.children_left), dtype=np.int32)
+                category_sets[list(self.categories.keys())] = np.arange(len(self.categories))
+                category_offsets, category_bits = pack_category_sets(list(self.categories.values()))
             _cext.dense_tree_update_weights(
                 self.children_left, self.children_right, self.children_default, self.features,
-                self.thresholds, self.values, 1, self.node_sample_weight, data, data_missing
+                self.thresholds, self.values, 1, self.node_sample_weight, data, data_missing,
+                category_sets, category_offsets, category_bits
             )
 
         # we compute the expectations to make sure they follow the SHAP logic
@@ -1311,6 +2615,11 @@ class XGBTreeModelLoader(object):
     We can't use the JSON dump because due to numerical precision issues those
     tree can actually be wrong when feature values land almost on a threshold.
     """
+
+    # the layout of each tree node and its stats in the raw dump
+    node_dtype = np.dtype([("parent", "i4"), ("cleft", "i4"), ("cright", "i4"), ("sindex", "u4"), ("info", "f4")])
+    stat_dtype = np.dtype([("loss_chg", "f4"), ("sum_hess", "f4"), ("base_weight", "f4"), ("leaf_child_cnt", "i4")])
+
     def __init__(self, xgb_model):
         # new in XGBoost 1.1, 'binf' is appended to the buffer
         self.buf = xgb_model.save_raw().lstrip(b'binf')
@@ -1347,7 +2656,7 @@ class XGBTreeModelLoader(object):
         self.size_leaf_vector = self.read('i')
         self.read_arr('i', 32) # reserved
 
-        # load each tree
+        # load each tree (the nodes and stats of a tree are read in bulk as structured arrays)
         self.num_roots = np.zeros(self.num_trees, dtype=np.int32)
         self.num_nodes = np.zeros(self.num_trees, dtype=np.int32)
         self.num_deleted = np.zeros(self.num_trees, dtype=np.int32)
@@ -1365,69 +2674,46 @@ class XGBTreeModelLoader(object):
         self.leaf_child_cnt = []
         for i in range(self.num_trees):
 
-            # load the per-tree params
-            self.num_roots[i] = self.read('i')
-            self.num_nodes[i] = self.read('i')
-            self.num_deleted[i] = self.read('i')
-            self.max_depth[i] = self.read('i')
-            self.num_feature[i] = self.read('i')
-            self.size_leaf_vector[i] = self.read('i')
+            # load the per-tree params (followed by 31 reserved ints)
+            params = self.read_records(np.int32, 37)
+            self.num_roots[i], self.num_nodes[i], self.num_deleted[i], self.max_depth[i], \
+                self.num_feature[i], self.size_leaf_vector[i] = params[:6]
 
             # load the nodes
-            self.read_arr('i', 31) # reserved
-            self.node_parents.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_cleft.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_cright.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_sindex.append(np.zeros(self.num_nodes[i], dtype=np.uint32))
-            self.node_info.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            for j in range(self.num_nodes[i]):
-                self.node_parents[-1][j] = self.read('i')
-                self.node_cleft[-1][j] = self.read('i')
-                self.node_cright[-1][j] = self.read('i')
-                self.node_sindex[-1][j] = self.read('I')
-                self.node_info[-1][j] = self.read('f')
-#                 print("self.node_cleft[-1][%d]" % j, self.node_cleft[-1][j])
-#                 print("self.node_cright[-1][%d]" % j, self.node_cright[-1][j])
-#                 print("self.node_sindex[-1][%d]" % j, self.node_sindex[-1][j])
-#                 print("self.node_info[-1][%d]" % j, self.node_info[-1][j])
-#                 print()
+            nodes = self.read_records(self.node_dtype, self.num_nodes[i])
+            self.node_parents.append(nodes["parent"].astype(np.int32))
+            self.node_cleft.append(nodes["cleft"].astype(np.int32))
+            self.node_cright.append(nodes["cright"].astype(np.int32))
+            self.node_sindex.append(nodes["sindex"].astype(np.uint32))
+            self.node_info.append(nodes["info"].astype(np.float32))
 
             # load the stat nodes
-            self.loss_chg.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.sum_hess.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.base_weight.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.leaf_child_cnt.append(np.zeros(self.num_nodes[i], dtype=np.int))
-            for j in range(self.num_nodes[i]):
-                self.loss_chg[-1][j] = self.read('f')
-                self.sum_hess[-1][j] = self.read('f')
-                self.base_weight[-1][j] = self.read('f')
-                self.leaf_child_cnt[-1][j] = self.read('i')
-#                 print("self.loss_chg[-1][%d]" % j, self.loss_chg[-1][j])
-#                 print("self.sum_hess[-1][%d]" % j, self.sum_hess[-1][j])
-#                 print("self.base_weight[-1][%d]" % j, self.base_weight[-1][j])
-#                 print("self.leaf_child_cnt[-1][%d]" % j, self.leaf_child_cnt[-1][j])
-#                 print()
+            stats = self.read_records(self.stat_dtype, self.num_nodes[i])
+            self.loss_chg.append(stats["loss_chg"].astype(np.float32))
+            self.sum_hess.append(stats["sum_hess"].astype(np.float32))
+            self.base_weight.append(stats["base_weight"].astype(np.float32))
+            self.leaf_child_cnt.append(stats["leaf_child_cnt"].astype(np.int64))
 
     def get_trees(self, data=None, data_missing=None):
         shape = (self.num_trees, self.num_nodes.max())
-        self.children_default = np.zeros(shape, dtype=np.int)
-        self.features = np.zeros(shape, dtype=np.int)
+        self.children_default = np.zeros(shape, dtype=np.int64)
+        self.features = np.zeros(shape, dtype=np.int64)
         self.thresholds = np.zeros(shape, dtype=np.float32)
         self.values = np.zeros((shape[0], shape[1], 1), dtype=np.float32)
         trees = []
         for i in range(self.num_trees):
-            for j in range(self.num_nodes[i]):
-                if np.right_shift(self.node_sindex[i][j], np.uint32(31)) != 0:
-                    self.children_default[i,j] = self.node_cleft[i][j]
-                else:
-                    self.children_default[i,j] = self.node_cright[i][j]
-                self.features[i,j] = self.node_sindex[i][j] & ((np.uint32(1) << np.uint32(31)) - np.uint32(1))
-                if self.node_cleft[i][j] >= 0:
-                    self.thresholds[i,j] = self.node_info[i][j]
-                else:
-                    self.values[i,j] = self.node_info[i][j]
-
             l = len(self.node_cleft[i])
+
+            # the top bit of sindex says if missing values go left, the rest is the split feature
+            default_left = np.right_shift(self.node_sindex[i], np.uint32(31)) != 0
+            self.children_default[i,:l] = np.where(default_left, self.node_cleft[i], self.node_cright[i])
+            self.features[i,:l] = self.node_sindex[i] & ((np.uint32(1) << np.uint32(31)) - np.uint32(1))
+
+            # node_info is the threshold of internal nodes and the value of leaves
+            internal = self.node_cleft[i] >= 0
+            self.thresholds[i,:l][internal] = self.node_info[i][internal]
+            self.values[i,:l,0][~internal] = self.node_info[i][~internal]
+
             trees.append(Tree({
                 "children_left": self.node_cleft[i],
                 "children_right": self.node_cright[i],
@@ -1439,13 +2725,17 @@ class XGBTreeModelLoader(object):
             }, data=data, data_missing=data_missing))
         return trees
 
-
     def read(self, dtype):
         size = struct.calcsize(dtype)
         val = struct.unpack(dtype, self.buf[self.pos:self.pos+size])[0]
         self.pos += size
         return val
 
+    def read_records(self, dtype, count):
+        val = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+        self.pos += val.nbytes
+        return val
+
     def read_arr(self, dtype, n_items):
         format = "%d%s" % (n_items, dtype)
         size = struct.calcsize(format)
@@ -1481,6 +2771,122 @@ class XGBTreeModelLoader(object):
         print("size_leaf_vector =", self.size_leaf_vector)
 
 
+def parse_lightgbm_tree(tree_str):
+    """ Parse one tree of a LightGBM text model into the dictionary format read by Tree.
+
+    The text format stores each field of a tree as a line holding the values of all its internal nodes (or
+    leaves), so every field is parsed as a whole array. Internal node i is node i of the tree, and leaf l
+    (stored by LightGBM as child ~l) is node num_leaves - 1 + l, the same numbering as the dump_model parser.
+    """
+    fields = dict(line.split("=", 1) for line in tree_str.split("\n") if "=" in line)
+    def array(key, dtype):
+        return np.fromstring(fields.get(key, ""), dtype=dtype, sep=" ")
+
+    num_parents = int(fields["num_leaves"]) - 1
+    num_nodes = 2 * num_parents + 1
+    leaves = slice(num_parents, num_nodes)
+    tree = {
+        "children_left": -np.ones(num_nodes, dtype=np.int32),
+        "children_right": -np.ones(num_nodes, dtype=np.int32),
+        "children_default": -np.ones(num_nodes, dtype=np.int32),
+        "features": -np.ones(num_nodes, dtype=np.int32),
+        "thresholds": -np.ones(num_nodes, dtype=np.float64),
+        "values": np.zeros((num_nodes, 1), dtype=np.float64),
+        "node_sample_weight": np.zeros(num_nodes, dtype=np.float64),
+        "categories": {},
+        "linear_leaves": {}
+    }
+    tree["values"][leaves,0] = array("leaf_value", np.float64)
+    tree["node_sample_weight"][leaves] = array("leaf_count", np.float64)
+
+    if num_parents > 0:
+        left_child = array("left_child", np.int32)
+        right_child = array("right_child", np.int32)
+        decision_type = array("decision_type", np.int32)
+        # bits 2-3 of decision_type hold the missing value type, and type 1 (zero_as_missing) sends zeros to
+        # the default child, which the cext can't do since it only treats NaN as missing
+        if np.any(((decision_type & 1) == 0) & ((decision_type >> 2) & 3 == 1)):
+            raise SHAPError("LightGBM models trained with zero_as_missing=True are not supported by the internal "
+                            "tree format!")
+        tree["children_left"][:num_parents] = np.where(left_child >= 0, left_child, num_parents + ~left_child)
+        tree["children_right"][:num_parents] = np.where(right_child >= 0, right_child, num_parents + ~right_child)
+        tree["children_default"][:num_parents] = np.where(
+            decision_type & 2, tree["children_left"][:num_parents], tree["children_right"][:num_parents]
+        )
+        tree["features"][:num_parents] = array("split_feature", np.int32)
+        tree["values"][:num_parents,0] = array("internal_value", np.float64)
+        tree["node_sample_weight"][:num_parents] = array("internal_count", np.float64)
+
+        # the threshold of a categorical split is the index of its bitset of categories that go left
+        thresholds = array("threshold", np.float64)
+        categorical = (decision_type & 1) != 0
+        if np.any(categorical):
+            cat_boundaries = array("cat_boundaries", np.int64)
+            cat_threshold = array("cat_threshold", np.uint32).astype("<u4")
+            for i in np.nonzero(categorical)[0]:
+                k = int(thresholds[i])
+                bits = np.unpackbits(cat_threshold[cat_boundaries[k]:cat_boundaries[k + 1]].view(np.uint8), bitorder="little")
+                tree["categories"][i] = np.nonzero(bits)[0].astype(np.int64)
+            thresholds[categorical] = 0
+        tree["thresholds"][:num_parents] = thresholds
+
+    # the leaves of linear trees also have a linear model of some features
+    if fields.get("is_linear", "0").strip() == "1":
+        leaf_value = array("leaf_value", np.float64)
+        leaf_const = array("leaf_const", np.float64)
+        num_features = array("num_features", np.int64)
+        offsets = np.concatenate([[0], np.cumsum(num_features)])
+        leaf_features = array("leaf_features", np.int32)
+        leaf_coeff = array("leaf_coeff", np.float64)
+        for l in range(num_parents + 1):
+            linear_leaf = lightgbm_linear_leaf(
+                leaf_features[offsets[l]:offsets[l + 1]], leaf_coeff[offsets[l]:offsets[l + 1]], leaf_value[l],
+                leaf_const[l]
+            )
+            if linear_leaf is not None:
+                tree["linear_leaves"][num_parents + l] = linear_leaf
+
+    return tree
+
+
+class LightGBMTreeModelLoader:
+    """ This loads a LightGBM model from its text model format.
+
+    This avoids dump_model, which builds a nested dictionary of every node of the model in Python.
+    """
+    def __init__(self, lgb_model):
+        model_str = lgb_model.model_to_string()
+        header = dict(line.split("=", 1) for line in model_str[:model_str.find("\nTree=")].split("\n") if "=" in line)
+        self.num_tree_per_iteration = int(header.get("num_tree_per_iteration", 1))
+        trees_str = model_str[model_str.find("\nTree="):model_str.find("\nend of trees")]
+        self.tree_strs = ["Tree=" + t for t in trees_str.split("\nTree=")[1:]]
+        self.num_trees = len(self.tree_strs)
+
+    def get_trees(self, data=None, data_missing=None, n_jobs=1):
+        """ Build the Tree objects, parsing the trees with n_jobs processes (-1 means using all the cores).
+        """
+        num_processes = min(get_num_threads(n_jobs), self.num_trees)
+        if num_processes > 1:
+            with multiprocessing.Pool(num_processes) as pool:
+                parsed_trees = pool.map(parse_lightgbm_tree, self.tree_strs, chunksize=64)
+        else:
+            parsed_trees = [parse_lightgbm_tree(t) for t in self.tree_strs]
+
+        # multiclass models grow one tree per class in every iteration, so tree i only adds to output
+        # i % num_tree_per_iteration
+        num_outputs = self.num_tree_per_iteration
+        if num_outputs > 1:
+            for i, tree in enumerate(parsed_trees):
+                values = np.zeros((tree["values"].shape[0], num_outputs))
+                values[:, i % num_outputs] = tree["values"][:, 0]
+                tree["values"] = values
+                for node, (features, coefs, means) in tree["linear_leaves"].items():
+                    stacked_coefs = np.zeros((len(features), num_outputs))
+                    stacked_coefs[:, i % num_outputs] = coefs[:, 0]
+                    tree["linear_leaves"][node] = (features, stacked_coefs, means)
+        return [Tree(t, data=data, data_missing=data_missing) for t in parsed_trees]
+
+
 class CatBoostTreeModelLoader:
     def __init__(self, cb_model):
         cb_model.save_model("cb_model.json", format="json")
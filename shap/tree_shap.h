@@ -11,6 +11,11 @@
 #include <stdio.h> 
 #include <cmath>
 #include <ctime>
+#include <thread>
+#include <vector>
+#include <atomic>
+#include <cstdint>
+#include <functional>
 #if defined(_WIN32) || defined(WIN32)
     #include <malloc.h>
 #elif defined(__MVS__)
@@ -20,8 +25,10 @@
 #endif
 using namespace std;
 
-typedef double tfloat;
-typedef tfloat (* transform_f)(const tfloat margin, const tfloat y);
+// everything below is templated on tfloat, the floating point type of the model and data arrays
+// (double by default, or float to halve the memory traffic when explaining float32 data)
+template <typename tfloat>
+using transform_f = tfloat (*)(const tfloat margin, const tfloat y);
 
 namespace FEATURE_DEPENDENCE {
     const unsigned independent = 0;
@@ -29,6 +36,98 @@ namespace FEATURE_DEPENDENCE {
     const unsigned global_path_dependent = 2;
 }
 
+namespace INTERACTIONS {
+    const unsigned none = 0;
+    const unsigned on_off = 1;
+    const unsigned fast = 2;
+}
+
+/**
+ * Runs body(start, end) over contiguous blocks of [0, num_items) using up to num_threads native threads.
+ *
+ * Every call of body gets its own block of items, so per-block scratch memory should be allocated
+ * inside body. The calling thread only waits, so it must not hold any locks the workers need.
+ */
+template <typename F>
+inline void parallel_for(const unsigned num_items, unsigned num_threads, F body) {
+    if (num_threads > num_items) num_threads = num_items;
+    if (num_threads <= 1) {
+        body(0, num_items);
+        return;
+    }
+
+    const unsigned block_size = (num_items + num_threads - 1) / num_threads;
+    std::vector<std::thread> workers;
+    for (unsigned start = 0; start < num_items; start += block_size) {
+        workers.push_back(std::thread(body, start, std::min(start + block_size, num_items)));
+    }
+    for (unsigned i = 0; i < workers.size(); ++i) workers[i].join();
+}
+
+/**
+ * Whether a (non-missing) value x of the split feature goes to the left child of a node.
+ *
+ * Numerical splits (category_set < 0) send x <= threshold to the left. Categorical splits send the categories
+ * in their set to the left, where set k is the bitset category_bits[category_offsets[k]:category_offsets[k + 1]]
+ * over the non-negative integer category values. Anything else (including negative values) goes right.
+ */
+template <typename tfloat>
+inline bool split_goes_left(const tfloat x, const tfloat threshold, const int category_set,
+                            const unsigned *category_offsets, const uint32_t *category_bits) {
+    if (category_set < 0) return x <= threshold;
+    if (!(x >= 0)) return false;
+    const uint64_t category = static_cast<uint64_t>(x);
+    const uint64_t word = category_offsets[category_set] + category / 32;
+    return word < category_offsets[category_set + 1] && ((category_bits[word] >> (category % 32)) & 1);
+}
+
+/**
+ * The linear models of the leaves of a tree ensemble (models is NULL when every leaf is constant).
+ *
+ * models holds the linear model of every node (-1 for constant leaves and internal nodes), and model m has the
+ * terms k in [offsets[m], offsets[m + 1]). A linear leaf outputs its values plus
+ * coefs[k] * (x[features[k]] - means[k]) summed over its terms (coefs holds one coefficient per output), so its
+ * values are its output at the means. Like LightGBM, a missing value in any feature of the model makes the
+ * leaf output just its values.
+ */
+template <typename tfloat>
+struct LinearLeaves {
+    int *models;
+    unsigned *offsets;
+    int *features;
+    tfloat *coefs;
+    tfloat *means;
+
+    LinearLeaves() : models(NULL), offsets(NULL), features(NULL), coefs(NULL), means(NULL) {}
+
+    // the linear model that node pos applies to the row x (-1 when the node outputs just its values)
+    inline int model(const unsigned pos, const bool *x_missing) const {
+        if (models == NULL || models[pos] < 0) return -1;
+        const int m = models[pos];
+        for (unsigned k = offsets[m]; k < offsets[m + 1]; ++k) {
+            if (x_missing[features[k]]) return -1;
+        }
+        return m;
+    }
+
+    // the value of term k for the row x when x uses model m (features the model ignores sit at their means)
+    inline tfloat feature_value(const int m, const unsigned k, const tfloat *x) const {
+        return m < 0 ? means[k] : x[features[k]];
+    }
+
+    // add what the linear model of leaf pos adds to its values for the row x to out (num_outputs entries)
+    inline void add_output(const unsigned pos, const tfloat *x, const bool *x_missing, const unsigned num_outputs,
+                           tfloat *out) const {
+        const int m = model(pos, x_missing);
+        if (m < 0) return;
+        for (unsigned k = offsets[m]; k < offsets[m + 1]; ++k) {
+            const tfloat dx = x[features[k]] - means[k];
+            for (unsigned j = 0; j < num_outputs; ++j) out[j] += coefs[k * num_outputs + j] * dx;
+        }
+    }
+};
+
+template <typename tfloat>
 struct TreeEnsemble {
     int *children_left;
     int *children_right;
@@ -42,20 +141,54 @@ struct TreeEnsemble {
     tfloat *base_offset;
     unsigned max_nodes;
     unsigned num_outputs;
+    unsigned *node_offsets; // when not NULL the trees are stored ragged and tree i starts at node_offsets[i]
+
+    // optional categorical splits (see split_goes_left): when category_sets is not NULL it holds the category set
+    // of every node (-1 for numerical splits), while the category sets themselves are shared by all the trees
+    int *category_sets;
+    unsigned *category_offsets;
+    uint32_t *category_bits;
+
+    // optional linear leaf models (see LinearLeaves), linear.models has an entry for every node
+    LinearLeaves<tfloat> linear;
 
-    TreeEnsemble() {}
+    TreeEnsemble() : node_offsets(NULL), category_sets(NULL), category_offsets(NULL), category_bits(NULL) {}
     TreeEnsemble(int *children_left, int *children_right, int *children_default, int *features,
                  tfloat *thresholds, tfloat *values, tfloat *node_sample_weights,
                  unsigned max_depth, unsigned tree_limit, tfloat *base_offset,
-                 unsigned max_nodes, unsigned num_outputs) :
+                 unsigned max_nodes, unsigned num_outputs, unsigned *node_offsets = NULL,
+                 int *category_sets = NULL, unsigned *category_offsets = NULL, uint32_t *category_bits = NULL) :
         children_left(children_left), children_right(children_right),
         children_default(children_default), features(features), thresholds(thresholds),
         values(values), node_sample_weights(node_sample_weights),
         max_depth(max_depth), tree_limit(tree_limit),
-        base_offset(base_offset), max_nodes(max_nodes), num_outputs(num_outputs) {}
+        base_offset(base_offset), max_nodes(max_nodes), num_outputs(num_outputs),
+        node_offsets(node_offsets), category_sets(category_sets), category_offsets(category_offsets),
+        category_bits(category_bits) {}
+
+    // whether a (non-missing) value x of the split feature goes to the left child of node pos
+    inline bool goes_left(const unsigned pos, const tfloat x) const {
+        return split_goes_left(
+            x, thresholds[pos], category_sets == NULL ? -1 : category_sets[pos], category_offsets, category_bits
+        );
+    }
+
+    // the position of the first node of tree i (trees are either padded to max_nodes or stored ragged)
+    inline unsigned tree_offset(const unsigned i) const {
+        return node_offsets == NULL ? i * max_nodes : node_offsets[i];
+    }
+
+    inline unsigned tree_num_nodes(const unsigned i) const {
+        return node_offsets == NULL ? max_nodes : node_offsets[i + 1] - node_offsets[i];
+    }
+
+    // the total number of node slots used by the first tree_limit trees
+    inline unsigned total_nodes() const {
+        return tree_offset(tree_limit);
+    }
 
     void get_tree(TreeEnsemble &tree, const unsigned i) const {
-        const unsigned d = i * max_nodes;
+        const unsigned d = tree_offset(i);
 
         tree.children_left = children_left + d;
         tree.children_right = children_right + d;
@@ -67,21 +200,55 @@ struct TreeEnsemble {
         tree.max_depth = max_depth;
         tree.tree_limit = 1;
         tree.base_offset = base_offset;
-        tree.max_nodes = max_nodes;
+        tree.max_nodes = tree_num_nodes(i);
         tree.num_outputs = num_outputs;
+        tree.node_offsets = NULL;
+        tree.category_sets = category_sets == NULL ? NULL : category_sets + d;
+        tree.category_offsets = category_offsets;
+        tree.category_bits = category_bits;
+        tree.linear = linear;
+        if (linear.models != NULL) tree.linear.models = linear.models + d;
     }
 
     void allocate(unsigned tree_limit_in, unsigned max_nodes_in, unsigned num_outputs_in) {
         tree_limit = tree_limit_in;
         max_nodes = max_nodes_in;
         num_outputs = num_outputs_in;
-        children_left = new int[tree_limit * max_nodes];
-        children_right = new int[tree_limit * max_nodes];
-        children_default = new int[tree_limit * max_nodes];
-        features = new int[tree_limit * max_nodes];
-        thresholds = new tfloat[tree_limit * max_nodes];
-        values = new tfloat[tree_limit * max_nodes * num_outputs];
-        node_sample_weights = new tfloat[tree_limit * max_nodes];
+        node_offsets = NULL;
+        allocate_nodes(tree_limit * max_nodes);
+    }
+
+    // allocate a ragged ensemble, tree i holds tree_num_nodes[i] nodes and at most max_nodes_in
+    void allocate_ragged(unsigned tree_limit_in, unsigned max_nodes_in, unsigned num_outputs_in,
+                         const unsigned *tree_num_nodes) {
+        tree_limit = tree_limit_in;
+        max_nodes = max_nodes_in;
+        num_outputs = num_outputs_in;
+        node_offsets = new unsigned[tree_limit + 1];
+        node_offsets[0] = 0;
+        for (unsigned i = 0; i < tree_limit; ++i) {
+            node_offsets[i + 1] = node_offsets[i] + tree_num_nodes[i];
+        }
+        allocate_nodes(node_offsets[tree_limit]);
+    }
+
+    void allocate_nodes(unsigned num_nodes) {
+        children_left = new int[num_nodes];
+        children_right = new int[num_nodes];
+        children_default = new int[num_nodes];
+        features = new int[num_nodes];
+        thresholds = new tfloat[num_nodes];
+        values = new tfloat[num_nodes * num_outputs];
+        node_sample_weights = new tfloat[num_nodes];
+        category_sets = NULL;
+        linear = LinearLeaves<tfloat>();
+    }
+
+    // give every node a category set entry that shares the category sets of another ensemble
+    void allocate_category_sets(unsigned num_nodes, const TreeEnsemble &source) {
+        category_sets = new int[num_nodes];
+        category_offsets = source.category_offsets;
+        category_bits = source.category_bits;
     }
 
     void free() {
@@ -92,9 +259,16 @@ struct TreeEnsemble {
         delete[] thresholds;
         delete[] values;
         delete[] node_sample_weights;
+        delete[] node_offsets;
+        delete[] category_sets;
+        delete[] linear.models;
+        node_offsets = NULL;
+        category_sets = NULL;
+        linear.models = NULL;
     }
 };
 
+template <typename tfloat>
 struct ExplanationDataset {
     tfloat *X;
     bool *X_missing;
@@ -105,10 +279,32 @@ struct ExplanationDataset {
     unsigned M;
     unsigned num_R;
 
-    ExplanationDataset() {}
+    // optional summary of the background rows used by the interventional algorithm:
+    // R_weights gives how many of the original background rows each row of R stands in for (NULL means one each), and
+    // when R_tree_offsets is not NULL tree k only needs rows R_tree_rows[R_tree_offsets[k]:R_tree_offsets[k+1]] of R,
+    // each standing in for R_tree_weights of the rows of R (the rows in a group are indistinguishable to that tree)
+    tfloat *R_weights;
+    unsigned *R_tree_offsets;
+    unsigned *R_tree_rows;
+    tfloat *R_tree_weights;
+
+    // optional cached margins (raw model outputs) of the background rows, num_R x num_outputs
+    tfloat *R_margins;
+
+    ExplanationDataset() : R_weights(NULL), R_tree_offsets(NULL), R_tree_rows(NULL), R_tree_weights(NULL),
+                           R_margins(NULL) {}
     ExplanationDataset(tfloat *X, bool *X_missing, tfloat *y, tfloat *R, bool *R_missing, unsigned num_X,
                        unsigned M, unsigned num_R) : 
-        X(X), X_missing(X_missing), y(y), R(R), R_missing(R_missing), num_X(num_X), M(M), num_R(num_R) {}
+        X(X), X_missing(X_missing), y(y), R(R), R_missing(R_missing), num_X(num_X), M(M), num_R(num_R),
+        R_weights(NULL), R_tree_offsets(NULL), R_tree_rows(NULL), R_tree_weights(NULL), R_margins(NULL) {}
+
+    // the total weight of the background rows
+    inline tfloat total_R_weight() const {
+        if (R_weights == NULL) return num_R;
+        tfloat total = 0;
+        for (unsigned j = 0; j < num_R; ++j) total += R_weights[j];
+        return total;
+    }
 
     void get_x_instance(ExplanationDataset &instance, const unsigned i) const {
         instance.M = M;
@@ -122,6 +318,7 @@ struct ExplanationDataset {
 // data we keep about our decision path
 // note that pweight is included for convenience and is not tied with the other attributes
 // the pweight of the i'th path element is the permuation weight of paths with i-1 ones in them
+template <typename tfloat>
 struct PathElement {
     int feature_index;
     tfloat zero_fraction;
@@ -132,14 +329,17 @@ struct PathElement {
         feature_index(i), zero_fraction(z), one_fraction(o), pweight(w) {}
 };
 
+template <typename tfloat>
 inline tfloat logistic_transform(const tfloat margin, const tfloat y) {
     return 1 / (1 + exp(-margin));
 }
 
+template <typename tfloat>
 inline tfloat logistic_nlogloss_transform(const tfloat margin, const tfloat y) {
     return log(1 + exp(margin)) - y * margin; // y is in {0, 1}
 }
 
+template <typename tfloat>
 inline tfloat squared_loss_transform(const tfloat margin, const tfloat y) {
     return (margin - y) * (margin - y);
 }
@@ -151,41 +351,48 @@ namespace MODEL_TRANSFORM {
     const unsigned squared_loss = 3;
 }
 
-inline transform_f get_transform(unsigned model_transform) {
-    transform_f transform = NULL;
+template <typename tfloat>
+inline transform_f<tfloat> get_transform(unsigned model_transform) {
+    transform_f<tfloat> transform = NULL;
     switch (model_transform) {
         case MODEL_TRANSFORM::logistic:
-            transform = logistic_transform;
+            transform = logistic_transform<tfloat>;
             break;
 
         case MODEL_TRANSFORM::logistic_nlogloss:
-            transform = logistic_nlogloss_transform;
+            transform = logistic_nlogloss_transform<tfloat>;
             break;
 
         case MODEL_TRANSFORM::squared_loss:
-            transform = squared_loss_transform;
+            transform = squared_loss_transform<tfloat>;
             break;
     }
 
     return transform;
 }
 
-inline tfloat *tree_predict(unsigned i, const TreeEnsemble &trees, const tfloat *x, const bool *x_missing) {
-    const unsigned offset = i * trees.max_nodes;
+// adds the output of tree i for the row x to out (num_outputs entries)
+template <typename tfloat>
+inline void tree_predict(unsigned i, const TreeEnsemble<tfloat> &trees, const tfloat *x, const bool *x_missing,
+                         tfloat *out) {
+    const unsigned offset = trees.tree_offset(i);
     unsigned node = 0;
     while (true) {
         const unsigned pos = offset + node;
         const unsigned feature = trees.features[pos];
         
-        // we hit a leaf so return a pointer to the values
+        // we hit a leaf so add its values (and its linear model)
         if (trees.children_left[pos] < 0) {
-            return trees.values + pos * trees.num_outputs;
+            const tfloat *leaf_value = trees.values + pos * trees.num_outputs;
+            for (unsigned k = 0; k < trees.num_outputs; ++k) out[k] += leaf_value[k];
+            trees.linear.add_output(pos, x, x_missing, trees.num_outputs, out);
+            return;
         }
         
         // otherwise we are at an internal node and need to recurse
         if (x_missing[feature]) {
             node = trees.children_default[pos];
-        } else if (x[feature] <= trees.thresholds[pos]) {
+        } else if (trees.goes_left(pos, x[feature])) {
             node = trees.children_left[pos];
         } else {
             node = trees.children_right[pos];
@@ -193,46 +400,99 @@ inline tfloat *tree_predict(unsigned i, const TreeEnsemble &trees, const tfloat
     }
 }
 
-inline void dense_tree_predict(tfloat *out, const TreeEnsemble &trees, const ExplanationDataset &data, unsigned model_transform) {
-    tfloat *row_out = out;
-    const tfloat *x = data.X;
-    const bool *x_missing = data.X_missing;
-
-    // see what transform (if any) we have
-    transform_f transform = get_transform(model_transform);
+// the number of rows dense_tree_predict pushes through each tree together
+const unsigned PREDICT_BLOCK_SIZE = 64;
 
-    for (unsigned i = 0; i < data.num_X; ++i) {
+/**
+ * Adds the leaf values of tree i to block_out for a block of num_rows rows (x and x_missing are row major).
+ *
+ * The rows move down the tree together one level at a time, so the nodes near the top of the tree are
+ * reused from cache by every row in the block and the inner loop is a simple comparison per row.
+ */
+template <typename tfloat>
+inline void tree_predict_block(unsigned i, const TreeEnsemble<tfloat> &trees, const tfloat *x,
+                               const bool *x_missing, const unsigned M, const unsigned num_rows,
+                               tfloat *block_out) {
+    const unsigned offset = trees.tree_offset(i);
+    unsigned nodes[PREDICT_BLOCK_SIZE];
+    std::fill(nodes, nodes + num_rows, offset);
+
+    // advance every row that is not at a leaf yet until all of them are
+    bool active = true;
+    while (active) {
+        active = false;
+        for (unsigned j = 0; j < num_rows; ++j) {
+            const unsigned pos = nodes[j];
+            if (trees.children_left[pos] < 0) continue;
+            active = true;
+
+            const unsigned feature = trees.features[pos];
+            if (x_missing[j * M + feature]) {
+                nodes[j] = offset + trees.children_default[pos];
+            } else if (trees.goes_left(pos, x[j * M + feature])) {
+                nodes[j] = offset + trees.children_left[pos];
+            } else {
+                nodes[j] = offset + trees.children_right[pos];
+            }
+        }
+    }
 
-        // add the base offset
+    for (unsigned j = 0; j < num_rows; ++j) {
+        const tfloat *leaf_value = trees.values + nodes[j] * trees.num_outputs;
         for (unsigned k = 0; k < trees.num_outputs; ++k) {
-            row_out[k] += trees.base_offset[k];
+            block_out[j * trees.num_outputs + k] += leaf_value[k];
         }
+        trees.linear.add_output(nodes[j], x + j * M, x_missing + j * M, trees.num_outputs,
+                                block_out + j * trees.num_outputs);
+    }
+}
 
-        // add the leaf values from each tree
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            const tfloat *leaf_value = tree_predict(j, trees, x, x_missing);
+template <typename tfloat>
+inline void dense_tree_predict(tfloat *out, const TreeEnsemble<tfloat> &trees, const ExplanationDataset<tfloat> &data,
+                               unsigned model_transform, const unsigned num_threads = 1) {
 
-            for (unsigned k = 0; k < trees.num_outputs; ++k) {
-                row_out[k] += leaf_value[k];
+    // see what transform (if any) we have
+    transform_f<tfloat> transform = get_transform<tfloat>(model_transform);
+
+    // each thread handles its own range of blocks of rows
+    const unsigned num_blocks = (data.num_X + PREDICT_BLOCK_SIZE - 1) / PREDICT_BLOCK_SIZE;
+    parallel_for(num_blocks, num_threads, [&](const unsigned start, const unsigned end) {
+        for (unsigned b = start; b < end; ++b) {
+            const unsigned first_row = b * PREDICT_BLOCK_SIZE;
+            const unsigned num_rows = std::min(PREDICT_BLOCK_SIZE, data.num_X - first_row);
+            tfloat *block_out = out + first_row * trees.num_outputs;
+
+            // add the base offset
+            for (unsigned i = 0; i < num_rows; ++i) {
+                for (unsigned k = 0; k < trees.num_outputs; ++k) {
+                    block_out[i * trees.num_outputs + k] += trees.base_offset[k];
+                }
             }
-        }
 
-        // apply any needed transform
-        if (transform != NULL) {
-            const tfloat y_i = data.y == NULL ? 0 : data.y[i];
-            for (unsigned k = 0; k < trees.num_outputs; ++k) {
-                row_out[k] = transform(row_out[k], y_i);
+            // add the leaf values from each tree
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                tree_predict_block(
+                    j, trees, data.X + first_row * data.M, data.X_missing + first_row * data.M,
+                    data.M, num_rows, block_out
+                );
             }
-        }
 
-        x += data.M;
-        x_missing += data.M;
-        row_out += trees.num_outputs;
-    }
+            // apply any needed transform
+            if (transform != NULL) {
+                for (unsigned i = 0; i < num_rows; ++i) {
+                    const tfloat y_i = data.y == NULL ? 0 : data.y[first_row + i];
+                    for (unsigned k = 0; k < trees.num_outputs; ++k) {
+                        block_out[i * trees.num_outputs + k] = transform(block_out[i * trees.num_outputs + k], y_i);
+                    }
+                }
+            }
+        }
+    });
 }
 
-inline void tree_update_weights(unsigned i, TreeEnsemble &trees, const tfloat *x, const bool *x_missing) {
-    const unsigned offset = i * trees.max_nodes;
+template <typename tfloat>
+inline void tree_update_weights(unsigned i, TreeEnsemble<tfloat> &trees, const tfloat *x, const bool *x_missing) {
+    const unsigned offset = trees.tree_offset(i);
     unsigned node = 0;
     while (true) {
         const unsigned pos = offset + node;
@@ -247,7 +507,7 @@ inline void tree_update_weights(unsigned i, TreeEnsemble &trees, const tfloat *x
         // otherwise we are at an internal node and need to recurse
         if (x_missing[feature]) {
             node = trees.children_default[pos];
-        } else if (x[feature] <= trees.thresholds[pos]) {
+        } else if (trees.goes_left(pos, x[feature])) {
             node = trees.children_left[pos];
         } else {
             node = trees.children_right[pos];
@@ -255,35 +515,50 @@ inline void tree_update_weights(unsigned i, TreeEnsemble &trees, const tfloat *x
     }
 }
 
-inline void dense_tree_update_weights(TreeEnsemble &trees, const ExplanationDataset &data) {
-    const tfloat *x = data.X;
-    const bool *x_missing = data.X_missing;
-
-    for (unsigned i = 0; i < data.num_X; ++i) {
-
-        // add the leaf values from each tree
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            tree_update_weights(j, trees, x, x_missing);
+// adds the number of samples that pass through each node to node_sample_weights (the trees are split between
+// the threads, so every tree is only ever written to by one of them)
+template <typename tfloat>
+inline void dense_tree_update_weights(TreeEnsemble<tfloat> &trees, const ExplanationDataset<tfloat> &data,
+                                      const unsigned num_threads = 1) {
+    // blocks of rows run through one tree at a time so the tree stays in cache
+    const unsigned block_size = 256;
+    parallel_for(trees.tree_limit, num_threads, [&](const unsigned start, const unsigned end) {
+        for (unsigned block_start = 0; block_start < data.num_X; block_start += block_size) {
+            const unsigned block_end = std::min(block_start + block_size, data.num_X);
+            for (unsigned j = start; j < end; ++j) {
+                for (unsigned i = block_start; i < block_end; ++i) {
+                    tree_update_weights(j, trees, data.X + size_t(i) * data.M, data.X_missing + size_t(i) * data.M);
+                }
+            }
         }
-
-        x += data.M;
-        x_missing += data.M;
-    }
+    });
 }
 
-inline void tree_saabas(tfloat *out, const TreeEnsemble &tree, const ExplanationDataset &data) {
+template <typename tfloat>
+inline void tree_saabas(tfloat *out, const TreeEnsemble<tfloat> &tree, const ExplanationDataset<tfloat> &data) {
     unsigned curr_node = 0;
     unsigned next_node = 0;
     while (true) {
         
-        // we hit a leaf and are done
-        if (tree.children_left[curr_node] < 0) return;
+        // we hit a leaf, so all that is left is to credit each term of its linear model to its feature
+        if (tree.children_left[curr_node] < 0) {
+            const int m = tree.linear.model(curr_node, data.X_missing);
+            if (m < 0) return;
+            for (unsigned k = tree.linear.offsets[m]; k < tree.linear.offsets[m + 1]; ++k) {
+                const unsigned feature = tree.linear.features[k];
+                const tfloat dx = data.X[feature] - tree.linear.means[k];
+                for (unsigned i = 0; i < tree.num_outputs; ++i) {
+                    out[feature * tree.num_outputs + i] += tree.linear.coefs[k * tree.num_outputs + i] * dx;
+                }
+            }
+            return;
+        }
         
         // otherwise we are at an internal node and need to recurse
         const unsigned feature = tree.features[curr_node];
         if (data.X_missing[feature]) {
             next_node = tree.children_default[curr_node];
-        } else if (data.X[feature] <= tree.thresholds[curr_node]) {
+        } else if (tree.goes_left(curr_node, data.X[feature])) {
             next_node = tree.children_left[curr_node];
         } else {
             next_node = tree.children_right[curr_node];
@@ -301,33 +576,39 @@ inline void tree_saabas(tfloat *out, const TreeEnsemble &tree, const Explanation
 /**
  * This runs Tree SHAP with a per tree path conditional dependence assumption.
  */
-void dense_tree_saabas(tfloat *out_contribs, const TreeEnsemble& trees, const ExplanationDataset &data) {
-    tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
+template <typename tfloat>
+void dense_tree_saabas(tfloat *out_contribs, const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                       const unsigned num_threads) {
 
-    // build explanation for each sample
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
-        data.get_x_instance(instance, i);
+    // build explanation for each sample (each thread handles its own block of samples)
+    parallel_for(data.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        tfloat *instance_out_contribs;
+        TreeEnsemble<tfloat> tree;
+        ExplanationDataset<tfloat> instance;
 
-        // aggregate the effect of explaining each tree
-        // (this works because of the linearity property of Shapley values)
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            trees.get_tree(tree, j);
-            tree_saabas(instance_out_contribs, tree, instance);
-        }
+        for (unsigned i = start; i < end; ++i) {
+            instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
+            data.get_x_instance(instance, i);
 
-        // apply the base offset to the bias term
-        for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+            // aggregate the effect of explaining each tree
+            // (this works because of the linearity property of Shapley values)
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                trees.get_tree(tree, j);
+                tree_saabas(instance_out_contribs, tree, instance);
+            }
+
+            // apply the base offset to the bias term
+            for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+            }
         }
-    }
+    });
 }
 
 
 // extend our decision path with a fraction of one and zero extensions
-inline void extend_path(PathElement *unique_path, unsigned unique_depth,
+template <typename tfloat>
+inline void extend_path(PathElement<tfloat> *unique_path, unsigned unique_depth,
                         tfloat zero_fraction, tfloat one_fraction, int feature_index) {
     unique_path[unique_depth].feature_index = feature_index;
     unique_path[unique_depth].zero_fraction = zero_fraction;
@@ -342,7 +623,8 @@ inline void extend_path(PathElement *unique_path, unsigned unique_depth,
 }
 
 // undo a previous extension of the decision path
-inline void unwind_path(PathElement *unique_path, unsigned unique_depth, unsigned path_index) {
+template <typename tfloat>
+inline void unwind_path(PathElement<tfloat> *unique_path, unsigned unique_depth, unsigned path_index) {
     const tfloat one_fraction = unique_path[path_index].one_fraction;
     const tfloat zero_fraction = unique_path[path_index].zero_fraction;
     tfloat next_one_portion = unique_path[unique_depth].pweight;
@@ -369,7 +651,8 @@ inline void unwind_path(PathElement *unique_path, unsigned unique_depth, unsigne
 
 // determine what the total permuation weight would be if
 // we unwound a previous extension in the decision path
-inline tfloat unwound_path_sum(const PathElement *unique_path, unsigned unique_depth,
+template <typename tfloat>
+inline tfloat unwound_path_sum(const PathElement<tfloat> *unique_path, unsigned unique_depth,
                                unsigned path_index) {
     const tfloat one_fraction = unique_path[path_index].one_fraction;
     const tfloat zero_fraction = unique_path[path_index].zero_fraction;
@@ -390,61 +673,201 @@ inline tfloat unwound_path_sum(const PathElement *unique_path, unsigned unique_d
     return total * (unique_depth + 1);
 }
 
-// recursive computation of SHAP values for a decision tree
-inline void tree_shap_recursive(const unsigned num_outputs, const int *children_left,
-                                const int *children_right,
-                                const int *children_default, const int *features,
-                                const tfloat *thresholds, const tfloat *values,
-                                const tfloat *node_sample_weight,
-                                const tfloat *x, const bool *x_missing, tfloat *phi,
-                                unsigned node_index, unsigned unique_depth,
-                                PathElement *parent_unique_path, tfloat parent_zero_fraction,
-                                tfloat parent_one_fraction, int parent_feature_index,
-                                int condition, unsigned condition_feature,
-                                tfloat condition_fraction) {
+// adds the SHAP values of the linear model of a leaf reached along unique_path to phi
+//
+// Each term of the model acts like one more split on its feature below the leaf: the term only adds its value
+// when the feature is known (so its zero fraction is 0), and it keeps whatever fraction of x's path the feature
+// already had higher up the tree. linear_path is scratch space for the extended path.
+template <typename tfloat>
+inline void linear_leaf_shap(const unsigned num_outputs, const LinearLeaves<tfloat> &linear,
+                             const unsigned node_index, const tfloat *x, const bool *x_missing, tfloat *phi,
+                             const PathElement<tfloat> *unique_path, const unsigned unique_depth,
+                             PathElement<tfloat> *linear_path) {
+    const int m = linear.model(node_index, x_missing);
+    if (m < 0) return;
+
+    for (unsigned k = linear.offsets[m]; k < linear.offsets[m + 1]; ++k) {
+        const int feature = linear.features[k];
+        const tfloat dx = x[feature] - linear.means[k];
+        if (dx == 0) continue;
+
+        // split on the term's feature (redoing any earlier split on it)
+        std::copy(unique_path, unique_path + unique_depth + 1, linear_path);
+        unsigned depth = unique_depth;
+        tfloat one_fraction = 1;
+        unsigned path_index = 0;
+        for (; path_index <= depth; ++path_index) {
+            if (linear_path[path_index].feature_index == feature) break;
+        }
+        if (path_index != depth + 1) {
+            one_fraction = linear_path[path_index].one_fraction;
+            unwind_path(linear_path, depth, path_index);
+            depth -= 1;
+        }
+        if (one_fraction == 0) continue;
+        depth += 1;
+        extend_path(linear_path, depth, tfloat(0), one_fraction, feature);
+
+        for (unsigned i = 1; i <= depth; ++i) {
+            const PathElement<tfloat> &el = linear_path[i];
+            const tfloat scale = unwound_path_sum(linear_path, depth, i) * (el.one_fraction - el.zero_fraction) * dx;
+            for (unsigned j = 0; j < num_outputs; ++j) {
+                phi[el.feature_index * num_outputs + j] += scale * linear.coefs[k * num_outputs + j];
+            }
+        }
+    }
+}
 
-    // stop if we have no weight coming down to us
-    if (condition_fraction == 0) return;
+// a node waiting on the explicit stack of tree_shap_paths (or tree_shap_interaction_paths), along with the path
+// element its parent adds for it and where the parent's unique path is stored
+template <typename tfloat>
+struct TreeShapFrame {
+    unsigned node_index;
+    unsigned unique_depth;
+    PathElement<tfloat> *parent_unique_path;
+    tfloat parent_zero_fraction;
+    tfloat parent_one_fraction;
+    int parent_feature_index;
+    tfloat condition_fraction;
+
+    TreeShapFrame() {}
+    TreeShapFrame(unsigned node_index, unsigned unique_depth, PathElement<tfloat> *parent_unique_path,
+                  tfloat parent_zero_fraction, tfloat parent_one_fraction, int parent_feature_index,
+                  tfloat condition_fraction) :
+        node_index(node_index), unique_depth(unique_depth), parent_unique_path(parent_unique_path),
+        parent_zero_fraction(parent_zero_fraction), parent_one_fraction(parent_one_fraction),
+        parent_feature_index(parent_feature_index), condition_fraction(condition_fraction) {}
+};
 
-    // extend the unique path
-    PathElement *unique_path = parent_unique_path + unique_depth + 1;
-    std::copy(parent_unique_path, parent_unique_path + unique_depth + 1, unique_path);
+/**
+ * The scratch memory for explaining trees up to max_depth deep over num_features features, allocated once and
+ * then reused for every tree and row a thread explains.
+ *
+ * Every node on the current path keeps its own copy of the unique path right after the copy of its parent, so
+ * paths holds those copies back to back, followed by one more path (scratch_path) for the linear leaf models and
+ * the conditioned paths of the interaction effects. A unique path holds every feature at most once (plus the
+ * root element), so for deep trees over few features the copies take far less than the depth squared. Walking
+ * the tree depth first, the stack only ever holds the cold sibling of each node on the current path plus the
+ * two children of the node just visited.
+ */
+template <typename tfloat>
+struct TreeShapArena {
+    size_t paths_size;
+    size_t stack_size;
+    PathElement<tfloat> *paths;
+    PathElement<tfloat> *scratch_path;
+    TreeShapFrame<tfloat> *stack;
+
+    TreeShapArena() : paths_size(0), stack_size(0), paths(NULL), scratch_path(NULL), stack(NULL) {}
+    TreeShapArena(const unsigned max_depth, const unsigned num_features) :
+        paths_size(0), stack_size(0), paths(NULL), scratch_path(NULL), stack(NULL) {
+        reserve(max_depth, num_features);
+    }
+    TreeShapArena(const TreeShapArena &) = delete;
+    TreeShapArena &operator=(const TreeShapArena &) = delete;
+    ~TreeShapArena() { free(); }
+
+    // make room for trees up to max_depth deep (keeping the current memory when it is already big enough)
+    void reserve(const unsigned max_depth, const unsigned num_features) {
+
+        // the unique path of a node d deep has at most min(d, num_features + 1) + 1 elements, and the copy of a
+        // child starts at most one element after the end of the copy of its parent
+        const size_t max_unique_depth = size_t(num_features) + 1;
+        size_t needed_paths = 1;
+        for (size_t d = 0; d <= max_depth; ++d) needed_paths += std::min(d, max_unique_depth) + 2;
+        const size_t scratch_size = std::min(size_t(max_depth), max_unique_depth) + 2;
+        const size_t needed_stack = size_t(max_depth) + 2;
+        if (needed_paths + scratch_size <= paths_size && needed_stack <= stack_size) return;
+
+        free();
+        paths_size = needed_paths + scratch_size;
+        stack_size = needed_stack;
+        paths = new PathElement<tfloat>[paths_size];
+        scratch_path = paths + needed_paths;
+        stack = new TreeShapFrame<tfloat>[stack_size];
+    }
 
-    if (condition == 0 || condition_feature != static_cast<unsigned>(parent_feature_index)) {
-        extend_path(unique_path, unique_depth, parent_zero_fraction,
-                    parent_one_fraction, parent_feature_index);
+    void free() {
+        delete[] paths;
+        delete[] stack;
+        paths_size = 0;
+        stack_size = 0;
+        paths = NULL;
+        scratch_path = NULL;
+        stack = NULL;
     }
-    const unsigned split_index = features[node_index];
+};
 
-    // leaf node
-    if (children_right[node_index] < 0) {
-        for (unsigned i = 1; i <= unique_depth; ++i) {
-            const tfloat w = unwound_path_sum(unique_path, unique_depth, i);
-            const PathElement &el = unique_path[i];
-            const unsigned phi_offset = el.feature_index * num_outputs;
-            const unsigned values_offset = node_index * num_outputs;
-            const tfloat scale = w * (el.one_fraction - el.zero_fraction) * condition_fraction;
-            for (unsigned j = 0; j < num_outputs; ++j) {
-                phi[phi_offset + j] += scale * values[values_offset + j];
+// computes the SHAP values of a decision tree, walking it depth first with the explicit stack of arena
+// (the linear leaf models are only explained when not conditioning on a feature)
+//
+// Every node copies the unique path of its parent into its own slot of arena.paths and extends it, exactly like
+// the recursive algorithm of the paper would on the call stack. The hot child is visited before the cold one, so
+// the values are added to phi in the same order as the recursive algorithm adds them.
+template <typename tfloat>
+inline void tree_shap_paths(const TreeEnsemble<tfloat> &tree, const tfloat *x, const bool *x_missing, tfloat *phi,
+                            int condition, unsigned condition_feature, TreeShapArena<tfloat> &arena) {
+    const unsigned num_outputs = tree.num_outputs;
+    TreeShapFrame<tfloat> *stack = arena.stack;
+    unsigned stack_size = 0;
+    stack[stack_size++] = TreeShapFrame<tfloat>(0, 0, arena.paths, 1, 1, -1, 1);
+
+    while (stack_size > 0) {
+        const TreeShapFrame<tfloat> frame = stack[--stack_size];
+        const unsigned node_index = frame.node_index;
+        unsigned unique_depth = frame.unique_depth;
+        const tfloat condition_fraction = frame.condition_fraction;
+
+        // stop if we have no weight coming down to us
+        if (condition_fraction == 0) continue;
+
+        // extend the unique path
+        PathElement<tfloat> *unique_path = frame.parent_unique_path + unique_depth + 1;
+        std::copy(frame.parent_unique_path, frame.parent_unique_path + unique_depth + 1, unique_path);
+
+        if (condition == 0 || condition_feature != static_cast<unsigned>(frame.parent_feature_index)) {
+            extend_path(unique_path, unique_depth, frame.parent_zero_fraction,
+                        frame.parent_one_fraction, frame.parent_feature_index);
+        }
+        const unsigned split_index = tree.features[node_index];
+
+        // leaf node
+        if (tree.children_right[node_index] < 0) {
+            for (unsigned i = 1; i <= unique_depth; ++i) {
+                const tfloat w = unwound_path_sum(unique_path, unique_depth, i);
+                const PathElement<tfloat> &el = unique_path[i];
+                const unsigned phi_offset = el.feature_index * num_outputs;
+                const unsigned values_offset = node_index * num_outputs;
+                const tfloat scale = w * (el.one_fraction - el.zero_fraction) * condition_fraction;
+                for (unsigned j = 0; j < num_outputs; ++j) {
+                    phi[phi_offset + j] += scale * tree.values[values_offset + j];
+                }
+            }
+            if (condition == 0) {
+                linear_leaf_shap(
+                    num_outputs, tree.linear, node_index, x, x_missing, phi, unique_path, unique_depth,
+                    arena.scratch_path
+                );
             }
+            continue;
         }
 
-    // internal node
-    } else {
         // find which branch is "hot" (meaning x would follow it)
         unsigned hot_index = 0;
         if (x_missing[split_index]) {
-            hot_index = children_default[node_index];
-        } else if (x[split_index] <= thresholds[node_index]) {
-            hot_index = children_left[node_index];
+            hot_index = tree.children_default[node_index];
+        } else if (tree.goes_left(node_index, x[split_index])) {
+            hot_index = tree.children_left[node_index];
         } else {
-            hot_index = children_right[node_index];
+            hot_index = tree.children_right[node_index];
         }
-        const unsigned cold_index = (static_cast<int>(hot_index) == children_left[node_index] ?
-                                        children_right[node_index] : children_left[node_index]);
-        const tfloat w = node_sample_weight[node_index];
-        const tfloat hot_zero_fraction = node_sample_weight[hot_index] / w;
-        const tfloat cold_zero_fraction = node_sample_weight[cold_index] / w;
+        const unsigned cold_index = (static_cast<int>(hot_index) == tree.children_left[node_index] ?
+                                        tree.children_right[node_index] : tree.children_left[node_index]);
+        // a node no background sample reaches (like the parts of a global_path_dependent merged tree that only the
+        // explained samples reach) has no split fractions, so x is taken to always follow its own branch there
+        const tfloat w = tree.node_sample_weights[node_index];
+        const tfloat hot_zero_fraction = w > 0 ? tree.node_sample_weights[hot_index] / w : 1;
+        const tfloat cold_zero_fraction = w > 0 ? tree.node_sample_weights[cold_index] / w : 0;
         tfloat incoming_zero_fraction = 1;
         tfloat incoming_one_fraction = 1;
 
@@ -461,7 +884,7 @@ inline void tree_shap_recursive(const unsigned num_outputs, const int *children_
             unique_depth -= 1;
         }
 
-        // divide up the condition_fraction among the recursive calls
+        // divide up the condition_fraction among the children
         tfloat hot_condition_fraction = condition_fraction;
         tfloat cold_condition_fraction = condition_fraction;
         if (condition > 0 && split_index == condition_feature) {
@@ -473,30 +896,176 @@ inline void tree_shap_recursive(const unsigned num_outputs, const int *children_
             unique_depth -= 1;
         }
 
-        tree_shap_recursive(
-            num_outputs, children_left, children_right, children_default, features, thresholds, values,
-            node_sample_weight, x, x_missing, phi, hot_index, unique_depth + 1, unique_path,
-            hot_zero_fraction * incoming_zero_fraction, incoming_one_fraction,
-            split_index, condition, condition_feature, hot_condition_fraction
-        );
+        // a branch that neither x nor any background sample can follow adds nothing (and would divide by zero),
+        // and the cold child goes on the stack first so that the hot one is visited first
+        if (cold_zero_fraction * incoming_zero_fraction != 0) {
+            stack[stack_size++] = TreeShapFrame<tfloat>(
+                cold_index, unique_depth + 1, unique_path, cold_zero_fraction * incoming_zero_fraction, 0,
+                split_index, cold_condition_fraction
+            );
+        }
+        if (hot_zero_fraction * incoming_zero_fraction != 0 || incoming_one_fraction != 0) {
+            stack[stack_size++] = TreeShapFrame<tfloat>(
+                hot_index, unique_depth + 1, unique_path, hot_zero_fraction * incoming_zero_fraction,
+                incoming_one_fraction, split_index, hot_condition_fraction
+            );
+        }
+    }
+}
 
-        tree_shap_recursive(
-            num_outputs, children_left, children_right, children_default, features, thresholds, values,
-            node_sample_weight, x, x_missing, phi, cold_index, unique_depth + 1, unique_path,
-            cold_zero_fraction * incoming_zero_fraction, 0,
-            split_index, condition, condition_feature, cold_condition_fraction
-        );
+// computes the SHAP interaction values of a decision tree, walking it like tree_shap_paths
+//
+// This walks the tree once without conditioning on any feature. At each leaf the path element for a
+// feature k already holds the fractions that the "on" (one_fraction) and "off" (zero_fraction) passes
+// of tree_shap_paths would have carried down as their condition_fraction, and unwinding k from the
+// path gives the same path those conditioned passes would have built. So the interaction effects of
+// every feature on the path are computed from the shared path instead of from two more traversals.
+template <typename tfloat>
+inline void tree_shap_interaction_paths(const TreeEnsemble<tfloat> &tree, const unsigned M, const tfloat *x,
+                                        const bool *x_missing, tfloat *phi, tfloat *phi_interactions,
+                                        TreeShapArena<tfloat> &arena) {
+    const unsigned num_outputs = tree.num_outputs;
+    PathElement<tfloat> *conditioned_path = arena.scratch_path;
+    TreeShapFrame<tfloat> *stack = arena.stack;
+    unsigned stack_size = 0;
+    stack[stack_size++] = TreeShapFrame<tfloat>(0, 0, arena.paths, 1, 1, -1, 1);
+
+    while (stack_size > 0) {
+        const TreeShapFrame<tfloat> frame = stack[--stack_size];
+        const unsigned node_index = frame.node_index;
+        unsigned unique_depth = frame.unique_depth;
+
+        // extend the unique path
+        PathElement<tfloat> *unique_path = frame.parent_unique_path + unique_depth + 1;
+        std::copy(frame.parent_unique_path, frame.parent_unique_path + unique_depth + 1, unique_path);
+        extend_path(unique_path, unique_depth, frame.parent_zero_fraction, frame.parent_one_fraction,
+                    frame.parent_feature_index);
+        const unsigned split_index = tree.features[node_index];
+
+        // leaf node
+        if (tree.children_right[node_index] < 0) {
+            const unsigned values_offset = node_index * num_outputs;
+            const unsigned row_size = (M + 1) * num_outputs;
+
+            // the main effects (identical to an unconditioned tree_shap_paths pass)
+            for (unsigned i = 1; i <= unique_depth; ++i) {
+                const tfloat w = unwound_path_sum(unique_path, unique_depth, i);
+                const PathElement<tfloat> &el = unique_path[i];
+                const unsigned phi_offset = el.feature_index * num_outputs;
+                const tfloat scale = w * (el.one_fraction - el.zero_fraction);
+                for (unsigned j = 0; j < num_outputs; ++j) {
+                    phi[phi_offset + j] += scale * tree.values[values_offset + j];
+                }
+            }
+
+            // the difference between conditioning each path feature on and off
+            for (unsigned k = 1; k <= unique_depth; ++k) {
+                const PathElement<tfloat> &cond_el = unique_path[k];
+                const tfloat cond_scale = (cond_el.one_fraction - cond_el.zero_fraction) / 2;
+                if (cond_scale == 0) continue;
+
+                std::copy(unique_path, unique_path + unique_depth + 1, conditioned_path);
+                unwind_path(conditioned_path, unique_depth, k);
+                tfloat *interactions_row = phi_interactions + cond_el.feature_index * row_size;
+                for (unsigned i = 1; i < unique_depth; ++i) {
+                    const PathElement<tfloat> &el = conditioned_path[i];
+                    if (el.one_fraction == el.zero_fraction) continue;
+                    const tfloat w = unwound_path_sum(conditioned_path, unique_depth - 1, i);
+                    const unsigned phi_offset = el.feature_index * num_outputs;
+                    const tfloat scale = w * (el.one_fraction - el.zero_fraction) * cond_scale;
+                    for (unsigned j = 0; j < num_outputs; ++j) {
+                        const tfloat val = scale * tree.values[values_offset + j];
+                        interactions_row[phi_offset + j] += val;
+                        phi[phi_offset + j] -= val;
+                    }
+                }
+            }
+            continue;
+        }
+
+        // find which branch is "hot" (meaning x would follow it)
+        unsigned hot_index = 0;
+        if (x_missing[split_index]) {
+            hot_index = tree.children_default[node_index];
+        } else if (tree.goes_left(node_index, x[split_index])) {
+            hot_index = tree.children_left[node_index];
+        } else {
+            hot_index = tree.children_right[node_index];
+        }
+        const unsigned cold_index = (static_cast<int>(hot_index) == tree.children_left[node_index] ?
+                                        tree.children_right[node_index] : tree.children_left[node_index]);
+        // a node no background sample reaches (like the parts of a global_path_dependent merged tree that only the
+        // explained samples reach) has no split fractions, so x is taken to always follow its own branch there
+        const tfloat w = tree.node_sample_weights[node_index];
+        const tfloat hot_zero_fraction = w > 0 ? tree.node_sample_weights[hot_index] / w : 1;
+        const tfloat cold_zero_fraction = w > 0 ? tree.node_sample_weights[cold_index] / w : 0;
+        tfloat incoming_zero_fraction = 1;
+        tfloat incoming_one_fraction = 1;
+
+        // see if we have already split on this feature,
+        // if so we undo that split so we can redo it for this node
+        unsigned path_index = 0;
+        for (; path_index <= unique_depth; ++path_index) {
+            if (static_cast<unsigned>(unique_path[path_index].feature_index) == split_index) break;
+        }
+        if (path_index != unique_depth + 1) {
+            incoming_zero_fraction = unique_path[path_index].zero_fraction;
+            incoming_one_fraction = unique_path[path_index].one_fraction;
+            unwind_path(unique_path, unique_depth, path_index);
+            unique_depth -= 1;
+        }
+
+        // a branch that neither x nor any background sample can follow adds nothing (and would divide by zero),
+        // and the cold child goes on the stack first so that the hot one is visited first
+        if (cold_zero_fraction * incoming_zero_fraction != 0) {
+            stack[stack_size++] = TreeShapFrame<tfloat>(
+                cold_index, unique_depth + 1, unique_path, cold_zero_fraction * incoming_zero_fraction, 0,
+                split_index, 1
+            );
+        }
+        if (hot_zero_fraction * incoming_zero_fraction != 0 || incoming_one_fraction != 0) {
+            stack[stack_size++] = TreeShapFrame<tfloat>(
+                hot_index, unique_depth + 1, unique_path, hot_zero_fraction * incoming_zero_fraction,
+                incoming_one_fraction, split_index, 1
+            );
+        }
     }
 }
 
-inline int compute_expectations(TreeEnsemble &tree, int i = 0, int depth = 0) {
+// sets the values of the internal nodes of a tree to the weighted average of the values of their children,
+// returning the depth of the tree (which is also stored in tree.max_depth)
+//
+// The tree is walked with an explicit stack, visiting every internal node a second time once both its children
+// have their values, so very deep trees don't need a deep call stack.
+template <typename tfloat>
+inline int compute_expectations(TreeEnsemble<tfloat> &tree) {
+    struct Visit {
+        unsigned node_index;
+        unsigned depth;
+        bool children_done;
+    };
+    std::vector<Visit> stack;
+    stack.push_back({0, 0, false});
     unsigned max_depth = 0;
 
-    if (tree.children_right[i] >= 0) {
+    while (!stack.empty()) {
+        const Visit visit = stack.back();
+        stack.pop_back();
+        const unsigned i = visit.node_index;
+
+        if (tree.children_right[i] < 0) {
+            max_depth = std::max(max_depth, visit.depth);
+            continue;
+        }
         const unsigned li = tree.children_left[i];
         const unsigned ri = tree.children_right[i];
-        const unsigned depth_left = compute_expectations(tree, li, depth + 1);
-        const unsigned depth_right = compute_expectations(tree, ri, depth + 1);
+        if (!visit.children_done) {
+            stack.push_back({i, visit.depth, true});
+            stack.push_back({ri, visit.depth + 1, false});
+            stack.push_back({li, visit.depth + 1, false});
+            continue;
+        }
+
         const tfloat left_weight = tree.node_sample_weights[li];
         const tfloat right_weight = tree.node_sample_weights[ri];
         const unsigned li_offset = li * tree.num_outputs;
@@ -510,16 +1079,18 @@ inline int compute_expectations(TreeEnsemble &tree, int i = 0, int depth = 0) {
                 tree.values[i_offset + j] = v;
             }
         }
-        max_depth = std::max(depth_left, depth_right) + 1;
     }
-    
-    if (depth == 0) tree.max_depth = max_depth;
-    
+
+    tree.max_depth = max_depth;
     return max_depth;
 }
 
-inline void tree_shap(const TreeEnsemble& tree, const ExplanationDataset &data,
-                      tfloat *out_contribs, int condition, unsigned condition_feature) {
+// adds the SHAP values of one tree for the single row in data to out_contribs
+// (arena must have room for trees of depth tree.max_depth)
+template <typename tfloat>
+inline void tree_shap(const TreeEnsemble<tfloat>& tree, const ExplanationDataset<tfloat> &data,
+                      tfloat *out_contribs, int condition, unsigned condition_feature,
+                      TreeShapArena<tfloat> &arena) {
 
     // update the reference value with the expected value of the tree's predictions
     if (condition == 0) {
@@ -528,35 +1099,42 @@ inline void tree_shap(const TreeEnsemble& tree, const ExplanationDataset &data,
         }
     }
 
-    // Pre-allocate space for the unique path data
-    const unsigned maxd = tree.max_depth + 2; // need a bit more space than the max depth
-    PathElement *unique_path_data = new PathElement[(maxd * (maxd + 1)) / 2];
+    tree_shap_paths(tree, data.X, data.X_missing, out_contribs, condition, condition_feature, arena);
+}
 
-    tree_shap_recursive(
-        tree.num_outputs, tree.children_left, tree.children_right, tree.children_default,
-        tree.features, tree.thresholds, tree.values, tree.node_sample_weights, data.X,
-        data.X_missing, out_contribs, 0, 0, unique_path_data, 1, 1, -1, condition,
-        condition_feature, 1
-    );
 
-    delete[] unique_path_data;
-}
+/**
+ * Computes the SHAP values of one tree (added to out_contribs) along with the interaction effects
+ * of every feature pair (added to out_interactions, with the interaction effects already removed
+ * from out_contribs so it can be used as the diagonal). arena must have room for trees of depth tree.max_depth.
+ */
+template <typename tfloat>
+inline void tree_shap_interactions(const TreeEnsemble<tfloat>& tree, const ExplanationDataset<tfloat> &data,
+                                   tfloat *out_contribs, tfloat *out_interactions, TreeShapArena<tfloat> &arena) {
 
+    // update the reference value with the expected value of the tree's predictions
+    for (unsigned j = 0; j < tree.num_outputs; ++j) {
+        out_contribs[data.M * tree.num_outputs + j] += tree.values[j];
+    }
+
+    tree_shap_interaction_paths(tree, data.M, data.X, data.X_missing, out_contribs, out_interactions, arena);
+}
 
-unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble &trees,
+template <typename tfloat>
+unsigned build_merged_tree_recursive(TreeEnsemble<tfloat> &out_tree, const TreeEnsemble<tfloat> &trees,
                                      const tfloat *data, const bool *data_missing, int *data_inds,
                                      const unsigned num_background_data_inds, unsigned num_data_inds,
                                      unsigned M, unsigned row = 0, unsigned i = 0, unsigned pos = 0,
                                      tfloat *leaf_value = NULL) {
     //tfloat new_leaf_value[trees.num_outputs];
     tfloat *new_leaf_value = (tfloat *) alloca(sizeof(tfloat) * trees.num_outputs); // allocate on the stack
-    unsigned row_offset = row * trees.max_nodes;
+    unsigned row_offset = trees.tree_offset(row);
   
     // we have hit a terminal leaf!!!
     if (trees.children_left[row_offset + i] < 0 && row + 1 == trees.tree_limit) {
 
         // create the leaf node
-        const tfloat *vals = trees.values + (row * trees.max_nodes + i) * trees.num_outputs;
+        const tfloat *vals = trees.values + (row_offset + i) * trees.num_outputs;
         if (leaf_value == NULL) {
             for (unsigned j = 0; j < trees.num_outputs; ++j) {
                 out_tree.values[pos * trees.num_outputs + j] = vals[j];
@@ -571,6 +1149,7 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
         out_tree.children_default[pos] = -1;
         out_tree.features[pos] = -1;
         out_tree.thresholds[pos] = 0;
+        if (out_tree.category_sets != NULL) out_tree.category_sets[pos] = -1;
         out_tree.node_sample_weights[pos] = num_background_data_inds;
 
         return pos;
@@ -580,7 +1159,7 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
     if (trees.children_left[row_offset + i] < 0) {
         
         // accumulate the value of this original leaf so it will land on all eventual terminal leaves
-        const tfloat *vals = trees.values + (row * trees.max_nodes + i) * trees.num_outputs;
+        const tfloat *vals = trees.values + (row_offset + i) * trees.num_outputs;
         if (leaf_value == NULL) {
             for (unsigned j = 0; j < trees.num_outputs; ++j) {
                 new_leaf_value[j] = vals[j];
@@ -594,12 +1173,11 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
 
         // move forward to the next tree
         row += 1;
-        row_offset += trees.max_nodes;
+        row_offset = trees.tree_offset(row);
         i = 0;
     }
     
-    // split the data inds by this node's threshold
-    const tfloat t = trees.thresholds[row_offset + i];
+    // split the data inds by this node's threshold (or category set)
     const int f = trees.features[row_offset + i];
     const bool right_default = trees.children_default[row_offset + i] == trees.children_right[row_offset + i];
     int low_ptr = 0;
@@ -608,9 +1186,9 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
     int low_data_ind;
     while (low_ptr <= high_ptr) {
         low_data_ind = data_inds[low_ptr];
-        const int data_ind = std::abs(low_data_ind) * M + f;
+        const int data_ind = (low_data_ind < 0 ? -low_data_ind - 1 : low_data_ind) * M + f;
         const bool is_missing = data_missing[data_ind];
-        if ((!is_missing && data[data_ind] > t) || (right_default && is_missing)) {
+        if ((!is_missing && !trees.goes_left(row_offset + i, data[data_ind])) || (right_default && is_missing)) {
             data_inds[low_ptr] = data_inds[high_ptr];
             data_inds[high_ptr] = low_data_ind;
             high_ptr -= 1;
@@ -662,6 +1240,7 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
         
         out_tree.features[pos] = trees.features[row_offset + i];
         out_tree.thresholds[pos] = trees.thresholds[row_offset + i];
+        if (out_tree.category_sets != NULL) out_tree.category_sets[pos] = trees.category_sets[row_offset + i];
         out_tree.node_sample_weights[pos] = num_background_data_inds;
 
         // build the right subtree
@@ -674,7 +1253,8 @@ unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble
 }
 
 
-void build_merged_tree(TreeEnsemble &out_tree, const ExplanationDataset &data, const TreeEnsemble &trees) {
+template <typename tfloat>
+void build_merged_tree(TreeEnsemble<tfloat> &out_tree, const ExplanationDataset<tfloat> &data, const TreeEnsemble<tfloat> &trees) {
     
     // create a joint data matrix from both X and R matrices
     tfloat *joined_data = new tfloat[(data.num_X + data.num_R) * data.M];
@@ -686,10 +1266,9 @@ void build_merged_tree(TreeEnsemble &out_tree, const ExplanationDataset &data, c
 
     // create an starting array of data indexes we will recursively sort
     int *data_inds = new int[data.num_X + data.num_R];
-    for (unsigned i = 0; i < data.num_X; ++i) data_inds[i] = i;
-    for (unsigned i = data.num_X; i < data.num_X + data.num_R; ++i) {
-        data_inds[i] = -i; // a negative index means it won't be recorded as a background sample
-    }
+    // a negative index -(i + 1) is row i of X, which is not recorded as a background sample
+    for (unsigned i = 0; i < data.num_X; ++i) data_inds[i] = -static_cast<int>(i) - 1;
+    for (unsigned i = data.num_X; i < data.num_X + data.num_R; ++i) data_inds[i] = i;
 
     build_merged_tree_recursive(
         out_tree, trees, joined_data, joined_data_missing, data_inds, data.num_R,
@@ -704,16 +1283,141 @@ void build_merged_tree(TreeEnsemble &out_tree, const ExplanationDataset &data, c
 
 // Independent Tree SHAP functions below here
 // ------------------------------------------
+// the leaf values are not part of the Node layout, tree_shap_indep reads all the outputs from the tree's values array
+template <typename tfloat>
 struct Node {
     short cl, cr, cd, pnode, feat, pfeat; // uint_16
-    float thres, value;
-    char from_flag;
+    int cat; // the category set of a categorical split (-1 for numerical splits)
+    tfloat thres;
 };
 
 #define FROM_NEITHER 0
 #define FROM_X_NOT_R 1
 #define FROM_R_NOT_X 2
 
+/**
+ * Reformats the trees into the Node layout used by tree_shap_indep. Tree i's nodes start at trees.tree_offset(i),
+ * the same position they have in the TreeEnsemble arrays.
+ */
+template <typename tfloat>
+inline void build_node_trees(const TreeEnsemble<tfloat> &trees, Node<tfloat> *node_trees) {
+    for (unsigned i = 0; i < trees.tree_limit; ++i) {
+        const unsigned offset = trees.tree_offset(i);
+        const unsigned num_nodes = trees.tree_num_nodes(i);
+        Node<tfloat> *node_tree = node_trees + offset;
+        for (unsigned j = 0; j < num_nodes; ++j) {
+            const unsigned en_ind = offset + j;
+            node_tree[j].cl = trees.children_left[en_ind];
+            node_tree[j].cr = trees.children_right[en_ind];
+            node_tree[j].cd = trees.children_default[en_ind];
+            if (j == 0) {
+                node_tree[j].pnode = 0;
+            }
+            if (trees.children_left[en_ind] >= 0) { // relies on all unused entries having negative values in them
+                node_tree[trees.children_left[en_ind]].pnode = j;
+                node_tree[trees.children_left[en_ind]].pfeat = trees.features[en_ind];
+            }
+            if (trees.children_right[en_ind] >= 0) { // relies on all unused entries having negative values in them
+                node_tree[trees.children_right[en_ind]].pnode = j;
+                node_tree[trees.children_right[en_ind]].pfeat = trees.features[en_ind];
+            }
+
+            node_tree[j].thres = trees.thresholds[en_ind];
+            node_tree[j].cat = trees.category_sets == NULL ? -1 : trees.category_sets[en_ind];
+            node_tree[j].feat = trees.features[en_ind];
+        }
+    }
+}
+
+/**
+ * A tree ensemble that owns a packed copy of all its arrays along with the Node layout of its trees.
+ *
+ * This is built once for a model and then reused by every call that explains it, so repeated calls
+ * don't need to convert the model arrays or rebuild the Node layout each time. The packed copy is
+ * ragged: only the first tree_num_nodes[i] nodes of each (padded) source tree are kept, and the trees
+ * are concatenated with their start positions recorded in trees.node_offsets.
+ */
+template <typename tfloat>
+struct PackedTreeEnsemble {
+    TreeEnsemble<tfloat> trees;
+    Node<tfloat> *node_trees;
+
+    PackedTreeEnsemble(const TreeEnsemble<tfloat> &source, const unsigned *tree_num_nodes,
+                       const unsigned num_category_sets = 0, const unsigned num_linear_models = 0) {
+        trees.allocate_ragged(source.tree_limit, source.max_nodes, source.num_outputs, tree_num_nodes);
+        trees.max_depth = source.max_depth;
+        trees.base_offset = new tfloat[source.num_outputs];
+        std::copy(source.base_offset, source.base_offset + source.num_outputs, trees.base_offset);
+
+        // the packed copy owns its own category sets
+        if (source.category_sets != NULL) {
+            const unsigned num_words = source.category_offsets[num_category_sets];
+            trees.category_sets = new int[trees.total_nodes()];
+            trees.category_offsets = new unsigned[num_category_sets + 1];
+            trees.category_bits = new uint32_t[num_words];
+            std::copy(source.category_offsets, source.category_offsets + num_category_sets + 1, trees.category_offsets);
+            std::copy(source.category_bits, source.category_bits + num_words, trees.category_bits);
+        }
+
+        // along with its own linear leaf models
+        const LinearLeaves<tfloat> &linear = source.linear;
+        if (linear.models != NULL) {
+            const unsigned num_terms = linear.offsets[num_linear_models];
+            trees.linear.models = new int[trees.total_nodes()];
+            trees.linear.offsets = new unsigned[num_linear_models + 1];
+            trees.linear.features = new int[num_terms];
+            trees.linear.coefs = new tfloat[num_terms * source.num_outputs];
+            trees.linear.means = new tfloat[num_terms];
+            std::copy(linear.offsets, linear.offsets + num_linear_models + 1, trees.linear.offsets);
+            std::copy(linear.features, linear.features + num_terms, trees.linear.features);
+            std::copy(linear.coefs, linear.coefs + num_terms * source.num_outputs, trees.linear.coefs);
+            std::copy(linear.means, linear.means + num_terms, trees.linear.means);
+        }
+
+        const unsigned num_outputs = source.num_outputs;
+        for (unsigned i = 0; i < source.tree_limit; ++i) {
+            const unsigned s = source.tree_offset(i);
+            const unsigned d = trees.tree_offset(i);
+            const unsigned n = trees.tree_num_nodes(i);
+            std::copy(source.children_left + s, source.children_left + s + n, trees.children_left + d);
+            std::copy(source.children_right + s, source.children_right + s + n, trees.children_right + d);
+            std::copy(source.children_default + s, source.children_default + s + n, trees.children_default + d);
+            std::copy(source.features + s, source.features + s + n, trees.features + d);
+            std::copy(source.thresholds + s, source.thresholds + s + n, trees.thresholds + d);
+            std::copy(source.values + s * num_outputs, source.values + (s + n) * num_outputs, trees.values + d * num_outputs);
+            std::copy(source.node_sample_weights + s, source.node_sample_weights + s + n, trees.node_sample_weights + d);
+            if (source.category_sets != NULL) {
+                std::copy(source.category_sets + s, source.category_sets + s + n, trees.category_sets + d);
+            }
+            if (linear.models != NULL) {
+                std::copy(linear.models + s, linear.models + s + n, trees.linear.models + d);
+            }
+        }
+
+        node_trees = new Node<tfloat>[trees.total_nodes()];
+        build_node_trees(trees, node_trees);
+    }
+
+    // a view of the first tree_limit trees (the packed data is shared, so this is cheap)
+    TreeEnsemble<tfloat> get_trees(const unsigned tree_limit) const {
+        TreeEnsemble<tfloat> limited_trees = trees;
+        limited_trees.tree_limit = std::min(tree_limit, trees.tree_limit);
+        return limited_trees;
+    }
+
+    ~PackedTreeEnsemble() {
+        trees.free();
+        delete[] trees.base_offset;
+        delete[] trees.category_offsets;
+        delete[] trees.category_bits;
+        delete[] trees.linear.offsets;
+        delete[] trees.linear.features;
+        delete[] trees.linear.coefs;
+        delete[] trees.linear.means;
+        delete[] node_trees;
+    }
+};
+
 // https://www.geeksforgeeks.org/space-and-time-efficient-binomial-coefficient/
 inline int bin_coeff(int n, int k) { 
     int res = 1; 
@@ -726,13 +1430,18 @@ inline int bin_coeff(int n, int k) {
     return res; 
 } 
 
-// note this only handles single output models, so multi-output models get explained using multiple passes
+// all the model outputs are explained in a single traversal: values holds num_outputs values per node,
+// pos_lst and neg_lst need num_outputs entries per node, and out_contribs is (num_feats + 1) x num_outputs
+// (from_flags is per-call scratch space with one entry per node, so mytree itself is never written to)
+template <typename tfloat>
 inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
                             const unsigned num_nodes, const tfloat *x,
                             const bool *x_missing, const tfloat *r,
                             const bool *r_missing, tfloat *out_contribs,
                             float *pos_lst, float *neg_lst, signed short *feat_hist,
-                            float *memoized_weights, int *node_stack, Node *mytree) {
+                            float *memoized_weights, int *node_stack, const Node<tfloat> *mytree,
+                            const tfloat *values, const unsigned num_outputs, char *from_flags,
+                            const unsigned *category_offsets, const uint32_t *category_bits) {
 
 //     const bool DEBUG = true;
 //     ofstream myfile;
@@ -745,12 +1454,15 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
     short node = 0, feat, cl, cr, cd, pnode, pfeat = -1;
     short next_xnode = -1, next_rnode = -1;
     short next_node = -1, from_child = -1;
-    float thres, pos_x = 0, neg_x = 0, pos_r = 0, neg_r = 0;
+    int cat;
+    tfloat thres;
+    float pos_x = 0, neg_x = 0, pos_r = 0, neg_r = 0;
     char from_flag;
     unsigned M = 0, N = 0;
     
-    Node curr_node = mytree[node];
+    Node<tfloat> curr_node = mytree[node];
     feat = curr_node.feat;
+    cat = curr_node.cat;
     thres = curr_node.thres;
     cl = curr_node.cl;
     cr = curr_node.cr;
@@ -758,7 +1470,9 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 
     // short circut when this is a stump tree (with no splits)
     if (cl < 0) {
-        out_contribs[num_feats] += curr_node.value;
+        for (unsigned o = 0; o < num_outputs; ++o) {
+            out_contribs[num_feats * num_outputs + o] += values[o];
+        }
         return;
     }
     
@@ -770,25 +1484,25 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
     
     if (x_missing[feat]) {
         next_xnode = cd;
-    } else if (x[feat] > thres) {
-        next_xnode = cr;
-    } else if (x[feat] <= thres) {
+    } else if (split_goes_left(x[feat], thres, cat, category_offsets, category_bits)) {
         next_xnode = cl;
+    } else {
+        next_xnode = cr;
     }
     
     if (r_missing[feat]) {
         next_rnode = cd;
-    } else if (r[feat] > thres) {
-        next_rnode = cr;
-    } else if (r[feat] <= thres) {
+    } else if (split_goes_left(r[feat], thres, cat, category_offsets, category_bits)) {
         next_rnode = cl;
+    } else {
+        next_rnode = cr;
     }
     
     if (next_xnode != next_rnode) {
-        mytree[next_xnode].from_flag = FROM_X_NOT_R;
-        mytree[next_rnode].from_flag = FROM_R_NOT_X;
+        from_flags[next_xnode] = FROM_X_NOT_R;
+        from_flags[next_rnode] = FROM_R_NOT_X;
     } else {
-        mytree[next_xnode].from_flag = FROM_NEITHER;
+        from_flags[next_xnode] = FROM_NEITHER;
     }
     
     // Check if x and r go the same way
@@ -814,13 +1528,14 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
         node = next_node;
         curr_node = mytree[node];
         feat = curr_node.feat;
+        cat = curr_node.cat;
         thres = curr_node.thres;
         cl = curr_node.cl;
         cr = curr_node.cr;
         cd = curr_node.cd;
         pnode = curr_node.pnode;
         pfeat = curr_node.pfeat;
-        from_flag = curr_node.from_flag;
+        from_flag = from_flags[node];
 
         
         
@@ -839,17 +1554,25 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
             //        myfile << "At a leaf\n";
             //      }
 
+            const tfloat *node_values = values + node * num_outputs;
             if (M == 0) {
-              out_contribs[num_feats] += mytree[node].value;
+                for (unsigned o = 0; o < num_outputs; ++o) {
+                    out_contribs[num_feats * num_outputs + o] += node_values[o];
+                }
             }
 
-            // Currently assuming a single output
             if (N != 0) {
                 if (M != 0) {
-                    pos_lst[node] = mytree[node].value * memoized_weights[N + max_depth * (M-1)];
+                    const float weight = memoized_weights[N + max_depth * (M-1)];
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        pos_lst[node * num_outputs + o] = node_values[o] * weight;
+                    }
                 }
                 if (M != N) {
-                    neg_lst[node] = -mytree[node].value * memoized_weights[N + max_depth * M];
+                    const float weight = memoized_weights[N + max_depth * M];
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        neg_lst[node * num_outputs + o] = -node_values[o] * weight;
+                    }
                 }
             }
 //             if (DEBUG) {
@@ -877,8 +1600,8 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
             continue;
         }
 
-        const bool x_right = x[feat] > thres;
-        const bool r_right = r[feat] > thres;
+        const bool x_right = !split_goes_left(x[feat], thres, cat, category_offsets, category_bits);
+        const bool r_right = !split_goes_left(r[feat], thres, cat, category_offsets, category_bits);
 
         if (x_missing[feat]) {
             next_xnode = cd;
@@ -898,10 +1621,10 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 
         if (next_xnode >= 0) {
           if (next_xnode != next_rnode) {
-              mytree[next_xnode].from_flag = FROM_X_NOT_R;
-              mytree[next_rnode].from_flag = FROM_R_NOT_X;
+              from_flags[next_xnode] = FROM_X_NOT_R;
+              from_flags[next_rnode] = FROM_R_NOT_X;
           } else {
-              mytree[next_xnode].from_flag = FROM_NEITHER;
+              from_flags[next_xnode] = FROM_NEITHER;
           }
         }
         
@@ -973,8 +1696,8 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
                     break;
                 }
                 // Update and unroll
-                pos_lst[node] = pos_lst[from_child];
-                neg_lst[node] = neg_lst[from_child];
+                std::copy(pos_lst + from_child * num_outputs, pos_lst + (from_child + 1) * num_outputs, pos_lst + node * num_outputs);
+                std::copy(neg_lst + from_child * num_outputs, neg_lst + (from_child + 1) * num_outputs, neg_lst + node * num_outputs);
 
 //                 if (DEBUG) {
 //                   myfile << "pos_lst[node]: " << pos_lst[node] << "\n";
@@ -1021,28 +1744,30 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 //                 if (DEBUG) {
 //                   myfile << "Compute stuff and unroll - Arriving from the right child\n";
 //                 }
-                pos_x = 0;
-                neg_x = 0;
-                pos_r = 0;
-                neg_r = 0;
+                short x_child = -1, r_child = -1;
                 if ((next_xnode == cr) && (next_rnode == cl)) {
-                    pos_x = pos_lst[cr];
-                    neg_x = neg_lst[cr];
-                    pos_r = pos_lst[cl];
-                    neg_r = neg_lst[cl];
+                    x_child = cr;
+                    r_child = cl;
                 } else if ((next_xnode == cl) && (next_rnode == cr)) {
-                    pos_x = pos_lst[cl];
-                    neg_x = neg_lst[cl];
-                    pos_r = pos_lst[cr];
-                    neg_r = neg_lst[cr];
+                    x_child = cl;
+                    r_child = cr;
+                }
+                for (unsigned o = 0; o < num_outputs; ++o) {
+                    pos_x = 0;
+                    neg_x = 0;
+                    pos_r = 0;
+                    neg_r = 0;
+                    if (x_child >= 0) {
+                        pos_x = pos_lst[x_child * num_outputs + o];
+                        neg_x = neg_lst[x_child * num_outputs + o];
+                        pos_r = pos_lst[r_child * num_outputs + o];
+                        neg_r = neg_lst[r_child * num_outputs + o];
+                    }
+                    // out_contribs needs to have been initialized as all zeros
+                    out_contribs[feat * num_outputs + o] += pos_x + neg_r;
+                    pos_lst[node * num_outputs + o] = pos_x + pos_r;
+                    neg_lst[node * num_outputs + o] = neg_x + neg_r;
                 }
-                // out_contribs needs to have been initialized as all zeros
-                // if (pos_x + neg_r != 0) {
-                //   std::cout << "val " << pos_x + neg_r << "\n";
-                // }
-                out_contribs[feat] += pos_x + neg_r;
-                pos_lst[node] = pos_x + pos_r;
-                neg_lst[node] = neg_x + neg_r;
 
 //                 if (DEBUG) {
 //                   myfile << "out_contribs[feat]: " << out_contribs[feat] << "\n";
@@ -1083,15 +1808,116 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
     //  }
 }
 
+/**
+ * Adds what the linear leaf models of tree i add to the interventional SHAP values of x against the background row r.
+ *
+ * tree_shap_indep explains the leaf values, so this adds the rest of each leaf's output: its linear model evaluated
+ * at r (a constant, which only depends on which features take x's value through reaching the leaf), plus one
+ * term coefs[k] * (x_k - r_k) for every term k that also needs its feature to take x's value. Both only depend
+ * on the set A of path features that only x agrees with and the set B that only r agrees with, so their Shapley
+ * values have a closed form. (Missing values are checked on x and r, so the hybrid rows of the two always use
+ * the linear terms of one of them.) feat_fails needs 2 * num_feats zeros and path_feats max_depth entries.
+ */
+template <typename tfloat>
+inline void tree_shap_indep_linear(const TreeEnsemble<tfloat> &trees, const unsigned i, const unsigned num_feats,
+                                   const tfloat *x, const bool *x_missing, const tfloat *r, const bool *r_missing,
+                                   tfloat *out_contribs, unsigned *feat_fails, int *path_feats,
+                                   const unsigned node = 0, const unsigned depth = 0, const unsigned num_a = 0,
+                                   const unsigned num_b = 0) {
+    const LinearLeaves<tfloat> &linear = trees.linear;
+    const unsigned num_outputs = trees.num_outputs;
+    const unsigned pos = trees.tree_offset(i) + node;
+    unsigned *x_fails = feat_fails;
+    unsigned *r_fails = feat_fails + num_feats;
+
+    // internal node: follow every child that x or r goes to, tracking which features only one of them agrees with
+    if (trees.children_left[pos] >= 0) {
+        const int feat = trees.features[pos];
+        const int x_child = x_missing[feat] ? trees.children_default[pos] :
+            (trees.goes_left(pos, x[feat]) ? trees.children_left[pos] : trees.children_right[pos]);
+        const int r_child = r_missing[feat] ? trees.children_default[pos] :
+            (trees.goes_left(pos, r[feat]) ? trees.children_left[pos] : trees.children_right[pos]);
+        const bool in_a = x_fails[feat] == 0 && r_fails[feat] > 0;
+        const bool in_b = x_fails[feat] > 0 && r_fails[feat] == 0;
+        const int children[2] = {trees.children_left[pos], trees.children_right[pos]};
+        for (unsigned c = 0; c < 2; ++c) {
+            if (children[c] != x_child && children[c] != r_child) continue;
+            if (children[c] != x_child) x_fails[feat] += 1;
+            if (children[c] != r_child) r_fails[feat] += 1;
+
+            // a feature that both x and r disagree with can never reach this child
+            if (x_fails[feat] == 0 || r_fails[feat] == 0) {
+                const bool child_in_a = x_fails[feat] == 0 && r_fails[feat] > 0;
+                const bool child_in_b = x_fails[feat] > 0 && r_fails[feat] == 0;
+                path_feats[depth] = feat;
+                tree_shap_indep_linear(
+                    trees, i, num_feats, x, x_missing, r, r_missing, out_contribs, feat_fails, path_feats,
+                    children[c], depth + 1, num_a + child_in_a - in_a, num_b + child_in_b - in_b
+                );
+            }
 
-inline void print_progress_bar(tfloat &last_print, tfloat start_time, unsigned i, unsigned total_count) {
-    const tfloat elapsed_seconds = difftime(time(NULL), start_time);
+            if (children[c] != x_child) x_fails[feat] -= 1;
+            if (children[c] != r_child) r_fails[feat] -= 1;
+        }
+        return;
+    }
+
+    // leaf node
+    if (linear.models == NULL || linear.models[pos] < 0) return;
+    const int m = linear.models[pos];
+    const int x_m = linear.model(pos, x_missing);
+    const int r_m = linear.model(pos, r_missing);
+
+    // adds the Shapley values of the game that is w when every feature of A (plus extra_feat when it is not -1)
+    // takes x's value and every feature of B takes r's value (and is 0 otherwise)
+    auto add_game = [&](const tfloat *w, const tfloat w_scale, const int extra_feat) {
+        const unsigned a = num_a + (extra_feat >= 0);
+        const unsigned b = num_b;
+        if (a == 0) {
+            for (unsigned j = 0; j < num_outputs; ++j) out_contribs[num_feats * num_outputs + j] += w[j] * w_scale;
+        }
+        const tfloat a_weight = a == 0 ? 0 : w_scale / (a * bin_coeff(a + b, a));
+        const tfloat b_weight = b == 0 ? 0 : -w_scale / (b * bin_coeff(a + b, b));
+        for (unsigned d = 0; d < depth; ++d) {
+            const int feat = path_feats[d];
+            if (std::find(path_feats, path_feats + d, feat) != path_feats + d) continue;
+            tfloat weight = 0;
+            if (x_fails[feat] == 0 && r_fails[feat] > 0) weight = a_weight;
+            else if (x_fails[feat] > 0 && r_fails[feat] == 0) weight = b_weight;
+            if (weight == 0) continue;
+            for (unsigned j = 0; j < num_outputs; ++j) out_contribs[feat * num_outputs + j] += w[j] * weight;
+        }
+        if (extra_feat >= 0) {
+            for (unsigned j = 0; j < num_outputs; ++j) out_contribs[extra_feat * num_outputs + j] += w[j] * a_weight;
+        }
+    };
+
+    for (unsigned k = linear.offsets[m]; k < linear.offsets[m + 1]; ++k) {
+        const int feat = linear.features[k];
+        const tfloat *coefs = linear.coefs + k * num_outputs;
+        const tfloat x_k = linear.feature_value(x_m, k, x);
+        const tfloat r_k = linear.feature_value(r_m, k, r);
+
+        // the term's value at r
+        if (r_k != linear.means[k]) add_game(coefs, r_k - linear.means[k], -1);
+
+        // the term's change from r to x, which also needs its own feature to take x's value
+        // (so it is 0 when the feature is in B, and adds the feature to A when it is in neither)
+        if (x_k == r_k || x_fails[feat] > 0) continue;
+        add_game(coefs, x_k - r_k, r_fails[feat] > 0 ? -1 : feat);
+    }
+}
+
+inline void print_progress_bar(double &last_print, double start_time, unsigned i, unsigned total_count) {
+    const double elapsed_seconds = difftime(time(NULL), start_time);
     
     if (elapsed_seconds > 10 && elapsed_seconds - last_print > 0.5) {
-        const tfloat fraction = static_cast<tfloat>(i) / total_count;
+        const double fraction = static_cast<double>(i) / total_count;
         const double total_seconds = elapsed_seconds / fraction;
         last_print = elapsed_seconds;
-        
+
+        // we may be running without the GIL (or on a worker thread) so we need to grab it before printing
+        PyGILState_STATE gil_state = PyGILState_Ensure();
         PySys_WriteStderr(
             "\r%3.0f%%|%.*s%.*s| %d/%d [%02d:%02d<%02d:%02d]       ",
             fraction * 100, int(0.5 + fraction*20), "===================",
@@ -1107,47 +1933,25 @@ inline void print_progress_bar(tfloat &last_print, tfloat start_time, unsigned i
             PyObject *result = PyObject_CallMethod(pyStderr, "flush", NULL);
             Py_XDECREF(result);
         }
+        PyGILState_Release(gil_state);
     }
 }
 
 /**
  * Runs Tree SHAP with feature independence assumptions on dense data.
  */
-void dense_independent(const TreeEnsemble& trees, const ExplanationDataset &data,
-                       tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
-
-    // reformat the trees for faster access
-    Node *node_trees = new Node[trees.tree_limit * trees.max_nodes];
-    for (unsigned i = 0; i < trees.tree_limit; ++i) {
-        Node *node_tree = node_trees + i * trees.max_nodes;
-        for (unsigned j = 0; j < trees.max_nodes; ++j) {
-            const unsigned en_ind = i * trees.max_nodes + j;
-            node_tree[j].cl = trees.children_left[en_ind];
-            node_tree[j].cr = trees.children_right[en_ind];
-            node_tree[j].cd = trees.children_default[en_ind];
-            if (j == 0) {
-                node_tree[j].pnode = 0;
-            }
-            if (trees.children_left[en_ind] >= 0) { // relies on all unused entries having negative values in them
-                node_tree[trees.children_left[en_ind]].pnode = j;
-                node_tree[trees.children_left[en_ind]].pfeat = trees.features[en_ind];
-            }
-            if (trees.children_right[en_ind] >= 0) { // relies on all unused entries having negative values in them
-                node_tree[trees.children_right[en_ind]].pnode = j;
-                node_tree[trees.children_right[en_ind]].pfeat = trees.features[en_ind];
-            }
-
-            node_tree[j].thres = trees.thresholds[en_ind];
-            node_tree[j].feat = trees.features[en_ind];
-        }
+template <typename tfloat>
+void dense_independent(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                       tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                       const unsigned num_threads, const Node<tfloat> *packed_node_trees = NULL) {
+
+    // reformat the trees for faster access (unless the caller already did)
+    Node<tfloat> *node_trees = NULL;
+    if (packed_node_trees == NULL) {
+        node_trees = new Node<tfloat>[trees.total_nodes()];
+        build_node_trees(trees, node_trees);
+        packed_node_trees = node_trees;
     }
-    
-    // preallocate arrays needed by the algorithm
-    float *pos_lst = new float[trees.max_nodes];
-    float *neg_lst = new float[trees.max_nodes];
-    int *node_stack = new int[(unsigned) trees.max_depth];
-    signed short *feat_hist = new signed short[data.M];
-    tfloat *tmp_out_contribs = new tfloat[(data.M + 1)];
 
     // precompute all the weight coefficients
     float *memoized_weights = new float[(trees.max_depth+1) * (trees.max_depth+1)];
@@ -1157,135 +1961,259 @@ void dense_independent(const TreeEnsemble& trees, const ExplanationDataset &data
         }
     }
 
-    // compute the explanations for each sample
-    tfloat *instance_out_contribs;
-    tfloat rescale_factor = 1.0;
-    tfloat margin_x = 0;
-    tfloat margin_r = 0;
+    // compute the explanations for each sample (every output is handled by the same pass through the trees)
+    const unsigned num_outputs = trees.num_outputs;
+    const unsigned contrib_row_size = (data.M + 1) * num_outputs;
+    const tfloat total_R_weight = data.total_R_weight();
     time_t start_time = time(NULL);
-    tfloat last_print = 0;
-    for (unsigned oind = 0; oind < trees.num_outputs; ++oind) {
-        // set the values int he reformated tree to the current output index
-        for (unsigned i = 0; i < trees.tree_limit; ++i) {
-            Node *node_tree = node_trees + i * trees.max_nodes;
-            for (unsigned j = 0; j < trees.max_nodes; ++j) {
-                const unsigned en_ind = i * trees.max_nodes + j;
-                node_tree[j].value = trees.values[en_ind * trees.num_outputs + oind];
-            }
+    double last_print = 0;
+    std::atomic<unsigned> num_done(0);
+
+    // loop over all the samples (each thread handles its own block of samples with its own scratch space)
+    parallel_for(data.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+
+        // preallocate arrays needed by the algorithm
+        float *pos_lst = new float[trees.max_nodes * num_outputs];
+        float *neg_lst = new float[trees.max_nodes * num_outputs];
+        char *from_flags = new char[trees.max_nodes];
+        int *node_stack = new int[(unsigned) trees.max_depth];
+        signed short *feat_hist = new signed short[data.M];
+        tfloat *tmp_out_contribs = new tfloat[contrib_row_size];
+        tfloat *margin_x = new tfloat[num_outputs];
+        tfloat *margin_r = new tfloat[num_outputs];
+        unsigned *feat_fails = NULL;
+        int *path_feats = NULL;
+        if (trees.linear.models != NULL) {
+            feat_fails = new unsigned[2 * data.M]();
+            path_feats = new int[trees.max_depth + 1];
         }
 
-        // loop over all the samples
-        for (unsigned i = 0; i < data.num_X; ++i) {
+        tfloat *instance_out_contribs;
+        tfloat rescale_factor = 1.0;
+        for (unsigned i = start; i < end; ++i) {
             const tfloat *x = data.X + i * data.M;
             const bool *x_missing = data.X_missing + i * data.M;
-            instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
+            instance_out_contribs = out_contribs + i * contrib_row_size;
             const tfloat y_i = data.y == NULL ? 0 : data.y[i];
 
-            print_progress_bar(last_print, start_time, oind * data.num_X + i, data.num_X * trees.num_outputs);
+            // only the first block reports progress, since printing needs to grab the GIL
+            if (start == 0) {
+                print_progress_bar(last_print, start_time, num_done, data.num_X);
+            }
 
-            // compute the model's margin output for x
-            if (transform != NULL) {
-                margin_x = trees.base_offset[oind];
+            // without a transform the trees can be explained one at a time against just the background
+            // rows that tree can tell apart
+            if (transform == NULL && data.R_tree_offsets != NULL) {
                 for (unsigned k = 0; k < trees.tree_limit; ++k) {
-                    margin_x += tree_predict(k, trees, x, x_missing)[oind];
+                    for (unsigned g = data.R_tree_offsets[k]; g < data.R_tree_offsets[k + 1]; ++g) {
+                        const unsigned j = data.R_tree_rows[g];
+                        std::fill_n(tmp_out_contribs, contrib_row_size, 0);
+                        tree_shap_indep(
+                            trees.max_depth, data.M, trees.tree_num_nodes(k), x, x_missing,
+                            data.R + j * data.M, data.R_missing + j * data.M,
+                            tmp_out_contribs, pos_lst, neg_lst, feat_hist, memoized_weights,
+                            node_stack, packed_node_trees + trees.tree_offset(k),
+                            trees.values + trees.tree_offset(k) * num_outputs, num_outputs, from_flags,
+                            trees.category_offsets, trees.category_bits
+                        );
+                        if (trees.linear.models != NULL) {
+                            tree_shap_indep_linear(
+                                trees, k, data.M, x, x_missing, data.R + j * data.M, data.R_missing + j * data.M,
+                                tmp_out_contribs, feat_fails, path_feats
+                            );
+                        }
+                        for (unsigned l = 0; l < contrib_row_size; ++l) {
+                            instance_out_contribs[l] += tmp_out_contribs[l] * data.R_tree_weights[g];
+                        }
+                    }
+                }
+                for (unsigned l = 0; l < contrib_row_size; ++l) {
+                    instance_out_contribs[l] /= total_R_weight;
                 }
+                for (unsigned oind = 0; oind < num_outputs; ++oind) {
+                    instance_out_contribs[data.M * num_outputs + oind] += trees.base_offset[oind];
+                }
+                num_done += 1;
+                continue;
+            }
+
+            // compute the model's margin output for x
+            if (transform != NULL) {
+                std::copy(trees.base_offset, trees.base_offset + num_outputs, margin_x);
+                for (unsigned k = 0; k < trees.tree_limit; ++k) tree_predict(k, trees, x, x_missing, margin_x);
             }
 
             for (unsigned j = 0; j < data.num_R; ++j) {
                 const tfloat *r = data.R + j * data.M;
                 const bool *r_missing = data.R_missing + j * data.M;
-                std::fill_n(tmp_out_contribs, (data.M + 1), 0);
-
-                // compute the model's margin output for r
-                if (transform != NULL) {
-                    margin_r = trees.base_offset[oind];
-                    for (unsigned k = 0; k < trees.tree_limit; ++k) {
-                        margin_r += tree_predict(k, trees, r, r_missing)[oind];
-                    }
+                std::fill_n(tmp_out_contribs, contrib_row_size, 0);
+
+                // compute the model's margin output for r (unless it was cached)
+                if (transform != NULL && data.R_margins != NULL) {
+                    std::copy(data.R_margins + j * num_outputs, data.R_margins + (j + 1) * num_outputs, margin_r);
+                } else if (transform != NULL) {
+                    std::copy(trees.base_offset, trees.base_offset + num_outputs, margin_r);
+                    for (unsigned k = 0; k < trees.tree_limit; ++k) tree_predict(k, trees, r, r_missing, margin_r);
                 }
 
                 for (unsigned k = 0; k < trees.tree_limit; ++k) {
                     tree_shap_indep(
-                        trees.max_depth, data.M, trees.max_nodes, x, x_missing, r, r_missing, 
-                        tmp_out_contribs, pos_lst, neg_lst, feat_hist, memoized_weights, 
-                        node_stack, node_trees + k * trees.max_nodes
+                        trees.max_depth, data.M, trees.tree_num_nodes(k), x, x_missing, r, r_missing,
+                        tmp_out_contribs, pos_lst, neg_lst, feat_hist, memoized_weights,
+                        node_stack, packed_node_trees + trees.tree_offset(k),
+                        trees.values + trees.tree_offset(k) * num_outputs, num_outputs, from_flags,
+                        trees.category_offsets, trees.category_bits
                     );
+                    if (trees.linear.models != NULL) {
+                        tree_shap_indep_linear(
+                            trees, k, data.M, x, x_missing, r, r_missing, tmp_out_contribs, feat_fails, path_feats
+                        );
+                    }
                 }
 
-                // compute the rescale factor
-                if (transform != NULL) {
-                    if (margin_x == margin_r) {
-                        rescale_factor = 1.0;
-                    } else {
-                        rescale_factor = (*transform)(margin_x, y_i) - (*transform)(margin_r, y_i);
-                        rescale_factor /= margin_x - margin_r;
+                const tfloat r_weight = data.R_weights == NULL ? 1 : data.R_weights[j];
+                for (unsigned oind = 0; oind < num_outputs; ++oind) {
+
+                    // compute the rescale factor
+                    if (transform != NULL) {
+                        if (margin_x[oind] == margin_r[oind]) {
+                            rescale_factor = 1.0;
+                        } else {
+                            rescale_factor = (*transform)(margin_x[oind], y_i) - (*transform)(margin_r[oind], y_i);
+                            rescale_factor /= margin_x[oind] - margin_r[oind];
+                        }
                     }
-                }
 
-                // add the effect of the current reference to our running total
-                // this is where we can do per reference scaling for non-linear transformations
-                for (unsigned k = 0; k < data.M; ++k) {
-                    instance_out_contribs[k * trees.num_outputs + oind] += tmp_out_contribs[k] * rescale_factor;
-                }
+                    // add the effect of the current reference to our running total
+                    // this is where we can do per reference scaling for non-linear transformations
+                    for (unsigned k = 0; k < data.M; ++k) {
+                        instance_out_contribs[k * num_outputs + oind] += tmp_out_contribs[k * num_outputs + oind] * rescale_factor * r_weight;
+                    }
 
-                // Add the base offset
-                if (transform != NULL) {
-                    instance_out_contribs[data.M * trees.num_outputs + oind] += (*transform)(trees.base_offset[oind] + tmp_out_contribs[data.M], 0);
-                } else {
-                    instance_out_contribs[data.M * trees.num_outputs + oind] += trees.base_offset[oind] + tmp_out_contribs[data.M];
+                    // Add the base offset
+                    const tfloat bias = trees.base_offset[oind] + tmp_out_contribs[data.M * num_outputs + oind];
+                    if (transform != NULL) {
+                        instance_out_contribs[data.M * num_outputs + oind] += (*transform)(bias, 0) * r_weight;
+                    } else {
+                        instance_out_contribs[data.M * num_outputs + oind] += bias * r_weight;
+                    }
                 }
             }
 
             // average the results over all the references.
-            for (unsigned j = 0; j < (data.M + 1); ++j) {
-                instance_out_contribs[j * trees.num_outputs + oind] /= data.num_R;
+            for (unsigned l = 0; l < contrib_row_size; ++l) {
+                instance_out_contribs[l] /= total_R_weight;
             }
-
-            // apply the base offset to the bias term
-            // for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            //     instance_out_contribs[data.M * trees.num_outputs + j] += (*transform)(trees.base_offset[j], 0);
-            // }
+            num_done += 1;
         }
-    }
-    
-    delete[] tmp_out_contribs;
-    delete[] node_trees;
-    delete[] pos_lst;
-    delete[] neg_lst;
-    delete[] node_stack;
-    delete[] feat_hist;
+
+        delete[] tmp_out_contribs;
+        delete[] pos_lst;
+        delete[] neg_lst;
+        delete[] from_flags;
+        delete[] node_stack;
+        delete[] feat_hist;
+        delete[] margin_x;
+        delete[] margin_r;
+        delete[] feat_fails;
+        delete[] path_feats;
+    });
+
+    if (node_trees != NULL) delete[] node_trees;
     delete[] memoized_weights;
 }
 
 
 /**
- * This runs Tree SHAP with a per tree path conditional dependence assumption.
+ * Tree SHAP with a per tree path conditional dependence assumption, where it is the trees rather than the samples
+ * that are split between the threads. This is what speeds up explaining a single sample (or a handful of them)
+ * with a large ensemble.
+ *
+ * Every thread adds the SHAP values of its own block of trees for all the samples to its own accumulator (the
+ * first block adds straight to out_contribs), and the accumulators are then added to out_contribs in the order of
+ * the blocks, so the result does not depend on which thread finishes first.
  */
-void dense_tree_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
-                               tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
-    tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
-
-    // build explanation for each sample
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
-        data.get_x_instance(instance, i);
-
-        // aggregate the effect of explaining each tree
-        // (this works because of the linearity property of Shapley values)
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            trees.get_tree(tree, j);
-            tree_shap(tree, instance, instance_out_contribs, 0, 0);
+template <typename tfloat>
+void dense_tree_path_dependent_by_tree(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                                       tfloat *out_contribs, const unsigned num_threads) {
+    const unsigned num_blocks = std::max(std::min(num_threads, trees.tree_limit), 1u);
+    const size_t row_size = size_t(data.M + 1) * trees.num_outputs;
+    const size_t out_size = data.num_X * row_size;
+    std::vector<tfloat> block_contribs((num_blocks - 1) * out_size, 0);
+
+    parallel_for(num_blocks, num_blocks, [&](const unsigned start, const unsigned end) {
+        TreeEnsemble<tfloat> tree;
+        ExplanationDataset<tfloat> instance;
+        TreeShapArena<tfloat> arena(trees.max_depth, data.M);
+
+        for (unsigned b = start; b < end; ++b) {
+            tfloat *contribs = b == 0 ? out_contribs : block_contribs.data() + (b - 1) * out_size;
+            const unsigned tree_start = size_t(b) * trees.tree_limit / num_blocks;
+            const unsigned tree_end = size_t(b + 1) * trees.tree_limit / num_blocks;
+            for (unsigned i = 0; i < data.num_X; ++i) {
+                data.get_x_instance(instance, i);
+                for (unsigned j = tree_start; j < tree_end; ++j) {
+                    trees.get_tree(tree, j);
+                    tree_shap(tree, instance, contribs + i * row_size, 0, 0, arena);
+                }
+            }
         }
+    });
+
+    // reduce the accumulators of the other blocks into the first one
+    for (unsigned b = 1; b < num_blocks; ++b) {
+        const tfloat *contribs = block_contribs.data() + (b - 1) * out_size;
+        for (size_t k = 0; k < out_size; ++k) out_contribs[k] += contribs[k];
+    }
 
-        // apply the base offset to the bias term
+    // apply the base offset to the bias term
+    for (unsigned i = 0; i < data.num_X; ++i) {
         for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+            out_contribs[i * row_size + data.M * trees.num_outputs + j] += trees.base_offset[j];
         }
     }
 }
 
+/**
+ * This runs Tree SHAP with a per tree path conditional dependence assumption.
+ *
+ * The samples are split between the threads, unless split_trees is set (see dense_tree_path_dependent_by_tree).
+ */
+template <typename tfloat>
+void dense_tree_path_dependent(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                               tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                               const unsigned num_threads, const bool split_trees = false) {
+    if (split_trees) {
+        dense_tree_path_dependent_by_tree(trees, data, out_contribs, num_threads);
+        return;
+    }
+
+    // build explanation for each sample (each thread handles its own block of samples)
+    parallel_for(data.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        tfloat *instance_out_contribs;
+        TreeEnsemble<tfloat> tree;
+        ExplanationDataset<tfloat> instance;
+        TreeShapArena<tfloat> arena(trees.max_depth, data.M);
+
+        for (unsigned i = start; i < end; ++i) {
+            instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
+            data.get_x_instance(instance, i);
+
+            // aggregate the effect of explaining each tree
+            // (this works because of the linearity property of Shapley values)
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                trees.get_tree(tree, j);
+                tree_shap(tree, instance, instance_out_contribs, 0, 0, arena);
+            }
+
+            // apply the base offset to the bias term
+            for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+            }
+        }
+    });
+}
+
 // phi = np.zeros((self._current_X.shape[1] + 1, self._current_X.shape[1] + 1, self.n_outputs))
 //         phi_diag = np.zeros((self._current_X.shape[1] + 1, self.n_outputs))
 //         for t in range(self.tree_limit):
@@ -1302,18 +2230,21 @@ void dense_tree_path_dependent(const TreeEnsemble& trees, const ExplanationDatas
 //         phi /= self.tree_limit
 //         return phi
 
-void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
+template <typename tfloat>
+void dense_tree_interactions_path_dependent(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
                                             tfloat *out_contribs,
-                                            tfloat transform(const tfloat, const tfloat)) {
+                                            tfloat transform(const tfloat, const tfloat),
+                                            const unsigned num_threads) {
 
     // build a list of all the unique features in each tree
-    int *unique_features = new int[trees.tree_limit * trees.max_nodes];
-    std::fill(unique_features, unique_features + trees.tree_limit * trees.max_nodes, -1);
+    int *unique_features = new int[trees.total_nodes()];
+    std::fill(unique_features, unique_features + trees.total_nodes(), -1);
     for (unsigned j = 0; j < trees.tree_limit; ++j) {
-        const int *features_row = trees.features + j * trees.max_nodes;
-        int *unique_features_row = unique_features + j * trees.max_nodes;
-        for (unsigned k = 0; k < trees.max_nodes; ++k) {
-            for (unsigned l = 0; l < trees.max_nodes; ++l) {
+        const unsigned num_nodes = trees.tree_num_nodes(j);
+        const int *features_row = trees.features + trees.tree_offset(j);
+        int *unique_features_row = unique_features + trees.tree_offset(j);
+        for (unsigned k = 0; k < num_nodes; ++k) {
+            for (unsigned l = 0; l < num_nodes; ++l) {
                 if (features_row[k] == unique_features_row[l]) break;
                 if (unique_features_row[l] < 0) {
                     unique_features_row[l] = features_row[k];
@@ -1323,64 +2254,117 @@ void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const Exp
         }
     }
     
-    // build an interaction explanation for each sample
-    tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
+    // build an interaction explanation for each sample (each thread handles its own block of samples)
     const unsigned contrib_row_size = (data.M + 1) * trees.num_outputs;
-    tfloat *diag_contribs = new tfloat[contrib_row_size];
-    tfloat *on_contribs = new tfloat[contrib_row_size];
-    tfloat *off_contribs = new tfloat[contrib_row_size];
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * contrib_row_size;
-        data.get_x_instance(instance, i);
+    parallel_for(data.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        tfloat *instance_out_contribs;
+        TreeEnsemble<tfloat> tree;
+        ExplanationDataset<tfloat> instance;
+        tfloat *diag_contribs = new tfloat[contrib_row_size];
+        tfloat *on_contribs = new tfloat[contrib_row_size];
+        tfloat *off_contribs = new tfloat[contrib_row_size];
+        TreeShapArena<tfloat> arena(trees.max_depth, data.M);
+        for (unsigned i = start; i < end; ++i) {
+            instance_out_contribs = out_contribs + i * (data.M + 1) * contrib_row_size;
+            data.get_x_instance(instance, i);
+
+            // aggregate the effect of explaining each tree
+            // (this works because of the linearity property of Shapley values)
+            std::fill(diag_contribs, diag_contribs + contrib_row_size, 0);
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                trees.get_tree(tree, j);
+                tree_shap(tree, instance, diag_contribs, 0, 0, arena);
+
+                const int *unique_features_row = unique_features + trees.tree_offset(j);
+                for (unsigned k = 0; k < trees.tree_num_nodes(j); ++k) {
+                    const int ind = unique_features_row[k];
+                    if (ind < 0) break; // < 0 means we have seen all the features for this tree
+
+                    // compute the shap value with this feature held on and off
+                    std::fill(on_contribs, on_contribs + contrib_row_size, 0);
+                    std::fill(off_contribs, off_contribs + contrib_row_size, 0);
+                    tree_shap(tree, instance, on_contribs, 1, ind, arena);
+                    tree_shap(tree, instance, off_contribs, -1, ind, arena);
+
+                    // save the difference between on and off as the interaction value
+                    for (unsigned l = 0; l < contrib_row_size; ++l) {
+                        const tfloat val = (on_contribs[l] - off_contribs[l]) / 2;
+                        instance_out_contribs[ind * contrib_row_size + l] += val;
+                        diag_contribs[l] -= val;
+                    }
+                }
+            }
 
-        // aggregate the effect of explaining each tree
-        // (this works because of the linearity property of Shapley values)
-        std::fill(diag_contribs, diag_contribs + contrib_row_size, 0);
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            trees.get_tree(tree, j);
-            tree_shap(tree, instance, diag_contribs, 0, 0);
+            // set the diagonal
+            for (unsigned j = 0; j < data.M + 1; ++j) {
+                const unsigned offset = j * contrib_row_size + j * trees.num_outputs;
+                for (unsigned k = 0; k < trees.num_outputs; ++k) {
+                    instance_out_contribs[offset + k] = diag_contribs[j * trees.num_outputs + k];
+                }
+            }
 
-            const int *unique_features_row = unique_features + j * trees.max_nodes;
-            for (unsigned k = 0; k < trees.max_nodes; ++k) {
-                const int ind = unique_features_row[k];
-                if (ind < 0) break; // < 0 means we have seen all the features for this tree
+            // apply the base offset to the bias term
+            const unsigned last_ind = (data.M * (data.M + 1) + data.M) * trees.num_outputs;
+            for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                instance_out_contribs[last_ind + j] += trees.base_offset[j];
+            }
+        }
 
-                // compute the shap value with this feature held on and off
-                std::fill(on_contribs, on_contribs + contrib_row_size, 0);
-                std::fill(off_contribs, off_contribs + contrib_row_size, 0);
-                tree_shap(tree, instance, on_contribs, 1, ind);
-                tree_shap(tree, instance, off_contribs, -1, ind);
+        delete[] diag_contribs;
+        delete[] on_contribs;
+        delete[] off_contribs;
+    });
 
-                // save the difference between on and off as the interaction value
-                for (unsigned l = 0; l < contrib_row_size; ++l) {
-                    const tfloat val = (on_contribs[l] - off_contribs[l]) / 2;
-                    instance_out_contribs[ind * contrib_row_size + l] += val;
-                    diag_contribs[l] -= val;
-                }
+    delete[] unique_features;
+}
+
+/**
+ * Same as dense_tree_interactions_path_dependent, but it uses a single pass over each tree
+ * (see tree_shap_interaction_paths) instead of conditioning on each unique feature of each tree.
+ */
+template <typename tfloat>
+void dense_tree_interactions_path_dependent_fast(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                                                 tfloat *out_contribs,
+                                                 tfloat transform(const tfloat, const tfloat),
+                                                 const unsigned num_threads) {
+
+    // build an interaction explanation for each sample (each thread handles its own block of samples)
+    const unsigned contrib_row_size = (data.M + 1) * trees.num_outputs;
+    parallel_for(data.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        tfloat *instance_out_contribs;
+        TreeEnsemble<tfloat> tree;
+        ExplanationDataset<tfloat> instance;
+        tfloat *diag_contribs = new tfloat[contrib_row_size];
+        TreeShapArena<tfloat> arena(trees.max_depth, data.M);
+        for (unsigned i = start; i < end; ++i) {
+            instance_out_contribs = out_contribs + i * (data.M + 1) * contrib_row_size;
+            data.get_x_instance(instance, i);
+
+            // aggregate the effect of explaining each tree
+            // (this works because of the linearity property of Shapley values)
+            std::fill(diag_contribs, diag_contribs + contrib_row_size, 0);
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                trees.get_tree(tree, j);
+                tree_shap_interactions(tree, instance, diag_contribs, instance_out_contribs, arena);
             }
-        }
 
-        // set the diagonal
-        for (unsigned j = 0; j < data.M + 1; ++j) {
-            const unsigned offset = j * contrib_row_size + j * trees.num_outputs;
-            for (unsigned k = 0; k < trees.num_outputs; ++k) {
-                instance_out_contribs[offset + k] = diag_contribs[j * trees.num_outputs + k];
+            // set the diagonal
+            for (unsigned j = 0; j < data.M + 1; ++j) {
+                const unsigned offset = j * contrib_row_size + j * trees.num_outputs;
+                for (unsigned k = 0; k < trees.num_outputs; ++k) {
+                    instance_out_contribs[offset + k] = diag_contribs[j * trees.num_outputs + k];
+                }
             }
-        }
 
-        // apply the base offset to the bias term
-        const unsigned last_ind = (data.M * (data.M + 1) + data.M) * trees.num_outputs;
-        for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[last_ind + j] += trees.base_offset[j];
+            // apply the base offset to the bias term
+            const unsigned last_ind = (data.M * (data.M + 1) + data.M) * trees.num_outputs;
+            for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                instance_out_contribs[last_ind + j] += trees.base_offset[j];
+            }
         }
-    }
 
-    delete[] diag_contribs;
-    delete[] on_contribs;
-    delete[] off_contribs;
-    delete[] unique_features;
+        delete[] diag_contribs;
+    });
 }
 
 /**
@@ -1389,67 +2373,406 @@ void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const Exp
  * By first merging all the trees in a tree ensemble into an equivalent single tree
  * this method allows arbitrary marginal transformations and also ensures that all the
  * evaluations of the model are consistent with some training data point.
+ *
+ * The merged tree has up to two nodes for every sample it is built from, so the rows of X are explained in
+ * chunks of chunk_size rows (0 means a single chunk), and every chunk gets a merged tree built from just its own
+ * rows and the background rows. The merged tree of a chunk depends on all of its rows, so the SHAP values of a
+ * row depend on the chunking (a chunk size of 1 explains every row against its own merged tree). The chunks are
+ * split between the threads, which each reuse a single merged tree buffer.
  */
-void dense_global_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
-                                 tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
-
-    // allocate space for our new merged tree (we save enough room to totally split all samples if need be)
-    TreeEnsemble merged_tree;
-    merged_tree.allocate(1, (data.num_X + data.num_R) * 2, trees.num_outputs);
-    
-    // collapse the ensemble of trees into a single tree that has the same behavior
-    // for all the X and R samples in the dataset
-    build_merged_tree(merged_tree, data, trees);
-
-    // compute the expected value and depth of the new merged tree
-    compute_expectations(merged_tree);
-
-    // explain each sample using our new merged tree
-    ExplanationDataset instance;
-    tfloat *instance_out_contribs;
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
-        data.get_x_instance(instance, i);
-       
-        // since we now just have a single merged tree we can just use the tree_path_dependent algorithm
-        tree_shap(merged_tree, instance, instance_out_contribs, 0, 0);
-
-        // apply the base offset to the bias term
-        for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+template <typename tfloat>
+void dense_global_path_dependent(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                                 tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                                 const unsigned num_threads, unsigned chunk_size = 0) {
+    if (chunk_size == 0 || chunk_size > data.num_X) chunk_size = data.num_X;
+    if (chunk_size == 0) return;
+    const unsigned num_chunks = (data.num_X + chunk_size - 1) / chunk_size;
+
+    // with a single chunk the merged tree is shared, and it is the rows that are split between the threads
+    const unsigned chunk_threads = num_chunks == 1 ? 1 : num_threads;
+    const unsigned row_threads = num_chunks == 1 ? num_threads : 1;
+
+    parallel_for(num_chunks, chunk_threads, [&](const unsigned chunk_start, const unsigned chunk_end) {
+
+        // allocate space for our new merged tree (we save enough room to totally split all samples if need be)
+        const unsigned max_nodes = (chunk_size + data.num_R) * 2;
+        TreeEnsemble<tfloat> merged_tree;
+        merged_tree.allocate(1, max_nodes, trees.num_outputs);
+        if (trees.category_sets != NULL) merged_tree.allocate_category_sets(max_nodes, trees);
+
+        for (unsigned c = chunk_start; c < chunk_end; ++c) {
+            ExplanationDataset<tfloat> chunk = data;
+            const unsigned row_start = c * chunk_size;
+            chunk.X = data.X + size_t(row_start) * data.M;
+            chunk.X_missing = data.X_missing + size_t(row_start) * data.M;
+            chunk.num_X = std::min(chunk_size, data.num_X - row_start);
+
+            // collapse the ensemble of trees into a single tree that has the same behavior
+            // for all the X and R samples in the chunk
+            build_merged_tree(merged_tree, chunk, trees);
+
+            // compute the expected value and depth of the new merged tree
+            compute_expectations(merged_tree);
+
+            // explain each sample using our new merged tree (the merged tree is only read from here on)
+            parallel_for(chunk.num_X, row_threads, [&](const unsigned start, const unsigned end) {
+                ExplanationDataset<tfloat> instance;
+                tfloat *instance_out_contribs;
+                TreeShapArena<tfloat> arena(merged_tree.max_depth, data.M);
+                for (unsigned i = start; i < end; ++i) {
+                    instance_out_contribs = out_contribs + size_t(row_start + i) * (data.M + 1) * trees.num_outputs;
+                    chunk.get_x_instance(instance, i);
+
+                    // since we now just have a single merged tree we can just use the tree_path_dependent algorithm
+                    tree_shap(merged_tree, instance, instance_out_contribs, 0, 0, arena);
+
+                    // apply the base offset to the bias term
+                    for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                        instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset[j];
+                    }
+                }
+            });
         }
-    }
 
-    merged_tree.free();
+        merged_tree.free();
+    });
 }
 
 
 /**
  * The main method for computing Tree SHAP on models using dense data.
  */
-void dense_tree_shap(const TreeEnsemble& trees, const ExplanationDataset &data, tfloat *out_contribs,
-                     const int feature_dependence, unsigned model_transform, bool interactions) {
+template <typename tfloat>
+void dense_tree_shap(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data, tfloat *out_contribs,
+                     const int feature_dependence, unsigned model_transform, unsigned interactions,
+                     const unsigned num_threads, const Node<tfloat> *packed_node_trees = NULL,
+                     const unsigned merged_chunk_size = 0, const bool split_trees = false) {
 
     // see what transform (if any) we have
-    transform_f transform = get_transform(model_transform);
+    transform_f<tfloat> transform = get_transform<tfloat>(model_transform);
 
     // dispatch to the correct algorithm handler
     switch (feature_dependence) {
         case FEATURE_DEPENDENCE::independent:
             if (interactions) {
                 std::cerr << "FEATURE_DEPENDENCE::independent does not support interactions!\n";
-            } else dense_independent(trees, data, out_contribs, transform);
+            } else dense_independent(trees, data, out_contribs, transform, num_threads, packed_node_trees);
             return;
         
         case FEATURE_DEPENDENCE::tree_path_dependent:
-            if (interactions) dense_tree_interactions_path_dependent(trees, data, out_contribs, transform);
-            else dense_tree_path_dependent(trees, data, out_contribs, transform);
+            if (interactions == INTERACTIONS::fast) {
+                dense_tree_interactions_path_dependent_fast(trees, data, out_contribs, transform, num_threads);
+            } else if (interactions) {
+                dense_tree_interactions_path_dependent(trees, data, out_contribs, transform, num_threads);
+            } else dense_tree_path_dependent(trees, data, out_contribs, transform, num_threads, split_trees);
             return;
 
         case FEATURE_DEPENDENCE::global_path_dependent:
             if (interactions) {
                 std::cerr << "FEATURE_DEPENDENCE::global_path_dependent does not support interactions!\n";
-            } else dense_global_path_dependent(trees, data, out_contribs, transform);
+            } else dense_global_path_dependent(trees, data, out_contribs, transform, num_threads, merged_chunk_size);
             return;
     }
 }
+
+
+/**
+ * Samples stored as a CSR sparse matrix (num_X x M), row i holds the entries [indptr[i], indptr[i+1]).
+ * Entries that are not stored are either zeros or, when absent_missing is true, missing values (which
+ * is how XGBoost reads sparse data).
+ */
+template <typename tfloat>
+struct SparseDataset {
+    const int64_t *indptr;
+    const int *indices;
+    const tfloat *data;
+    unsigned num_X;
+    unsigned M;
+    bool absent_missing;
+
+    SparseDataset(const int64_t *indptr, const int *indices, const tfloat *data, unsigned num_X, unsigned M,
+                  bool absent_missing) :
+        indptr(indptr), indices(indices), data(data), num_X(num_X), M(M), absent_missing(absent_missing) {}
+};
+
+/**
+ * Runs body(i, x, x_missing) for the rows [start, end) of a sparse dataset, with each row expanded into
+ * dense x and x_missing buffers of M entries. Only the stored entries of a row are written (and then reset
+ * once body returns), so the cost per row scales with its number of stored entries instead of with M.
+ */
+template <typename tfloat, typename F>
+inline void for_each_sparse_row(const SparseDataset<tfloat> &X, const unsigned start, const unsigned end, F body) {
+    tfloat *x = new tfloat[X.M];
+    bool *x_missing = new bool[X.M];
+    std::fill_n(x, X.M, 0);
+    std::fill_n(x_missing, X.M, X.absent_missing);
+
+    for (unsigned i = start; i < end; ++i) {
+        for (int64_t k = X.indptr[i]; k < X.indptr[i + 1]; ++k) {
+            x[X.indices[k]] = X.data[k];
+            x_missing[X.indices[k]] = std::isnan(X.data[k]);
+        }
+        body(i, x, x_missing);
+        for (int64_t k = X.indptr[i]; k < X.indptr[i + 1]; ++k) {
+            x[X.indices[k]] = 0;
+            x_missing[X.indices[k]] = X.absent_missing;
+        }
+    }
+
+    delete[] x;
+    delete[] x_missing;
+}
+
+/**
+ * The same as dense_tree_predict, but for samples stored in a sparse matrix.
+ */
+template <typename tfloat>
+inline void sparse_tree_predict(tfloat *out, const TreeEnsemble<tfloat> &trees, const SparseDataset<tfloat> &X,
+                                const tfloat *y, unsigned model_transform, const unsigned num_threads = 1) {
+
+    // see what transform (if any) we have
+    transform_f<tfloat> transform = get_transform<tfloat>(model_transform);
+
+    parallel_for(X.num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        for_each_sparse_row(X, start, end, [&](const unsigned i, const tfloat *x, const bool *x_missing) {
+            tfloat *row_out = out + i * trees.num_outputs;
+            for (unsigned k = 0; k < trees.num_outputs; ++k) row_out[k] += trees.base_offset[k];
+            for (unsigned j = 0; j < trees.tree_limit; ++j) tree_predict(j, trees, x, x_missing, row_out);
+            if (transform != NULL) {
+                const tfloat y_i = y == NULL ? 0 : y[i];
+                for (unsigned k = 0; k < trees.num_outputs; ++k) row_out[k] = transform(row_out[k], y_i);
+            }
+        });
+    });
+}
+
+/**
+ * SHAP values stored as a CSR sparse matrix with num_X rows and (M + 1) * num_outputs columns. Column
+ * o * (M + 1) + j holds the value of feature j for output o (j == M is the bias term), and only the
+ * nonzero values are stored.
+ */
+template <typename tfloat>
+struct SparseContribs {
+    std::vector<int64_t> indptr;
+    std::vector<int> indices;
+    std::vector<tfloat> data;
+};
+
+/**
+ * The k features with the largest absolute SHAP values in each row. indices and values are (num_X, num_outputs, k)
+ * arrays, and the features of each row and output are sorted by decreasing absolute SHAP value (ties go to the
+ * lower feature index). With signed_values they are (num_X, num_outputs, 2, k) arrays instead, which hold the k
+ * largest SHAP values in decreasing order followed by the k smallest in increasing order. The bias term is never
+ * included.
+ */
+template <typename tfloat>
+struct TopKContribs {
+    unsigned k;
+    int *indices;
+    tfloat *values;
+    bool signed_values;
+
+    TopKContribs(unsigned k, int *indices, tfloat *values, bool signed_values = false)
+        : k(k), indices(indices), values(values), signed_values(signed_values) {}
+};
+
+/**
+ * Orders (value, feature) pairs for TopKContribs: by decreasing absolute value when order is 0, by decreasing
+ * value when it is 1 and by increasing value when it is -1, then by increasing feature index.
+ */
+template <typename tfloat>
+inline bool top_k_better(const int order, const std::pair<tfloat,int> &a, const std::pair<tfloat,int> &b) {
+    const tfloat key_a = order == 0 ? std::abs(a.first) : order * a.first;
+    const tfloat key_b = order == 0 ? std::abs(b.first) : order * b.first;
+    return key_a > key_b || (key_a == key_b && a.second < b.second);
+}
+
+/**
+ * Explains the rows of a dataset one at a time, where for_each_row(start, end, body) calls body(i, x, x_missing)
+ * with the dense values of each row i in [start, end).
+ *
+ * Each row is explained with the same algorithms dense_tree_shap uses (or with Saabas when approximate is true).
+ * data supplies the labels and background rows, its X and X_missing are not used. The SHAP values are written
+ * into the dense out_contribs array when it is not NULL, otherwise only their nonzero values are collected into
+ * sparse_out, or only the top_out->k largest of them into top_out. A feature can only get a nonzero SHAP value
+ * when some tree splits on it, so collecting a row only looks at those features, and the output scales with the
+ * number of features the trees use rather than M.
+ */
+template <typename tfloat, typename RowsF>
+void tree_shap_by_row(const TreeEnsemble<tfloat>& trees, const unsigned num_X, const unsigned M, RowsF for_each_row,
+                      const ExplanationDataset<tfloat> &data, tfloat *out_contribs,
+                      SparseContribs<tfloat> *sparse_out, TopKContribs<tfloat> *top_out,
+                      const int feature_dependence, unsigned model_transform, const bool approximate,
+                      const unsigned num_threads, const Node<tfloat> *packed_node_trees) {
+    const unsigned num_outputs = trees.num_outputs;
+    const unsigned contrib_row_size = (M + 1) * num_outputs;
+    const bool collect = out_contribs == NULL;
+
+    // the sorted list of features the trees split on or use in their linear leaves (plus the bias term)
+    std::vector<bool> used(M + 1, false);
+    std::vector<unsigned> used_features;
+    if (collect) {
+        for (unsigned j = 0; j < trees.tree_limit; ++j) {
+            const unsigned offset = trees.tree_offset(j);
+            for (unsigned k = 0; k < trees.tree_num_nodes(j); ++k) {
+                const unsigned pos = offset + k;
+                if (trees.children_left[pos] >= 0) used[trees.features[pos]] = true;
+                if (trees.linear.models != NULL && trees.linear.models[pos] >= 0) {
+                    const int m = trees.linear.models[pos];
+                    for (unsigned l = trees.linear.offsets[m]; l < trees.linear.offsets[m + 1]; ++l) {
+                        used[trees.linear.features[l]] = true;
+                    }
+                }
+            }
+        }
+        used[M] = true;
+        for (unsigned j = 0; j <= M; ++j) {
+            if (used[j]) used_features.push_back(j);
+        }
+    }
+    std::vector<int> *row_indices = sparse_out == NULL ? NULL : new std::vector<int>[num_X];
+    std::vector<tfloat> *row_data = sparse_out == NULL ? NULL : new std::vector<tfloat>[num_X];
+
+    parallel_for(num_X, num_threads, [&](const unsigned start, const unsigned end) {
+        tfloat *tmp_out_contribs = collect ? new tfloat[contrib_row_size] : NULL;
+        if (tmp_out_contribs != NULL) std::fill_n(tmp_out_contribs, contrib_row_size, 0);
+        std::vector<std::pair<tfloat,int> > heap;
+        ExplanationDataset<tfloat> instance = data;
+        instance.num_X = 1;
+        instance.M = M;
+
+        for_each_row(start, end, [&](const unsigned i, tfloat *x, bool *x_missing) {
+            instance.X = x;
+            instance.X_missing = x_missing;
+            instance.y = data.y == NULL ? NULL : data.y + i;
+            tfloat *instance_out_contribs = collect ? tmp_out_contribs : out_contribs + i * contrib_row_size;
+
+            if (approximate) {
+                dense_tree_saabas(instance_out_contribs, trees, instance, 1);
+            } else {
+                dense_tree_shap(
+                    trees, instance, instance_out_contribs, feature_dependence, model_transform,
+                    INTERACTIONS::none, 1, packed_node_trees
+                );
+            }
+            if (!collect) return;
+
+            for (unsigned o = 0; o < num_outputs; ++o) {
+
+                // move the nonzero values into the sparse row
+                if (sparse_out != NULL) {
+                    for (unsigned k = 0; k < used_features.size(); ++k) {
+                        const tfloat val = tmp_out_contribs[used_features[k] * num_outputs + o];
+                        if (val != 0) {
+                            row_indices[i].push_back(o * (M + 1) + used_features[k]);
+                            row_data[i].push_back(val);
+                        }
+                    }
+                }
+
+                // keep the k best features in a heap whose top is the worst of them (for each list of features)
+                const unsigned num_lists = top_out == NULL ? 0 : (top_out->signed_values ? 2 : 1);
+                for (unsigned s = 0; s < num_lists; ++s) {
+                    const int order = top_out->signed_values ? (s == 0 ? 1 : -1) : 0;
+                    auto better = [order](const std::pair<tfloat,int> &a, const std::pair<tfloat,int> &b) {
+                        return top_k_better(order, a, b);
+                    };
+                    auto offer = [&](const std::pair<tfloat,int> &item) {
+                        if (heap.size() < top_out->k) {
+                            heap.push_back(item);
+                            std::push_heap(heap.begin(), heap.end(), better);
+                        } else if (better(item, heap.front())) {
+                            std::pop_heap(heap.begin(), heap.end(), better);
+                            heap.back() = item;
+                            std::push_heap(heap.begin(), heap.end(), better);
+                        }
+                    };
+
+                    heap.clear();
+                    for (unsigned k = 0; k < used_features.size() - 1; ++k) {
+                        offer(std::pair<tfloat,int>(
+                            tmp_out_contribs[used_features[k] * num_outputs + o], used_features[k]
+                        ));
+                    }
+
+                    // features no tree splits on have zero SHAP values, so only the first k of them can make it
+                    for (unsigned j = 0, num_unused = 0; j < M && num_unused < top_out->k; ++j) {
+                        if (!used[j]) {
+                            offer(std::pair<tfloat,int>(0, j));
+                            ++num_unused;
+                        }
+                    }
+                    std::sort(heap.begin(), heap.end(), better);
+
+                    const unsigned offset = ((i * num_outputs + o) * num_lists + s) * top_out->k;
+                    for (unsigned k = 0; k < top_out->k; ++k) {
+                        top_out->values[offset + k] = heap[k].first;
+                        top_out->indices[offset + k] = heap[k].second;
+                    }
+                }
+            }
+
+            // clear the buffer for the next row
+            for (unsigned k = 0; k < used_features.size(); ++k) {
+                std::fill_n(tmp_out_contribs + used_features[k] * num_outputs, num_outputs, 0);
+            }
+        });
+
+        delete[] tmp_out_contribs;
+    });
+
+    // concatenate the rows into the CSR arrays
+    if (sparse_out != NULL) {
+        sparse_out->indptr.resize(num_X + 1);
+        sparse_out->indptr[0] = 0;
+        for (unsigned i = 0; i < num_X; ++i) {
+            sparse_out->indptr[i + 1] = sparse_out->indptr[i] + row_indices[i].size();
+        }
+        sparse_out->indices.reserve(sparse_out->indptr[num_X]);
+        sparse_out->data.reserve(sparse_out->indptr[num_X]);
+        for (unsigned i = 0; i < num_X; ++i) {
+            sparse_out->indices.insert(sparse_out->indices.end(), row_indices[i].begin(), row_indices[i].end());
+            sparse_out->data.insert(sparse_out->data.end(), row_data[i].begin(), row_data[i].end());
+        }
+        delete[] row_indices;
+        delete[] row_data;
+    }
+}
+
+/**
+ * The main method for computing Tree SHAP on models using sparse data (see tree_shap_by_row).
+ */
+template <typename tfloat>
+void sparse_tree_shap(const TreeEnsemble<tfloat>& trees, const SparseDataset<tfloat> &X,
+                      const ExplanationDataset<tfloat> &data, tfloat *out_contribs,
+                      SparseContribs<tfloat> *sparse_out, TopKContribs<tfloat> *top_out,
+                      const int feature_dependence, unsigned model_transform, const bool approximate,
+                      const unsigned num_threads, const Node<tfloat> *packed_node_trees = NULL) {
+    tree_shap_by_row(
+        trees, X.num_X, X.M,
+        [&](const unsigned start, const unsigned end, std::function<void(unsigned, tfloat*, bool*)> body) {
+            for_each_sparse_row(X, start, end, body);
+        },
+        data, out_contribs, sparse_out, top_out, feature_dependence, model_transform, approximate, num_threads,
+        packed_node_trees
+    );
+}
+
+/**
+ * Computes Tree SHAP on dense data, collecting only the nonzero SHAP values of each row into sparse_out (or only
+ * the largest of them into top_out).
+ */
+template <typename tfloat>
+void dense_tree_shap_collected(const TreeEnsemble<tfloat>& trees, const ExplanationDataset<tfloat> &data,
+                               SparseContribs<tfloat> *sparse_out, TopKContribs<tfloat> *top_out,
+                               const int feature_dependence, unsigned model_transform, const bool approximate,
+                               const unsigned num_threads, const Node<tfloat> *packed_node_trees = NULL) {
+    tree_shap_by_row(
+        trees, data.num_X, data.M,
+        [&](const unsigned start, const unsigned end, std::function<void(unsigned, tfloat*, bool*)> body) {
+            for (unsigned i = start; i < end; ++i) body(i, data.X + i * data.M, data.X_missing + i * data.M);
+        },
+        data, (tfloat*)NULL, sparse_out, top_out, feature_dependence, model_transform, approximate, num_threads,
+        packed_node_trees
+    );
+}
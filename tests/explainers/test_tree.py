@@ -1,3 +1,6 @@
+import itertools
+import math
+import sys
 import matplotlib
 import numpy as np
 matplotlib.use('Agg')
@@ -187,6 +190,45 @@ def test_xgboost_mixed_types():
     shap_values = shap.TreeExplainer(bst).shap_values(X)
     shap.dependence_plot(0, shap_values, X, show=False)
 
+def test_xgboost_raw_model_loader():
+    try:
+        import xgboost
+    except Exception as e:
+        print("Skipping test_xgboost_raw_model_loader!")
+        return
+    import json
+
+    np.random.seed(0)
+    X = np.random.randn(500, 4)
+    X[np.random.rand(500, 4) < 0.2] = np.nan
+    y = np.nan_to_num(X[:,0], nan=2) + np.isnan(X[:,1]) * np.nan_to_num(X[:,2]) - np.nan_to_num(X[:,3], nan=-1)
+    model = xgboost.train({"max_depth": 4}, xgboost.DMatrix(X, label=y), 10)
+
+    # the bulk reads of the raw dump give the same trees as the JSON dump, and the arrays keep their dtypes
+    loader = shap.explainers.tree.XGBTreeModelLoader(model)
+    trees = loader.get_trees()
+    assert loader.children_default.dtype == np.int64 and loader.features.dtype == np.int64
+    assert loader.thresholds.dtype == np.float32 and loader.values.dtype == np.float32
+    json_trees = [json.loads(t) for t in shap.explainers.tree.get_xgboost_json(model)]
+    assert len(json_trees) == len(trees)
+    num_default_left = 0
+    for json_tree, tree in zip(json_trees, trees):
+        nodes = [json_tree]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            i = node["nodeid"]
+            if "leaf" in node:
+                assert tree.children_left[i] == -1
+                assert np.float32(tree.values[i,0]) == np.float32(node["leaf"])
+            else:
+                assert tree.children_left[i] == node["yes"] and tree.children_right[i] == node["no"]
+                assert tree.children_default[i] == node["missing"]
+                assert tree.features[i] == int(node["split"][1:])
+                assert np.float32(tree.thresholds[i]) == np.float32(node["split_condition"])
+                num_default_left += node["missing"] == node["yes"]
+                nodes.extend(node["children"])
+    assert num_default_left > 0 # the missing values go both ways
+
 def test_ngboost():
     try:
         import ngboost
@@ -1175,3 +1217,798 @@ def test_skopt_rf_et():
 
     assert np.allclose(shap_values_et.sum(1) + explainer_et.expected_value, result_et.models[-1].predict(et_df))
     assert np.allclose(shap_values_rf.sum(1) + explainer_rf.expected_value, result_rf.models[-1].predict(rf_df))
+
+def test_multithreaded_shap_values():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values[:100]
+    y = y[:100]
+
+    # tree path dependent explanations
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=20, max_depth=6, random_state=0)
+    model.fit(X, y)
+    explainer = shap.TreeExplainer(model)
+    assert np.allclose(explainer.shap_values(X), explainer.shap_values(X, n_jobs=4))
+    assert np.allclose(explainer.shap_values(X, approximate=True), explainer.shap_values(X, approximate=True, n_jobs=-1))
+
+    # interventional and global path dependent explanations
+    for feature_perturbation in ["interventional", "global_path_dependent"]:
+        explainer = shap.TreeExplainer(model, X, feature_perturbation=feature_perturbation)
+        assert np.allclose(explainer.shap_values(X), explainer.shap_values(X, n_jobs=3))
+
+    # and the same for an XGBoost model
+    try:
+        import xgboost
+    except:
+        print("Skipping the XGBoost part of test_multithreaded_shap_values!")
+        return
+    model = xgboost.train({"max_depth": 4}, xgboost.DMatrix(X, label=y), 20)
+    for feature_perturbation in ["interventional", "global_path_dependent"]:
+        explainer = shap.TreeExplainer(model, X, feature_perturbation=feature_perturbation)
+        assert np.allclose(explainer.shap_values(X), explainer.shap_values(X, n_jobs=3))
+
+def test_multithreaded_shap_interaction_values():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values[:50]
+    y = y[:50]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model)
+    interaction_vals = explainer.shap_interaction_values(X)
+    assert np.allclose(interaction_vals, explainer.shap_interaction_values(X, n_jobs=4))
+    assert np.allclose(interaction_vals.sum(2), explainer.shap_values(X))
+
+def test_fast_shap_interaction_values():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values[:50]
+    y = y[:50]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=10, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model)
+    interaction_vals = explainer.shap_interaction_values(X)
+    fast_interaction_vals = explainer.shap_interaction_values(X, algorithm="fast")
+    assert np.allclose(interaction_vals, fast_interaction_vals)
+
+    # the multi-output case
+    X, y = shap.datasets.iris()
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
+    model.fit(X, y)
+    explainer = shap.TreeExplainer(model)
+    assert np.allclose(explainer.shap_interaction_values(X), explainer.shap_interaction_values(X, algorithm="fast"))
+
+def test_float32_precision():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values.astype(np.float32)
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=10, random_state=0)
+    model.fit(X, y)
+
+    for data, feature_perturbation in [(None, "tree_path_dependent"), (X[:20], "interventional")]:
+        explainer = shap.TreeExplainer(model, data, feature_perturbation=feature_perturbation)
+        explainer32 = shap.TreeExplainer(model, data, feature_perturbation=feature_perturbation, precision="float32")
+        assert explainer32.model.thresholds.dtype == np.float32
+        shap_values32 = explainer32.shap_values(X)
+        assert shap_values32.dtype == np.float32
+        assert np.allclose(explainer.shap_values(X), shap_values32, atol=1e-3)
+        assert np.allclose(shap_values32.sum(1) + explainer32.expected_value, model.predict(X), atol=1e-3)
+
+def test_iter_shap_values():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.iloc[:110]
+    y = y[:110]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    for explainer in [shap.TreeExplainer(model), shap.TreeExplainer(model, X.iloc[:20])]:
+        shap_values = explainer.shap_values(X)
+        chunks = list(explainer.iter_shap_values(X, chunk_size=25))
+        assert [len(c) for c in chunks] == [25, 25, 25, 25, 10]
+        assert np.allclose(shap_values, np.concatenate(chunks))
+        chunks = list(explainer.iter_shap_values(X.values.astype(np.float64), chunk_size=30))
+        assert np.allclose(shap_values, np.concatenate(chunks))
+
+    # the multi-output case
+    X, y = shap.datasets.iris()
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
+    model.fit(X, y)
+    explainer = shap.TreeExplainer(model)
+    shap_values = explainer.shap_values(X)
+    chunks = list(explainer.iter_shap_values(X, chunk_size=64))
+    for i in range(len(shap_values)):
+        assert np.allclose(shap_values[i], np.concatenate([c[i] for c in chunks]))
+
+def test_packed_trees_are_reused():
+    import pickle
+    import sklearn.ensemble
+
+    X, y = shap.datasets.iris()
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model, X[:20])
+    shap_values = explainer.shap_values(X)
+    packed_trees = explainer.model.get_packed_trees()
+    assert np.allclose(shap_values, explainer.shap_values(X))
+    assert explainer.model.get_packed_trees() is packed_trees
+
+    # the packed trees are rebuilt when needed after pickling
+    explainer2 = pickle.loads(pickle.dumps(explainer))
+    assert np.allclose(shap_values, explainer2.shap_values(X))
+
+def test_ragged_packed_trees():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values[:200]
+    y = y[:200]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=8, max_features=0.3, random_state=0)
+    model.fit(X, y)
+
+    # the trees are unbalanced, so the ragged packed copy must line every tree up correctly
+    explainer = shap.TreeExplainer(model, X[:30])
+    assert len(np.unique(explainer.model.num_nodes)) > 1
+    assert np.allclose(explainer.model.predict(X), model.predict(X))
+    shap_values = explainer.shap_values(X[:50])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[:50]))
+
+    explainer = shap.TreeExplainer(model, feature_perturbation="tree_path_dependent")
+    shap_values = explainer.shap_values(X[:50])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[:50]))
+    interaction_values = explainer.shap_interaction_values(X[:10])
+    assert np.allclose(interaction_values.sum(2), shap_values[:10])
+
+def test_blocked_predict_threads():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.iris()
+    X = np.vstack([X.values] * 3)
+    y = np.hstack([y] * 3)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
+    model.fit(X, y)
+
+    # 450 rows is not a multiple of the row block size
+    explainer = shap.TreeExplainer(model)
+    predictions = explainer.model.predict(X)
+    assert np.allclose(predictions, model.predict_proba(X))
+    for n_jobs in [2, 3, -1]:
+        assert np.array_equal(explainer.model.predict(X, n_jobs=n_jobs), predictions)
+    assert np.allclose(explainer.model.predict(X[5]), predictions[5])
+
+def test_summarize_background():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    y = y > np.median(y)
+    model = sklearn.ensemble.GradientBoostingClassifier(n_estimators=20, max_depth=3, random_state=0)
+    model.fit(X, y)
+
+    # the summary is exact both when the trees can be explained one at a time and when a transform is used
+    for model_output in ["raw", "probability"]:
+        explainer = shap.TreeExplainer(model, X[:400], model_output=model_output)
+        summarized = shap.TreeExplainer(model, X[:400], model_output=model_output, summarize_background=True)
+        assert summarized._background_summary is not None
+        assert np.allclose(explainer.shap_values(X[400:]), summarized.shap_values(X[400:]))
+
+    # with no transform every tree only needs a few representative background rows
+    summarized = shap.TreeExplainer(model, X[:400], summarize_background=True)
+    R_tree_offsets = summarized._background_summary[3]
+    assert R_tree_offsets[-1] < 20 * 400
+
+def test_background_margins_are_cached():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    y = y > np.median(y)
+    model = sklearn.ensemble.GradientBoostingClassifier(n_estimators=20, max_depth=3, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model, X[:100], model_output="probability")
+    shap_values = explainer.shap_values(X[100:150])
+    assert len(explainer._background_margins) == 1
+    margins = list(explainer._background_margins.values())[0]
+    assert np.allclose(margins[:,0], model.decision_function(X[:100]))
+
+    # the second call reuses the cached margins
+    assert np.allclose(explainer.shap_values(X[100:150]), shap_values)
+    assert list(explainer._background_margins.values())[0] is margins
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict_proba(X[100:150])[:,1])
+
+def test_save_load():
+    import os
+    import tempfile
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    y = y > np.median(y)
+    model = sklearn.ensemble.GradientBoostingClassifier(n_estimators=20, max_depth=3, random_state=0)
+    model.fit(X, y)
+
+    explainers = [
+        shap.TreeExplainer(model),
+        shap.TreeExplainer(model, X[:100], model_output="probability"),
+        shap.TreeExplainer(model, X[:100], summarize_background=True)
+    ]
+    tmpdir = tempfile.mkdtemp()
+    for i, explainer in enumerate(explainers):
+        path = os.path.join(tmpdir, "explainer%d.shap" % i)
+        explainer.save(path)
+        for mmap in [True, False]:
+            loaded = shap.TreeExplainer.load(path, mmap=mmap)
+            assert isinstance(loaded.model.values, np.memmap) == mmap
+            assert np.allclose(loaded.expected_value, explainer.expected_value)
+            assert np.allclose(loaded.shap_values(X[400:]), explainer.shap_values(X[400:]))
+
+def test_save_load_lightgbm_multiclass():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_save_load_lightgbm_multiclass!")
+        return
+    import os
+    import tempfile
+
+    X, y = shap.datasets.iris()
+    X = X.values
+    model = lightgbm.LGBMClassifier(n_estimators=10, num_leaves=4, verbose=-1)
+    model.fit(X, y)
+
+    # the loaded explainer runs the internal algorithm, with the same output for every class as LightGBM
+    explainer = shap.TreeExplainer(model)
+    shap_values = explainer.shap_values(X[:20])
+    path = os.path.join(tempfile.mkdtemp(), "explainer.shap")
+    explainer.save(path)
+    loaded = shap.TreeExplainer.load(path)
+    assert loaded.model.num_outputs == 3
+    loaded_values = loaded.shap_values(X[:20])
+    assert len(loaded_values) == 3
+    for i in range(3):
+        assert np.allclose(loaded_values[i], shap_values[i])
+        assert np.allclose(loaded.expected_value[i], explainer.expected_value[i])
+
+    # LightGBM reports two outputs for binary models, while the loaded explainer has the single internal one
+    model.fit(X, y == 1)
+    explainer = shap.TreeExplainer(model)
+    shap_values = explainer.shap_values(X[:20])
+    explainer.save(path)
+    loaded = shap.TreeExplainer.load(path)
+    assert np.allclose(loaded.shap_values(X[:20]), shap_values[1])
+    assert np.allclose(loaded.expected_value, explainer.expected_value[1])
+
+def test_process_backend_shares_memory():
+    if sys.version_info < (3, 8):
+        print("Skipping test_process_backend_shares_memory!")
+        return
+    import pickle
+    import os
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    y = y > np.median(y)
+    model = sklearn.ensemble.GradientBoostingClassifier(n_estimators=20, max_depth=3, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model, X[:100], model_output="probability")
+    shap_values = explainer.shap_values(X[400:])
+
+    # the process backend shares the arrays for the call only, and leaves no shared memory blocks behind
+    shm_dir = "/dev/shm"
+    blocks_before = set(os.listdir(shm_dir)) if os.path.isdir(shm_dir) else set()
+    assert np.allclose(explainer.shap_values(X[400:], n_jobs=2, backend="process"), shap_values)
+    assert not isinstance(explainer.model.values.base, shap.explainers.tree.SharedArray)
+    assert not isinstance(explainer.data.base, shap.explainers.tree.SharedArray)
+    if os.path.isdir(shm_dir):
+        assert set(os.listdir(shm_dir)) <= blocks_before
+
+    # once share_memory moves the arrays into shared memory pickling only stores handles to them, and the process
+    # backend uses them as they are
+    shared = shap.TreeExplainer(model, X[:100], model_output="probability")
+    shared.share_memory()
+    assert len(pickle.dumps(shared.model)) < len(pickle.dumps(explainer.model)) / 10
+    assert np.allclose(shared.shap_values(X[400:], n_jobs=2, backend="process"), shap_values)
+    assert isinstance(shared.model.values.base, shap.explainers.tree.SharedArray)
+    assert np.allclose(pickle.loads(pickle.dumps(shared)).shap_values(X[400:]), shap_values)
+
+def test_update_background_weights():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=4, random_state=0)
+    model.fit(X, y)
+
+    # folding the reference data in one batch at a time matches passing it all at once
+    explainer = shap.TreeExplainer(model, X, feature_perturbation="tree_path_dependent")
+    batched = shap.TreeExplainer(model, X[:200], feature_perturbation="tree_path_dependent")
+    batched.update_background_weights(X[200:400])
+    batched.update_background_weights(X[400:], n_jobs=2)
+    assert np.allclose(batched.model.node_sample_weight, explainer.model.node_sample_weight)
+    assert np.allclose(batched.shap_values(X[:20]), explainer.shap_values(X[:20]))
+    assert np.allclose(batched.expected_value, explainer.expected_value)
+
+def test_update_background_weights_lightgbm():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_update_background_weights_lightgbm!")
+        return
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = lightgbm.sklearn.LGBMRegressor(n_estimators=10, num_leaves=8, min_child_samples=5)
+    model.fit(X, y)
+
+    # the reweighted trees are explained by the internal algorithm instead of LightGBM's own Tree SHAP
+    explainer = shap.TreeExplainer(model)
+    shap_values = explainer.shap_values(X[:20])
+    explainer.update_background_weights(X[:100] + 5)
+    reweighted_values = explainer.shap_values(X[:20])
+    assert not np.allclose(reweighted_values, shap_values)
+    assert np.allclose(reweighted_values.sum(1) + explainer.expected_value, model.predict(X[:20]))
+    assert np.allclose(np.concatenate(list(explainer.iter_shap_values(X[:20], chunk_size=8))), reweighted_values)
+
+    # multiclass models keep one output per class, and counting the training data again changes nothing
+    X, y = shap.datasets.iris()
+    X = X.values
+    model = lightgbm.LGBMClassifier(n_estimators=10, num_leaves=4, verbose=-1)
+    model.fit(X, y)
+    contribs = model.booster_.predict(X[:20], pred_contrib=True).reshape(20, 3, X.shape[1] + 1)
+    explainer = shap.TreeExplainer(model)
+    explainer.update_background_weights(X)
+    shap_values = explainer.shap_values(X[:20])
+    assert len(shap_values) == 3
+    for i in range(3):
+        assert np.allclose(shap_values[i], contribs[:, i, :-1])
+
+def test_global_path_dependent_max_merged_nodes():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    explainer = shap.TreeExplainer(model, X[:50], feature_perturbation="global_path_dependent")
+    shap_values = explainer.shap_values(X[50:])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[50:]))
+
+    # a limit that fits every sample in one merged tree changes nothing
+    unbounded = shap.TreeExplainer(model, X[:50], feature_perturbation="global_path_dependent", max_merged_nodes=10000)
+    assert np.allclose(unbounded.shap_values(X[50:], n_jobs=2), shap_values)
+
+    # chunked explanations stay additive, don't depend on the threads, and use less memory
+    bounded = shap.TreeExplainer(model, X[:50], feature_perturbation="global_path_dependent", max_merged_nodes=150)
+    bounded_values = bounded.shap_values(X[50:])
+    assert np.allclose(bounded_values.sum(1) + bounded.expected_value, model.predict(X[50:]))
+    assert np.allclose(bounded.shap_values(X[50:], n_jobs=3), bounded_values)
+    assert bounded.merged_tree_memory(len(X) - 50) < explainer.merged_tree_memory(len(X) - 50)
+
+    # iter_shap_values explains whole chunks at a time, so it matches shap_values
+    chunks = list(bounded.iter_shap_values(X[50:], chunk_size=60))
+    assert np.allclose(np.concatenate(chunks), bounded_values)
+    assert np.allclose(np.concatenate(list(explainer.iter_shap_values(X[50:], chunk_size=len(X)))), shap_values)
+
+    # with a merged tree per sample the explanations don't depend on the other samples
+    per_sample = shap.TreeExplainer(model, X[:50], feature_perturbation="global_path_dependent", max_merged_nodes=102)
+    assert np.allclose(per_sample.shap_values(X[50:60])[5:], per_sample.shap_values(X[55:60]))
+
+def test_global_path_dependent_background_rows():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=5, max_depth=4, random_state=0)
+    model.fit(X, y)
+
+    # the merged tree counts the background rows in its nodes, not the rows being explained, so the expected
+    # value the C extension returns is the mean prediction of the background rows
+    explainer = shap.TreeExplainer(model, X[:30], feature_perturbation="global_path_dependent")
+    explainer.expected_value = None
+    shap_values = explainer.shap_values(X[100:110])
+    assert np.allclose(explainer.expected_value, model.predict(X[:30]).mean())
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[100:110]))
+
+def test_global_path_dependent_unseen_branches():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=5, max_depth=4, random_state=0)
+    model.fit(X, y)
+
+    # with a single background row most nodes of the merged tree are only reached by the rows being explained
+    explainer = shap.TreeExplainer(model, X[:1], feature_perturbation="global_path_dependent")
+    shap_values = explainer.shap_values(X[100:110])
+    assert np.all(np.isfinite(shap_values))
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[100:110]))
+
+def test_very_deep_tree():
+
+    # a chain of 20000 splits over three features, where internal node k sits at 2k with a leaf to its left
+    depth = 20000
+    internal = 2 * np.arange(depth)
+    children_left = np.full(2 * depth + 1, -1)
+    children_left[internal] = internal + 1
+    children_right = np.full(2 * depth + 1, -1)
+    children_right[internal] = internal + 2
+    features = np.full(2 * depth + 1, -2)
+    features[internal] = np.arange(depth) % 3
+    thresholds = np.zeros(2 * depth + 1)
+    thresholds[internal] = np.arange(depth) / 1000
+    values = np.zeros((2 * depth + 1, 1))
+    values[internal + 1, 0] = np.arange(depth) % 7
+    values[-1, 0] = 10
+    node_sample_weight = np.ones(2 * depth + 1)
+    node_sample_weight[internal] = depth + 1 - np.arange(depth)
+    model = {"trees": [{
+        "children_left": children_left, "children_right": children_right, "children_default": children_right,
+        "features": features, "thresholds": thresholds, "values": values, "node_sample_weight": node_sample_weight
+    }]}
+
+    # the paths are walked without recursing, and only take memory for as many features as the tree has
+    explainer = shap.TreeExplainer(model)
+    assert explainer.model.max_depth == depth
+    np.random.seed(0)
+    X = np.random.rand(20, 3) * depth / 1000
+    shap_values = explainer.shap_values(X)
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, explainer.model.predict(X))
+    interaction_values = explainer.shap_interaction_values(X[:5])
+    assert np.allclose(interaction_values.sum(2), shap_values[:5])
+
+def test_parallel_over_trees():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.iris()
+    X = X.values
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=50, max_depth=6, random_state=0)
+    model.fit(X, y)
+    explainer = shap.TreeExplainer(model)
+
+    # splitting the trees between the threads gives the same SHAP values as splitting the samples
+    shap_values = explainer.shap_values(X[:10])
+    for n_jobs in [1, 3, 64]:
+        by_tree = explainer.shap_values(X[:10], n_jobs=n_jobs, parallel_over="trees")
+        assert np.allclose(by_tree, shap_values)
+    single = explainer.shap_values(X[0], n_jobs=4, parallel_over="trees")
+    assert np.allclose(single, [v[0] for v in shap_values])
+
+def test_optimize():
+    import sklearn.ensemble
+
+    np.random.seed(0)
+    X = np.round(np.random.randn(300, 10), 1)
+    X[:, 6:] = 0
+    y = X[:, 0] + (X[:, 1] > 0) * X[:, 2]
+    model = sklearn.ensemble.GradientBoostingRegressor(n_estimators=40, max_depth=2, random_state=0)
+    model.fit(X, y)
+
+    # the optimized ensemble drops the constant features but explains exactly like the original one
+    for data in [None, X[:50]]:
+        explainer = shap.TreeExplainer(model, data)
+        optimized = shap.TreeExplainer(model, data)
+        optimized.optimize()
+        assert len(optimized.model.used_features) <= 6
+        assert np.allclose(optimized.model.predict(X), explainer.model.predict(X))
+        assert np.allclose(optimized.shap_values(X[:20]), explainer.shap_values(X[:20]))
+        assert np.allclose(optimized.expected_value, explainer.expected_value)
+    assert np.allclose(optimized.shap_values(X[:20], output_format="csr").toarray(),
+                       explainer.shap_values(X[:20]))
+    optimized = shap.TreeExplainer(model)
+    optimized.optimize()
+    interactions = shap.TreeExplainer(model).shap_interaction_values(X[:5])
+    assert np.allclose(optimized.shap_interaction_values(X[:5]), interactions)
+
+def test_optimize_lightgbm():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_optimize_lightgbm!")
+        return
+
+    np.random.seed(0)
+    X = np.round(np.random.randn(300, 10), 1)
+    X[:, 6:] = 0
+    y = (X[:, 0] > 0).astype(float)
+    model = lightgbm.LGBMRegressor(n_estimators=30, num_leaves=4, verbose=-1)
+    model.fit(X, y)
+
+    # the optimized trees are explained by the internal algorithm, so tree_limit counts the trees that are left
+    explainer = shap.TreeExplainer(model)
+    shap_values = explainer.shap_values(X[:20])
+    explainer.optimize()
+    num_trees = explainer.model.values.shape[0]
+    assert num_trees < 30
+    assert np.allclose(explainer.shap_values(X[:20]), shap_values)
+    assert np.allclose(explainer.shap_values(X[:20], tree_limit=num_trees), shap_values)
+
+def test_optimize_lightgbm_multiclass():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_optimize_lightgbm_multiclass!")
+        return
+
+    X, y = shap.datasets.iris()
+    X = X.values
+    model = lightgbm.LGBMClassifier(n_estimators=10, num_leaves=4, verbose=-1)
+    model.fit(X, y)
+    contribs = model.booster_.predict(X[:20], pred_contrib=True).reshape(20, 3, X.shape[1] + 1)
+
+    # every class keeps its own output once the trees are explained by the internal algorithm
+    explainer = shap.TreeExplainer(model)
+    explainer.optimize()
+    assert explainer.model.num_outputs == 3
+    shap_values = explainer.shap_values(X[:20])
+    assert len(shap_values) == 3
+    for i in range(3):
+        assert np.allclose(shap_values[i], contribs[:, i, :-1])
+        assert np.allclose(explainer.expected_value[i], contribs[0, i, -1])
+
+def test_multi_output_interventional():
+    import sklearn.ensemble
+
+    X, y = shap.datasets.iris()
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
+    model.fit(X, y)
+
+    # every class is explained by the same pass through the trees
+    explainer = shap.TreeExplainer(model, X[:50])
+    shap_values = explainer.shap_values(X[50:100])
+    assert len(shap_values) == 3
+    probs = model.predict_proba(X[50:100])
+    for i in range(3):
+        assert np.allclose(shap_values[i].sum(1) + explainer.expected_value[i], probs[:,i], atol=1e-6)
+
+def test_sparse_input():
+    import scipy.sparse
+    import sklearn.ensemble
+
+    np.random.seed(0)
+    X = np.random.randn(200, 50)
+    X[np.random.rand(200, 50) < 0.8] = 0
+    y = X[:,0] + X[:,1] * X[:,2] + (X[:,3] > 0)
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+    X_sparse = scipy.sparse.csr_matrix(X)
+
+    # sparse rows are expanded inside the C extension and get the same values as the dense rows
+    for explainer in [shap.TreeExplainer(model), shap.TreeExplainer(model, X[:20])]:
+        shap_values = explainer.shap_values(X[:50])
+        assert np.allclose(explainer.shap_values(X_sparse[:50], n_jobs=2), shap_values)
+        assert np.allclose(explainer.shap_values(X_sparse[:50].tocoo(), approximate=True), explainer.shap_values(X[:50], approximate=True))
+        assert np.allclose(explainer.model.predict(X_sparse[:50]), model.predict(X[:50]))
+
+
+def test_csr_output():
+    import scipy.sparse
+    import sklearn.ensemble
+
+    np.random.seed(0)
+    X = np.random.randn(100, 200)
+    y = X[:,0] + X[:,1] * X[:,2]
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=5, max_depth=4, random_state=0)
+    model.fit(X, y > 0)
+    used_features = np.unique(np.concatenate([e.tree_.feature[e.tree_.feature >= 0] for e in model.estimators_]))
+
+    # only the features the trees split on are stored, and the values match the dense output
+    for explainer in [shap.TreeExplainer(model), shap.TreeExplainer(model, X[:20])]:
+        shap_values = explainer.shap_values(X[:30])
+        for X_explain in [X[:30], scipy.sparse.csr_matrix(X[:30])]:
+            csr_values = explainer.shap_values(X_explain, output_format="csr", n_jobs=2)
+            for i in range(2):
+                assert scipy.sparse.isspmatrix_csr(csr_values[i])
+                assert np.all(np.isin(csr_values[i].indices, used_features))
+                assert np.allclose(csr_values[i].toarray(), shap_values[i])
+        csr_values = explainer.shap_values(X[:30], approximate=True, output_format="csr")
+        assert np.allclose(csr_values[1].toarray(), explainer.shap_values(X[:30], approximate=True)[1])
+
+    # global_path_dependent explains the rows together, with or without a limit on the merged trees
+    for max_merged_nodes in [None, 100]:
+        explainer = shap.TreeExplainer(
+            model, X[:30], feature_perturbation="global_path_dependent", max_merged_nodes=max_merged_nodes
+        )
+        shap_values = explainer.shap_values(X[30:60])
+        csr_values = explainer.shap_values(X[30:60], output_format="csr", n_jobs=2)
+        for i in range(2):
+            assert np.allclose(csr_values[i].toarray(), shap_values[i])
+
+
+def test_top_k():
+    import scipy.sparse
+    import sklearn.ensemble
+
+    np.random.seed(0)
+    X = np.random.randn(100, 30)
+    y = X[:,0] - 2 * X[:,1] * X[:,2] + X[:,3]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    # the top k values are the largest absolute values of the full SHAP values
+    for explainer in [shap.TreeExplainer(model), shap.TreeExplainer(model, X[:20])]:
+        shap_values = explainer.shap_values(X[:40])
+        for X_explain in [X[:40], scipy.sparse.csr_matrix(X[:40])]:
+            indices, values = explainer.shap_values(X_explain, top_k=5, n_jobs=2)
+            assert indices.shape == (40, 5) and values.shape == (40, 5)
+            assert np.allclose(np.take_along_axis(shap_values, indices, axis=1), values)
+            assert np.allclose(np.abs(values), -np.sort(-np.abs(shap_values), axis=1)[:, :5])
+
+            # the signed mode returns the largest and the smallest values separately
+            largest, smallest = explainer.shap_values(X_explain, top_k=5, top_k_mode="signed")
+            assert np.allclose(np.take_along_axis(shap_values, largest[0], axis=1), largest[1])
+            assert np.allclose(largest[1], -np.sort(-shap_values, axis=1)[:, :5])
+            assert np.allclose(np.take_along_axis(shap_values, smallest[0], axis=1), smallest[1])
+            assert np.allclose(smallest[1], np.sort(shap_values, axis=1)[:, :5])
+
+    # global_path_dependent explains the rows together
+    explainer = shap.TreeExplainer(model, X[:20], feature_perturbation="global_path_dependent", max_merged_nodes=60)
+    shap_values = explainer.shap_values(X[40:80])
+    indices, values = explainer.shap_values(X[40:80], top_k=5)
+    assert np.allclose(np.take_along_axis(shap_values, indices, axis=1), values)
+    assert np.allclose(np.abs(values), -np.sort(-np.abs(shap_values), axis=1)[:, :5])
+
+    # asking for more features than there are returns all of them
+    indices, values = shap.TreeExplainer(model).shap_values(X[0], top_k=100)
+    assert sorted(indices) == list(range(30))
+
+
+def test_lightgbm_categorical():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_categorical!")
+        return
+
+    np.random.seed(0)
+    X = np.column_stack([
+        np.random.randint(0, 40, 1000), np.random.randn(1000), np.random.randint(0, 5, 1000), np.random.randn(1000)
+    ]).astype(np.float64)
+    y = 2 * np.isin(X[:,0], [1, 3, 7, 11, 20, 33]) + X[:,1] + (X[:,2] == 2) * X[:,3]
+    model = lightgbm.LGBMRegressor(n_estimators=20, num_leaves=15, min_data_per_group=5, cat_smooth=1, verbose=-1)
+    model.fit(X, y, categorical_feature=[0, 2])
+
+    # the categorical splits are parsed into the internal trees
+    explainer = shap.TreeExplainer(model)
+    assert explainer.model.category_sets is not None and np.any(explainer.model.category_sets >= 0)
+    assert np.allclose(explainer.model.predict(X[:100]), model.predict(X[:100]))
+
+    # the internal algorithm (the csr output skips LightGBM's own implementation) matches LightGBM
+    shap_values = explainer.shap_values(X[:100], output_format="csr").toarray()
+    assert np.allclose(shap_values, model.predict(X[:100], pred_contrib=True)[:,:-1])
+
+    # interventional explanations sum to the model output
+    explainer = shap.TreeExplainer(model, X[:50])
+    shap_values = explainer.shap_values(X[:100])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[:100]), atol=1e-6)
+
+def test_lightgbm_zero_as_missing():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_zero_as_missing!")
+        return
+
+    np.random.seed(0)
+    X = np.random.randn(200, 3)
+    X[X[:,0] > 1, 0] = 0
+    y = X[:,0] + X[:,1]
+    model = lightgbm.train({"zero_as_missing": True, "verbose": -1}, lightgbm.Dataset(X, y), 5)
+
+    # the internal trees can't send zeros to the default child, so LightGBM explains the model itself
+    explainer = shap.TreeExplainer(model)
+    assert explainer.model.trees is None
+    shap_values = explainer.shap_values(X[:20])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, model.predict(X[:20]))
+
+    # and the algorithms that need the internal trees refuse the model rather than giving wrong values
+    try:
+        shap.TreeExplainer(model, X[:50])
+        assert False, "A zero_as_missing LightGBM model should need feature_perturbation=\"tree_path_dependent\"!"
+    except shap.common.SHAPError:
+        pass
+
+def test_lightgbm_linear_tree():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_linear_tree!")
+        return
+
+    np.random.seed(0)
+    X = np.random.randn(1000, 3)
+    X[np.random.rand(1000, 3) < 0.05] = np.nan
+    y = np.where(X[:,0] > 0, 2 * np.nan_to_num(X[:,1]), -np.nan_to_num(X[:,2])) + np.random.randn(1000) * 0.1
+    model = lightgbm.LGBMRegressor(n_estimators=10, num_leaves=6, linear_tree=True, verbose=-1)
+    model.fit(X, y)
+
+    # the linear leaves are parsed into the internal trees (including the fallback for missing values)
+    explainer = shap.TreeExplainer(model, feature_perturbation="tree_path_dependent")
+    assert explainer.model.linear_models is not None
+    assert np.allclose(explainer.model.predict(X[:100]), model.predict(X[:100]))
+
+    # the path dependent split of leaves that use several features between their values and their linear terms
+    # depends on an arbitrary choice of means, so they are only explained with the interventional algorithm
+    raised = False
+    try:
+        explainer.shap_values(X[:100])
+    except AssertionError as e:
+        raised = "interventional" in str(e)
+    assert raised
+
+    # leaves with one feature have a single mean where their linear model gives the leaf's missing value output
+    stumps = lightgbm.LGBMRegressor(n_estimators=10, num_leaves=2, linear_tree=True, verbose=-1)
+    stumps.fit(X, y)
+    explainer = shap.TreeExplainer(stumps)
+    num_linear_leaves = 0
+    for tree, tree_info in zip(explainer.model.trees, stumps.booster_.dump_model()["tree_info"]):
+        for l, leaf in enumerate([tree_info["tree_structure"]["left_child"], tree_info["tree_structure"]["right_child"]]):
+            if len(leaf["leaf_features"]) > 0:
+                features, coefs, means = tree.linear_leaves[1 + l]
+                assert list(features) == leaf["leaf_features"] == [tree_info["tree_structure"]["split_feature"]]
+                assert np.allclose(means, (leaf["leaf_value"] - leaf["leaf_const"]) / np.array(leaf["leaf_coeff"]))
+                num_linear_leaves += 1
+    assert num_linear_leaves > 0
+
+    # LightGBM can't explain linear trees itself, so these come from the internal algorithm
+    shap_values = explainer.shap_values(X[:100])
+    assert np.allclose(shap_values.sum(1) + explainer.expected_value, stumps.predict(X[:100]))
+
+    # interventional explanations match brute force Shapley values against the same background
+    background = X[:20][~np.isnan(X[:20]).any(1)]
+    explainer = shap.TreeExplainer(model, background)
+    x = np.array([0.5, -1.0, 2.0])
+    shap_values = explainer.shap_values(x.reshape(1, -1))[0]
+    brute_force = np.zeros(3)
+    for i in range(3):
+        others = [j for j in range(3) if j != i]
+        for size in range(3):
+            for S in itertools.combinations(others, size):
+                weight = math.factorial(size) * math.factorial(2 - size) / math.factorial(3)
+                with_i = background.copy()
+                with_i[:,list(S) + [i]] = x[list(S) + [i]]
+                without_i = background.copy()
+                without_i[:,list(S)] = x[list(S)]
+                brute_force[i] += weight * (model.predict(with_i).mean() - model.predict(without_i).mean())
+    assert np.allclose(shap_values, brute_force)
+
+def test_lightgbm_text_model_loader():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_text_model_loader!")
+        return
+
+    np.random.seed(0)
+    X = np.column_stack([np.random.randint(0, 20, 1000), np.random.randn(1000, 3)]).astype(np.float64)
+    X[np.random.rand(1000, 4) < 0.05] = np.nan
+    y = 2 * np.isin(X[:,0], [1, 3, 7, 11]) + np.nan_to_num(X[:,1]) * np.nan_to_num(X[:,2])
+    model = lightgbm.LGBMRegressor(n_estimators=20, num_leaves=15, min_data_per_group=5, cat_smooth=1, verbose=-1)
+    model.fit(X, y, categorical_feature=[0])
+
+    # parsing the text model gives the same trees as walking the dump_model JSON
+    json_trees = [shap.explainers.tree.Tree(t) for t in model.booster_.dump_model()["tree_info"]]
+    text_trees = shap.explainers.tree.LightGBMTreeModelLoader(model.booster_).get_trees()
+    assert len(json_trees) == len(text_trees)
+    for json_tree, text_tree in zip(json_trees, text_trees):
+        for name in ["children_left", "children_right", "children_default", "features", "thresholds", "values"]:
+            assert np.array_equal(getattr(json_tree, name), getattr(text_tree, name))
+        assert json_tree.categories.keys() == text_tree.categories.keys()
+        for node in json_tree.categories:
+            assert np.array_equal(json_tree.categories[node], text_tree.categories[node])
+
+    # the trees can be parsed by several processes through the explainer
+    explainer = shap.TreeExplainer(model, n_jobs=2)
+    for name in ["children_left", "children_right", "features", "thresholds", "values"]:
+        assert np.array_equal(getattr(explainer.model, name), getattr(shap.TreeExplainer(model).model, name))